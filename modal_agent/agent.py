@@ -3,25 +3,52 @@
 Stores logs and results directly in Supabase.
 """
 
+import contextvars
+import hashlib
 import json
+import math
 import os
+import queue
 import re
+import threading
 import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta, timezone
 from typing import Callable
 
 import modal
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+# Admission limits are read where the app is deployed and baked into the image
+# env, so Modal's concurrency limit and the database admission check (run in
+# other containers) always use the same values
+AGENT_LIMITS_ENV = {
+    name: os.environ.get(name, default)
+    for name, default in (
+        ("AGENT_MAX_CONCURRENCY", "20"),
+        ("AGENT_MAX_QUEUED", "50"),
+        ("AGENT_MAX_RUNS_PER_USER", "2"),
+    )
+}
 
-image = modal.Image.debian_slim(python_version="3.12").pip_install(
-    "anthropic", "requests", "supabase", "fastapi", "logfire"
+image = (
+    modal.Image.debian_slim(python_version="3.12")
+    .pip_install("anthropic", "requests", "supabase", "fastapi", "logfire")
+    .env(AGENT_LIMITS_ENV)
 )
 
-# Image with bun for artifact building
+# Image with bun for artifact building (installed outside /root so the
+# unprivileged user that runs artifact code can execute it)
 artifact_image = (
     modal.Image.debian_slim(python_version="3.12")
     .apt_install("curl", "unzip")
-    .run_commands("curl -fsSL https://bun.sh/install | bash")
-    .env({"PATH": "/root/.bun/bin:$PATH"})
+    .run_commands("curl -fsSL https://bun.sh/install | BUN_INSTALL=/usr/local bash")
     .pip_install("supabase", "fastapi")
 )
 
@@ -30,6 +57,149 @@ anthropic_secret = modal.Secret.from_name("anthropic-api-key")
 supabase_secret = modal.Secret.from_name("policyengine-chat-supabase")
 logfire_secret = modal.Secret.from_name("logfire")
 
+# Persistent cache shared by all agent containers (OpenAPI spec and generated tools)
+cache_volume = modal.Volume.from_name("policyengine-chat-cache", create_if_missing=True)
+CACHE_MOUNT = "/cache"
+# The ArtifactBuilder's own volume: only bun's package cache and pinned lockfiles
+artifact_build_volume = modal.Volume.from_name("policyengine-chat-artifact-build", create_if_missing=True)
+ARTIFACT_BUILD_MOUNT = "/artifact-build"
+TOOL_CACHE_DIR = os.environ.get("TOOL_CACHE_DIR", f"{CACHE_MOUNT}/openapi")
+TOOL_CACHE_REVALIDATE_SECONDS = int(os.environ.get("TOOL_CACHE_REVALIDATE_SECONDS", "300"))
+# Bump when openapi_to_claude_tools output changes so stale on-disk tools are rebuilt
+TOOL_CACHE_VERSION = 6
+
+# Tool input schemas: $ref definitions shared by several operations that
+# convert to more than SCHEMA_SHARED_COMPACT_CHARS drop their nested field
+# descriptions, and a tool whose schema is still over SCHEMA_TOOL_MAX_CHARS
+# has its deepest objects collapsed to field lists until it fits
+SCHEMA_SHARED_COMPACT_CHARS = 1500
+SCHEMA_TOOL_MAX_CHARS = 8000
+
+# Per-run tool subsetting: each run starts with the API tools most relevant to
+# the question (plus those the system prompt relies on) and an expand_tools
+# tool to load more, instead of sending every operation on every turn
+TOOL_SUBSET = os.environ.get("TOOL_SUBSET", "1") == "1"
+TOOL_SUBSET_SIZE = 12
+TOOL_EXPAND_SIZE = 6
+TOOL_SUBSET_MIN_TOOLS = 24  # APIs with fewer tools always get the full list
+TOOL_SUBSET_HISTORY_MESSAGES = 4  # recent history messages used to rank tools
+
+# Agent log batching (rows are written to Supabase by a background thread)
+LOG_BATCH_SIZE = 25
+LOG_FLUSH_INTERVAL = 0.25
+LOG_QUEUE_SIZE = 1000
+
+# Run tracing (see Tracer): a comma-separated list of exporters, "logfire"
+# and/or "file" (OTLP/JSON lines appended to TRACE_FILE for offline analysis)
+TRACE_EXPORTERS = os.environ.get("TRACE_EXPORTERS", "logfire")
+TRACE_FILE = os.environ.get("TRACE_FILE", "/tmp/agent-traces.jsonl")
+TRACE_SERVICE_NAME = "policyengine-chat-agent"
+
+# How often the agent checks threads.cancel_requested_at, which bounds how long
+# a cancel takes to interrupt sleeps, job polls, tool waits and streams
+CANCEL_POLL_INTERVAL = 1.0
+
+# Rolling compaction of old tool results in the conversation
+CONTEXT_COMPACT_THRESHOLD = 4_000  # estimated tokens of stale tool results before compacting (a dozen or so results)
+CONTEXT_KEEP_RECENT_TURNS = 2
+CHARS_PER_TOKEN = 4
+
+# Streaming text deltas are relayed as delta events in small batches
+STREAM_FLUSH_INTERVAL = 0.2
+STREAM_FLUSH_CHARS = 200
+
+# Maximum API tool calls run concurrently within one turn
+MAX_PARALLEL_TOOLS = 4
+
+# Shared HTTP client for the PolicyEngine API (one per container)
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "16"))
+HTTP_MAX_RETRIES = int(os.environ.get("HTTP_MAX_RETRIES", "3"))
+HTTP_RETRY_STATUSES = (502, 503, 504)
+
+# Server-side polling of async job endpoints (household calculations, economic impact)
+JOB_POLL_TIMEOUT = 300
+JOB_POLL_INITIAL_INTERVAL = 1.0
+JOB_POLL_MAX_INTERVAL = 10.0
+JOB_POLL_BACKOFF = 1.5
+JOB_TERMINAL_STATUSES = {"completed", "complete", "succeeded", "success", "failed", "error", "cancelled"}
+
+# Cache for GET tool responses, optionally shared across containers through a Modal Dict
+API_CACHE_TTL = int(os.environ.get("API_CACHE_TTL", "300"))
+API_CACHE_MAX_BYTES = int(os.environ.get("API_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+API_CACHE_MAX_ENTRY_BYTES = 2 * 1024 * 1024
+API_CACHE_SHARED = os.environ.get("API_CACHE_SHARED", "") == "1"
+# How long a container trusts its copy of a collection's write generation from the shared store
+API_CACHE_GENERATION_TTL = 5
+api_cache_dict = modal.Dict.from_name("policyengine-chat-api-cache", create_if_missing=True)
+
+# Haiku summaries of large API responses, keyed by content hash
+SUMMARY_MODEL = "claude-haiku-3-5-20241022"
+SUMMARY_THRESHOLD = 2000
+SUMMARY_CACHE_MAX_BYTES = int(os.environ.get("SUMMARY_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+SUMMARY_CACHE_DIR = os.environ.get("SUMMARY_CACHE_DIR", f"{CACHE_MOUNT}/summaries")
+SUMMARY_CACHE_PERSIST = os.environ.get("SUMMARY_CACHE_PERSIST", "1") == "1"
+
+# USD per million input/output tokens. Cache reads bill at 10% of the input
+# price and cache writes at 125%.
+MODEL_PRICES = {
+    "claude-opus-4-5": (5.0, 25.0),
+    "claude-sonnet-4-5": (3.0, 15.0),
+    "claude-haiku-3-5-20241022": (0.8, 4.0),
+}
+CACHE_READ_PRICE_FACTOR = 0.1
+CACHE_WRITE_PRICE_FACTOR = 1.25
+
+# Post-completion work (title, usage accounting) runs after the answer is saved
+TITLE_MODEL = "claude-sonnet-4-5"
+DEFAULT_THREAD_TITLE = "New chat"
+FINALIZE_RETRIES = 3
+
+# Admission control for every run (see admit_agent_run). Spawned runs beyond
+# AGENT_MAX_CONCURRENCY wait in Modal's queue, which holds at most
+# AGENT_MAX_QUEUED more; anything past that is rejected with a 429.
+AGENT_MAX_CONCURRENCY = int(AGENT_LIMITS_ENV["AGENT_MAX_CONCURRENCY"])
+AGENT_MAX_QUEUED = int(AGENT_LIMITS_ENV["AGENT_MAX_QUEUED"])
+AGENT_MAX_RUNS_PER_USER = int(AGENT_LIMITS_ENV["AGENT_MAX_RUNS_PER_USER"])
+AGENT_STALE_RUN_SECONDS = 1800  # queued/running rows older than this no longer hold a slot
+QUEUE_STATS_WINDOW_SECONDS = 900
+
+# Warm agent containers keep their clients and tool cache loaded between runs
+DEFAULT_API_BASE_URL = "https://v2.api.policyengine.org"
+AGENT_KEEP_WARM = int(os.environ.get("AGENT_KEEP_WARM", "1"))
+AGENT_IDLE_TIMEOUT = int(os.environ.get("AGENT_IDLE_TIMEOUT", "300"))
+# Runs without a request time count as cold if they start this soon after setup
+COLD_START_GRACE_SECONDS = 2
+CONTAINER_STARTED_AT = time.monotonic()  # module import, a proxy for container start
+
+# Built react/script artifacts, keyed by content hash plus dependency set
+ARTIFACT_CACHE_DIR = f"{CACHE_MOUNT}/artifacts"
+ARTIFACT_CACHE_MAX_BYTES = int(os.environ.get("ARTIFACT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+ARTIFACT_BUILD_VERSION = 1  # bump when the build templates below change
+ARTIFACT_CACHE_CONTROL = "public, max-age=3600, stale-while-revalidate=86400"
+ARTIFACT_BUILT_TYPES = ("react", "script")
+
+# ArtifactBuilder pool: node_modules are installed once per dependency set per
+# container, versions are pinned by a lockfile on the builder's volume, and
+# bun's package cache is shared through it. Artifact code never sees either:
+# each build runs as ARTIFACT_RUN_USER in a throwaway copy of the dependencies
+ARTIFACT_DEPS_DIR = os.environ.get("ARTIFACT_DEPS_DIR", "/tmp/artifact-deps")
+ARTIFACT_BUILDS_DIR = os.environ.get("ARTIFACT_BUILDS_DIR", "/tmp/artifact-builds")
+ARTIFACT_LOCK_DIR = f"{ARTIFACT_BUILD_MOUNT}/locks"
+ARTIFACT_BUN_CACHE_DIR = f"{ARTIFACT_BUILD_MOUNT}/bun-cache"
+ARTIFACT_RUN_USER = "nobody"
+BUN_LOCKFILES = ("bun.lock", "bun.lockb")
+ARTIFACT_MAX_CONCURRENT_BUILDS = int(os.environ.get("ARTIFACT_MAX_CONCURRENT_BUILDS", "4"))
+ARTIFACT_BUILDER_KEEP_WARM = int(os.environ.get("ARTIFACT_BUILDER_KEEP_WARM", "0"))
+ARTIFACT_SCRIPT_TIMEOUT = 30
+
+# Per-model token counters recorded on threads and agent_runs
+USAGE_FIELDS = ("input_tokens", "output_tokens", "cache_read_tokens", "cache_creation_tokens")
+
+# Local compaction of API responses before they reach Claude (or Haiku)
+MAX_RESULT_ITEMS = 50
+MIN_COLUMNAR_ROWS = 3
+RESPONSE_SHAPE_MAX_DEPTH = 6
+
 
 SYSTEM_PROMPT = """You are a PolicyEngine assistant that helps users understand tax and benefit policies.
 
@@ -47,7 +217,7 @@ Parameters and datasets from both countries are in the same database. Without th
 
 1. **Household calculations** (supports batch processing):
    - POST /household/calculate with tax_benefit_model_name, people, entities, and year
-   - Poll GET /household/calculate/{job_id} until completed
+   - The tool waits for the job and returns the completed result - no need to poll
    - **BATCH PROCESSING**: You can calculate MANY households in one API call:
      - Use numeric IDs to link people to entities
      - Each person needs `person_id` and `person_{entity}_id` fields (e.g., `person_household_id`, `person_tax_unit_id`)
@@ -101,7 +271,7 @@ Parameters and datasets from both countries are in the same database. Without th
    - **VALIDATE with household calculation first** (see step 4)
    - GET /datasets/?tax_benefit_model_name=policyengine-uk to find dataset_id
    - POST /analysis/economic-impact with tax_benefit_model_name, policy_id and dataset_id
-   - GET /analysis/economic-impact/{report_id} for results (includes decile_impacts and program_statistics)
+   - The tool waits for the analysis and returns the results (includes decile_impacts and program_statistics)
 
 ## PolicyEngine writing style
 
@@ -183,10 +353,27 @@ If you don't have an ID, you MUST call the relevant list/search endpoint first.
 1. Use the API tools to get accurate, current data - NEVER guess or make up values
 2. Be concise - lead with key numbers
 3. For UK, amounts are in GBP (£). For US, amounts are in USD ($)
-4. When polling async endpoints, use the sleep tool to wait 5-10 seconds between requests
+4. Job endpoints wait for completion server-side. Only if a job result comes back still running, call its status endpoint again (it also waits)
 5. ALWAYS maintain policy neutrality - describe impacts, never evaluate them
+6. API results are compacted: null/empty fields are omitted and lists of records may come as {"columns": [...], "rows": [[...]]} tables
+"""
+
+# Appended only while expand_tools is offered (see system_prompt)
+SYSTEM_PROMPT_EXPAND_GUIDELINE = """7. Only some API tools are loaded. If you need an endpoint you don't have, call expand_tools with a short description of it
 """
 
+
+def system_prompt(expandable: bool) -> str:
+    """System prompt for a request, mentioning expand_tools only when it is in the tool list."""
+    return SYSTEM_PROMPT + SYSTEM_PROMPT_EXPAND_GUIDELINE if expandable else SYSTEM_PROMPT
+
+
+# System prompt endpoints, whose tools are always offered
+SYSTEM_PROMPT_ENDPOINTS = {
+    (method.lower(), path.rstrip("/"))
+    for method, path in re.findall(r"\b(GET|POST|PUT|PATCH|DELETE) (/[\w/{}-]*)", SYSTEM_PROMPT)
+}
+
 SLEEP_TOOL = {
     "name": "sleep",
     "description": "Wait for a specified number of seconds. Use this between polling requests to avoid hammering the API.",
@@ -202,6 +389,25 @@ SLEEP_TOOL = {
     },
 }
 
+EXPAND_TOOLS_TOOL = {
+    "name": "expand_tools",
+    "description": "Load more PolicyEngine API tools. Only the API tools most relevant to the question are loaded at first. Describe the operation you need (e.g. 'list datasets', 'economic impact of a reform') and the best matching tools become available from your next turn. Set all to true to load every API tool.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "query": {
+                "type": "string",
+                "description": "What the API operation should do",
+            },
+            "all": {
+                "type": "boolean",
+                "description": "Load every API tool",
+            },
+        },
+        "required": ["query"],
+    },
+}
+
 CREATE_ARTIFACT_TOOL = {
     "name": "create_artifact",
     "description": """Create a single, polished interactive artifact.
@@ -292,11 +498,288 @@ Each artifact should feel intentionally designed for its specific context.""",
 }
 
 
-def fetch_openapi_spec(api_base_url: str) -> dict:
-    """Fetch and cache OpenAPI spec."""
-    resp = requests.get(f"{api_base_url}/openapi.json", timeout=30)
+class LRUCache:
+    """Thread-safe LRU cache bounded by total size in bytes."""
+
+    def __init__(self, max_bytes: int, max_entries: int | None = None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self._sizes: dict = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def set(self, key, value, size: int) -> None:
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = value
+            self._sizes[key] = size
+            self._bytes += size
+            while self._bytes > self.max_bytes or (
+                self.max_entries is not None and len(self._entries) > self.max_entries
+            ):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+
+    def pop(self, key) -> None:
+        with self._lock:
+            self._remove(key)
+
+    def remove_where(self, predicate: Callable) -> int:
+        """Remove every entry whose value matches predicate, returning how many."""
+        with self._lock:
+            keys = [k for k, v in self._entries.items() if predicate(v)]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def _remove(self, key) -> None:
+        if key in self._entries:
+            del self._entries[key]
+            self._bytes -= self._sizes.pop(key)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class ResponseCache:
+    """TTL + LRU cache of GET responses keyed on URL and sorted query params.
+
+    Honours Cache-Control (no-store, no-cache, max-age) and revalidates stale
+    entries that have an ETag with a conditional request. With a shared store
+    (a Modal Dict) entries are also visible to other containers.
+
+    Keys include the write generation of the URL's collection. A write starts
+    a new generation, which orphans everything cached for that collection:
+    immediately in this container, and in others once their copy of the
+    generation (kept API_CACHE_GENERATION_TTL seconds) expires.
+    """
+
+    def __init__(self, max_bytes: int, default_ttl: int, shared=None):
+        self.default_ttl = default_ttl
+        self.shared = shared
+        self._memory = LRUCache(max_bytes)
+        self._generations: dict[str, tuple[str, float]] = {}
+        self._generations_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.stats = {"hits": 0, "shared_hits": 0, "misses": 0, "revalidated": 0, "stores": 0}
+
+    @staticmethod
+    def key(url: str, params: dict, generation: str = "") -> str:
+        canonical = json.dumps(["GET", url, sorted((k, str(v)) for k, v in params.items()), generation])
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def generation(self, url_prefix: str) -> str:
+        """Current write generation of the collection under a URL prefix ("" before any write)."""
+        now = time.time()
+        with self._generations_lock:
+            known = self._generations.get(url_prefix)
+        if known and (self.shared is None or known[1] > now):
+            return known[0]
+        generation = known[0] if known else ""
+        if self.shared is not None:
+            try:
+                generation = self.shared.get(f"generation:{url_prefix}", generation)
+            except Exception as e:
+                print(f"Shared API cache read failed: {e}")
+        with self._generations_lock:
+            self._generations[url_prefix] = (generation, now + API_CACHE_GENERATION_TTL)
+        return generation
+
+    def count(self, stat: str) -> None:
+        with self._stats_lock:
+            self.stats[stat] += 1
+
+    def snapshot(self) -> dict:
+        with self._stats_lock:
+            return dict(self.stats)
+
+    def lookup(self, key: str) -> dict | None:
+        """Cached entry (fresh or stale) from memory, then the shared store."""
+        entry = self._memory.get(key)
+        if entry is None and self.shared is not None:
+            try:
+                entry = self.shared.get(key)
+            except Exception as e:
+                print(f"Shared API cache read failed: {e}")
+            if entry is not None:
+                self.count("shared_hits")
+                self._memory.set(key, entry, len(entry["text"]))
+        return entry
+
+    def store(self, key: str, url: str, resp: requests.Response) -> None:
+        cache_control = resp.headers.get("Cache-Control", "").lower()
+        if resp.status_code != 200 or "no-store" in cache_control or "private" in cache_control:
+            return
+        ttl = self.default_ttl
+        max_age = re.search(r"max-age=(\d+)", cache_control)
+        if max_age:
+            ttl = min(ttl, int(max_age.group(1)))
+        if "no-cache" in cache_control:
+            ttl = 0
+        etag = resp.headers.get("ETag")
+        if ttl <= 0 and not etag:
+            return
+        text = resp.text
+        if len(text) > API_CACHE_MAX_ENTRY_BYTES:
+            return
+        entry = {"url": url, "text": text, "etag": etag, "expires": time.time() + ttl}
+        self._put(key, entry)
+        self.count("stores")
+
+    def refresh(self, key: str, entry: dict, resp: requests.Response) -> dict:
+        """Extend a stale entry after a 304 Not Modified."""
+        max_age = re.search(r"max-age=(\d+)", resp.headers.get("Cache-Control", "").lower())
+        ttl = min(self.default_ttl, int(max_age.group(1))) if max_age else self.default_ttl
+        entry = {**entry, "expires": time.time() + ttl}
+        self._put(key, entry)
+        self.count("revalidated")
+        return entry
+
+    def invalidate_prefix(self, url_prefix: str) -> int:
+        """Start a new generation for a collection after a write to it, here and in the shared store.
+
+        Returns the number of in-memory entries dropped (shared entries are
+        orphaned rather than deleted, and age out of the Dict).
+        """
+        generation = os.urandom(8).hex()
+        with self._generations_lock:
+            self._generations[url_prefix] = (generation, time.time() + API_CACHE_GENERATION_TTL)
+        if self.shared is not None:
+            try:
+                self.shared.put(f"generation:{url_prefix}", generation)
+            except Exception as e:
+                print(f"Shared API cache write failed: {e}")
+        return self._memory.remove_where(lambda entry: entry["url"].startswith(url_prefix))
+
+    def _put(self, key: str, entry: dict) -> None:
+        self._memory.set(key, entry, len(entry["text"]))
+        if self.shared is not None:
+            try:
+                self.shared.put(key, entry)
+            except Exception as e:
+                print(f"Shared API cache write failed: {e}")
+
+
+_response_cache = ResponseCache(
+    API_CACHE_MAX_BYTES,
+    API_CACHE_TTL,
+    shared=api_cache_dict if API_CACHE_SHARED else None,
+)
+
+
+# Connect time (TCP + TLS) spent by the current thread's request, set by the timed connections
+_http_timing = threading.local()
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        _http_timing.connect = (getattr(_http_timing, "connect", None) or 0.0) + time.perf_counter() - start
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        _http_timing.connect = (getattr(_http_timing, "connect", None) or 0.0) + time.perf_counter() - start
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose pooled connections record how long they took to connect."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TimedHTTPConnectionPool,
+            "https": _TimedHTTPSConnectionPool,
+        }
+
+
+_http_session: requests.Session | None = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    """Container-lifetime session with keep-alive connection pooling and retries.
+
+    Idempotent methods are retried on connection errors and 502/503/504 with
+    jittered exponential backoff. POST/PATCH are only retried if the
+    connection failed before the request was sent.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            retry = Retry(
+                total=HTTP_MAX_RETRIES,
+                status_forcelist=HTTP_RETRY_STATUSES,
+                allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+                backoff_factor=0.5,
+                backoff_jitter=0.5,
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            )
+            adapter = TimedHTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=HTTP_POOL_SIZE,
+                max_retries=retry,
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _http_session = session
+        return _http_session
+
+
+def http_request(method: str, url: str, log_fn: Callable = print, **kwargs) -> requests.Response:
+    """Make a request on the shared session and log connect/TTFB/total timings.
+
+    Requests served on a pooled keep-alive connection are marked "(reused)".
+    """
+    _http_timing.connect = None
+    start = time.perf_counter()
+    resp = get_http_session().request(method.upper(), url, stream=True, **kwargs)
+    ttfb = time.perf_counter() - start
+    resp.content  # Read the body so the connection goes back to the pool
+    total = time.perf_counter() - start
+    connect = _http_timing.connect
+    log_fn(
+        f"[HTTP] {method.upper()} {url.split('?')[0]} {resp.status_code} "
+        f"connect={(connect or 0) * 1000:.0f}ms ttfb={ttfb * 1000:.0f}ms total={total * 1000:.0f}ms"
+        + (" (reused)" if connect is None else "")
+    )
+    return resp
+
+
+def fetch_openapi_spec(api_base_url: str, etag: str | None = None) -> tuple[dict | None, str | None]:
+    """Fetch the OpenAPI spec, returning (spec, etag).
+
+    If etag is given the request is conditional and spec is None when unchanged.
+    """
+    headers = {"If-None-Match": etag} if etag else {}
+    resp = http_request("get", f"{api_base_url}/openapi.json", headers=headers, timeout=30)
+    if resp.status_code == 304:
+        return None, etag
     resp.raise_for_status()
-    return resp.json()
+    return resp.json(), resp.headers.get("ETag")
 
 
 def resolve_ref(spec: dict, ref: str) -> dict:
@@ -310,59 +793,288 @@ def resolve_ref(spec: dict, ref: str) -> dict:
     return result
 
 
-def schema_to_json_schema(spec: dict, schema: dict) -> dict:
-    """Convert OpenAPI schema to JSON Schema for Claude tools."""
-    if "$ref" in schema:
-        schema = resolve_ref(spec, schema["$ref"])
+def schema_refs(obj) -> set[str]:
+    """$ref pointers used directly anywhere inside obj."""
+    refs = set()
+    if isinstance(obj, dict):
+        if isinstance(obj.get("$ref"), str):
+            refs.add(obj["$ref"])
+        for value in obj.values():
+            refs |= schema_refs(value)
+    elif isinstance(obj, list):
+        for value in obj:
+            refs |= schema_refs(value)
+    return refs
 
-    result = {}
-
-    if "type" in schema:
-        result["type"] = schema["type"]
-    if "description" in schema:
-        result["description"] = schema["description"]
-    if "enum" in schema:
-        result["enum"] = schema["enum"]
-    if "default" in schema:
-        result["default"] = schema["default"]
-    if "format" in schema:
-        fmt = schema["format"]
-        if "description" in result:
-            result["description"] += f" (format: {fmt})"
-        else:
-            result["description"] = f"Format: {fmt}"
 
+def strip_nested_descriptions(schema: dict) -> dict:
+    """Copy of schema without the description keyword on schemas below its top level.
+
+    Only schema nodes are walked, so a property that is itself named
+    "description" keeps its place in properties (and required).
+    """
+    def strip(node: dict, top: bool = False) -> dict:
+        if not isinstance(node, dict):
+            return node
+        result = {k: v for k, v in node.items() if top or k != "description"}
+        if isinstance(node.get("properties"), dict):
+            result["properties"] = {name: strip(prop) for name, prop in node["properties"].items()}
+        if isinstance(node.get("items"), dict):
+            result["items"] = strip(node["items"])
+        if isinstance(node.get("additionalProperties"), dict):
+            result["additionalProperties"] = strip(node["additionalProperties"])
+        for key in ("anyOf", "oneOf", "allOf"):
+            if isinstance(node.get(key), list):
+                result[key] = [strip(sub) for sub in node[key]]
+        return result
+
+    return strip(schema, top=True)
+
+
+def collapse_schema(schema: dict, max_depth: int, depth: int = 0) -> dict:
+    """Copy of schema with objects nested deeper than max_depth reduced to a field list."""
+    if schema.get("type") == "array" and "items" in schema:
+        return {**schema, "items": collapse_schema(schema["items"], max_depth, depth)}
+    if "properties" not in schema:
+        return schema
+    if depth >= max_depth:
+        collapsed = {k: v for k, v in schema.items() if k not in ("properties", "required")}
+        fields = f"Fields: {', '.join(schema['properties'])}"
+        collapsed["description"] = f"{schema['description']} ({fields})" if schema.get("description") else fields
+        return collapsed
+    return {
+        **schema,
+        "properties": {
+            name: collapse_schema(prop, max_depth, depth + 1)
+            for name, prop in schema["properties"].items()
+        },
+    }
+
+
+class SchemaConverter:
+    """Converts OpenAPI schemas to JSON Schema for Claude tools.
+
+    Each $ref is resolved and converted once per spec (memoized), a $ref met
+    again while it is still being converted becomes a stub instead of
+    recursing, and large definitions shared by several operations are kept
+    compact. A result holding a stub for an enclosing $ref is only right in
+    that context, so it is not memoized. Converted schemas are shared between tools, so callers must copy
+    before mutating anything below the top level (convert() returns a fresh
+    top-level dict).
+    """
+
+    def __init__(self, spec: dict):
+        self.spec = spec
+        self.memo: dict[str, dict] = {}
+        self.resolving: set[str] = set()
+        self.cycles: set[str] = set()
+        self.compacted: set[str] = set()
+        self.stubs: list[str] = []  # refs stubbed, in order
+        self.shared = self._shared_refs()
+
+    def _shared_refs(self) -> set[str]:
+        """Refs reachable from more than one operation."""
+        closure: dict[str, set[str]] = {}
+
+        def reachable(ref: str) -> set[str]:
+            if ref not in closure:
+                closure[ref] = {ref}
+                for inner in schema_refs(resolve_ref(self.spec, ref)):
+                    closure[ref] |= reachable(inner)
+            return closure[ref]
+
+        counts = Counter()
+        for methods in self.spec.get("paths", {}).values():
+            for method, operation in methods.items():
+                if method not in ("get", "post", "put", "patch", "delete"):
+                    continue
+                refs = set()
+                for ref in schema_refs([operation.get("parameters", []), operation.get("requestBody", {})]):
+                    refs |= reachable(ref)
+                counts.update(refs)
+        return {ref for ref, count in counts.items() if count > 1}
+
+    def convert(self, schema: dict) -> dict:
+        """Convert an OpenAPI schema (or $ref) to JSON Schema."""
+        ref = schema.get("$ref")
+        if ref is None:
+            return self._convert(schema)
+        if ref in self.memo:
+            return dict(self.memo[ref])
+        name = ref.rsplit("/", 1)[-1]
+        if ref in self.resolving:
+            self.cycles.add(ref)
+            self.stubs.append(ref)
+            return {"type": "object", "description": f"{name} (recursive)"}
+        first_stub = len(self.stubs)
+        self.resolving.add(ref)
+        try:
+            result = self._convert(resolve_ref(self.spec, ref))
+        finally:
+            self.resolving.discard(ref)
+        if ref in self.shared and len(json.dumps(result)) > SCHEMA_SHARED_COMPACT_CHARS:
+            result = strip_nested_descriptions(result)
+            self.compacted.add(name)
+        # Stubs for ref itself are fine; stubs for refs still being resolved above it are not
+        if not any(stub in self.resolving for stub in self.stubs[first_stub:]):
+            self.memo[ref] = result
+        return dict(result)
+
+    def _convert(self, schema: dict) -> dict:
+        result = {}
+
+        if "type" in schema:
+            result["type"] = schema["type"]
+        if "description" in schema:
+            result["description"] = schema["description"]
+        if "enum" in schema:
+            result["enum"] = schema["enum"]
+        if "default" in schema:
+            result["default"] = schema["default"]
+        if "format" in schema:
+            fmt = schema["format"]
+            if "description" in result:
+                result["description"] += f" (format: {fmt})"
+            else:
+                result["description"] = f"Format: {fmt}"
+
+        if "anyOf" in schema:
+            non_null = [s for s in schema["anyOf"] if s.get("type") != "null"]
+            if non_null:
+                result.update(self.convert(non_null[0]))
+
+        if "allOf" in schema:
+            for sub in schema["allOf"]:
+                result.update(self.convert(sub))
+
+        if schema.get("type") == "object" or "properties" in schema:
+            result["type"] = "object"
+            if "properties" in schema:
+                result["properties"] = {
+                    prop_name: self.convert(prop_schema)
+                    for prop_name, prop_schema in schema["properties"].items()
+                }
+            if "required" in schema:
+                result["required"] = schema["required"]
+
+        if schema.get("type") == "array" and "items" in schema:
+            result["items"] = self.convert(schema["items"])
+
+        return result
+
+    def fit_budget(self, input_schema: dict, max_chars: int = SCHEMA_TOOL_MAX_CHARS) -> tuple[dict, int | None]:
+        """Collapse the deepest objects of a tool schema until it fits max_chars.
+
+        Returns the schema and the depth it was collapsed to (None if it fit
+        as-is). At depth 1 the schema may still be over budget; callers check.
+        """
+        if len(json.dumps(input_schema)) <= max_chars:
+            return input_schema, None
+        for max_depth in (3, 2, 1):
+            input_schema = collapse_schema(input_schema, max_depth)
+            if len(json.dumps(input_schema)) <= max_chars:
+                break
+        return input_schema, max_depth
+
+
+def response_schema(spec: dict, operation: dict) -> dict:
+    """Resolved JSON schema of an operation's successful response, or {}."""
+    responses = operation.get("responses", {})
+    for code in ("200", "201", "202"):
+        content = responses.get(code, {}).get("content", {})
+        schema = content.get("application/json", {}).get("schema")
+        if schema:
+            if "$ref" in schema:
+                schema = resolve_ref(spec, schema["$ref"])
+            if "anyOf" in schema:
+                non_null = [s for s in schema["anyOf"] if s.get("type") != "null"]
+                if non_null:
+                    schema = non_null[0]
+                    if "$ref" in schema:
+                        schema = resolve_ref(spec, schema["$ref"])
+            return schema
+    return {}
+
+
+def response_shape(spec: dict, schema: dict, depth: int = 0, seen: frozenset = frozenset()) -> dict | None:
+    """Field tree of a response schema, used to project responses to documented fields.
+
+    Objects become {"fields": {name: shape}}, arrays {"items": shape}. None
+    means keep the value as-is (scalars, free-form objects, recursion, depth limit).
+    """
+    if depth > RESPONSE_SHAPE_MAX_DEPTH or not schema:
+        return None
+    if "$ref" in schema:
+        if schema["$ref"] in seen:
+            return None
+        seen = seen | {schema["$ref"]}
+        schema = resolve_ref(spec, schema["$ref"])
     if "anyOf" in schema:
         non_null = [s for s in schema["anyOf"] if s.get("type") != "null"]
-        if len(non_null) == 1:
-            result.update(schema_to_json_schema(spec, non_null[0]))
-        elif non_null:
-            result.update(schema_to_json_schema(spec, non_null[0]))
-
+        return response_shape(spec, non_null[0], depth, seen) if len(non_null) == 1 else None
     if "allOf" in schema:
+        fields = {}
         for sub in schema["allOf"]:
-            result.update(schema_to_json_schema(spec, sub))
-
-    if schema.get("type") == "object" or "properties" in schema:
-        result["type"] = "object"
-        if "properties" in schema:
-            result["properties"] = {}
-            for prop_name, prop_schema in schema["properties"].items():
-                result["properties"][prop_name] = schema_to_json_schema(
-                    spec, prop_schema
-                )
-        if "required" in schema:
-            result["required"] = schema["required"]
-
+            shape = response_shape(spec, sub, depth, seen)
+            if shape is None or "fields" not in shape:
+                return None
+            fields.update(shape["fields"])
+        return {"fields": fields}
     if schema.get("type") == "array" and "items" in schema:
-        result["items"] = schema_to_json_schema(spec, schema["items"])
-
-    return result
+        items = response_shape(spec, schema["items"], depth + 1, seen)
+        return {"items": items} if items else None
+    if "properties" in schema and not schema.get("additionalProperties"):
+        return {
+            "fields": {
+                name: response_shape(spec, prop, depth + 1, seen)
+                for name, prop in schema["properties"].items()
+            }
+        }
+    return None
+
+
+def merge_shapes(a: dict | None, b: dict | None) -> dict | None:
+    """Union of two response shapes (None, keep everything, wins)."""
+    if a is None or b is None:
+        return None
+    if "fields" in a and "fields" in b:
+        fields = dict(a["fields"])
+        for name, shape in b["fields"].items():
+            fields[name] = merge_shapes(fields[name], shape) if name in fields else shape
+        return {"fields": fields}
+    if "items" in a and "items" in b:
+        items = merge_shapes(a["items"], b["items"])
+        return {"items": items} if items else None
+    return None
+
+
+def find_job_endpoints(spec: dict) -> dict[str, tuple[str, str]]:
+    """Map job-creating POST paths to their (status path, id parameter).
+
+    A POST is a job endpoint when its response has a status field and the
+    spec has a GET at the same path plus one path parameter, e.g.
+    POST /household/calculate -> GET /household/calculate/{job_id}.
+    """
+    paths = spec.get("paths", {})
+    jobs = {}
+    for path, methods in paths.items():
+        post = methods.get("post")
+        if not post or "status" not in response_schema(spec, post).get("properties", {}):
+            continue
+        for candidate, candidate_methods in paths.items():
+            match = re.fullmatch(re.escape(path.rstrip("/")) + r"/\{(\w+)\}/?", candidate)
+            if match and "get" in candidate_methods:
+                jobs[path] = (candidate, match.group(1))
+                break
+    return jobs
 
 
 def openapi_to_claude_tools(spec: dict) -> list[dict]:
     """Convert OpenAPI spec to Claude tool definitions (full version with all details)."""
     tools = []
+    converter = SchemaConverter(spec)
+    job_endpoints = find_job_endpoints(spec)
+    job_status_paths = {status_path for status_path, _ in job_endpoints.values()}
 
     for path, methods in spec.get("paths", {}).items():
         for method, operation in methods.items():
@@ -376,6 +1088,10 @@ def openapi_to_claude_tools(spec: dict) -> list[dict]:
             summary = operation.get("summary", "")
             description = operation.get("description", "")
             full_desc = f"{method.upper()} {path}"
+            if method == "post" and path in job_endpoints:
+                full_desc += "\n\nStarts a job and waits for it to finish - returns the completed result."
+            elif method == "get" and path in job_status_paths:
+                full_desc += "\n\nWaits for the job to finish before returning."
             if summary:
                 full_desc += f"\n\n{summary}"
             if description:
@@ -390,7 +1106,7 @@ def openapi_to_claude_tools(spec: dict) -> list[dict]:
                 param_schema = param.get("schema", {})
                 param_required = param.get("required", False)
 
-                prop = schema_to_json_schema(spec, param_schema)
+                prop = converter.convert(param_schema)
                 prop["description"] = (
                     param.get("description", "")
                     + f" (in: {param_in})"
@@ -407,7 +1123,7 @@ def openapi_to_claude_tools(spec: dict) -> list[dict]:
                 body_schema = json_content.get("schema", {})
 
                 if body_schema:
-                    resolved = schema_to_json_schema(spec, body_schema)
+                    resolved = converter.convert(body_schema)
                     if "properties" in resolved:
                         for prop_name, prop_schema in resolved["properties"].items():
                             properties[prop_name] = prop_schema
@@ -421,26 +1137,722 @@ def openapi_to_claude_tools(spec: dict) -> list[dict]:
             input_schema = {"type": "object", "properties": properties}
             if required:
                 input_schema["required"] = list(set(required))
+            input_schema, collapsed_depth = converter.fit_budget(input_schema)
+
+            meta = {
+                "path": path,
+                "method": method,
+                "parameters": operation.get("parameters", []),
+                "tags": operation.get("tags", []),
+                "response_shape": response_shape(spec, response_schema(spec, operation)),
+            }
+            if method == "post" and path in job_endpoints:
+                meta["job_status_path"], meta["job_id_param"] = job_endpoints[path]
+                # The result may come from the status endpoint once the job is awaited
+                status_operation = spec["paths"][meta["job_status_path"]]["get"]
+                meta["response_shape"] = merge_shapes(
+                    meta["response_shape"],
+                    response_shape(spec, response_schema(spec, status_operation)),
+                )
+            elif method == "get" and path in job_status_paths:
+                meta["job_poll"] = True
+            if collapsed_depth is not None:
+                meta["schema_collapsed_depth"] = collapsed_depth
+                schema_chars = len(json.dumps(input_schema))
+                if schema_chars > SCHEMA_TOOL_MAX_CHARS:
+                    meta["schema_over_budget"] = True
+                    print(
+                        f"[TOOLS] {tool_name} input schema is still {schema_chars} chars after collapsing"
+                        f" to depth {collapsed_depth} (budget {SCHEMA_TOOL_MAX_CHARS})"
+                    )
 
             tools.append({
                 "name": tool_name,
                 "description": full_desc[:1024],
                 "input_schema": input_schema,
-                "_meta": {
-                    "path": path,
-                    "method": method,
-                    "parameters": operation.get("parameters", []),
-                },
+                "_meta": meta,
             })
 
+    if converter.cycles or converter.compacted:
+        print(
+            f"[TOOLS] Converted {len(converter.memo)} schema definitions"
+            f" (recursive: {', '.join(sorted(r.rsplit('/', 1)[-1] for r in converter.cycles)) or 'none'};"
+            f" compacted: {', '.join(sorted(converter.compacted)) or 'none'})"
+        )
     return tools
 
 
+def build_claude_tools(full_tools: list[dict], expandable: bool = False) -> list[dict]:
+    """Strip internal metadata and add the built-in tools, with cache_control on the last tool."""
+    builtin_tools = [SLEEP_TOOL, EXPAND_TOOLS_TOOL, CREATE_ARTIFACT_TOOL] if expandable else [SLEEP_TOOL, CREATE_ARTIFACT_TOOL]
+    claude_tools = [
+        {k: v for k, v in t.items() if k != "_meta"}
+        for t in full_tools
+    ] + builtin_tools
+    # Only the last item needs cache_control to cache the whole prefix
+    return claude_tools[:-1] + [{**claude_tools[-1], "cache_control": {"type": "ephemeral"}}]
+
+
+def spec_hash(spec: dict) -> str:
+    """Stable content hash of an OpenAPI spec."""
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+
+# Converted tools per API base URL, shared by every run in this container
+_tool_cache: dict[str, dict] = {}
+_tool_cache_lock = threading.Lock()
+_tool_cache_revalidating: set[str] = set()
+_tool_cache_stats = {"hits": 0, "disk_hits": 0, "misses": 0, "refreshes": 0, "unchanged": 0, "errors": 0}
+
+
+def _tool_cache_path(api_base_url: str) -> str:
+    key = hashlib.sha256(api_base_url.encode()).hexdigest()[:16]
+    return os.path.join(TOOL_CACHE_DIR, f"{key}.json")
+
+
+def tool_footprint(full_tools: list[dict], cached_tools: list[dict]) -> dict:
+    """Estimated token footprint of the tool definitions sent to Claude."""
+    sizes = {t["name"]: len(json.dumps(t)) // CHARS_PER_TOKEN for t in cached_tools}
+    largest = max(sizes, key=sizes.get) if sizes else None
+    return {
+        "tokens": len(json.dumps(cached_tools)) // CHARS_PER_TOKEN,
+        "largest": largest,
+        "largest_tokens": sizes.get(largest, 0),
+        "collapsed": sum(1 for t in full_tools if "schema_collapsed_depth" in t["_meta"]),
+        "over_budget": [t["name"] for t in full_tools if t["_meta"].get("schema_over_budget")],
+    }
+
+
+def _make_tool_entry(api_base_url: str, full_tools: list[dict], etag: str | None, content_hash: str) -> dict:
+    cached_tools = build_claude_tools(full_tools)
+    return {
+        "api_base_url": api_base_url,
+        "etag": etag,
+        "spec_hash": content_hash,
+        "fetched_at": time.time(),
+        "full_tools": full_tools,
+        "tool_lookup": {t["name"]: t for t in full_tools},
+        "cached_tools": cached_tools,
+        "footprint": tool_footprint(full_tools, cached_tools),
+        "index": ToolIndex(full_tools),
+    }
+
+
+def _read_tool_cache_file(api_base_url: str) -> dict | None:
+    try:
+        with open(_tool_cache_path(api_base_url)) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get("api_base_url") != api_base_url or data.get("version") != TOOL_CACHE_VERSION:
+        return None
+    entry = _make_tool_entry(api_base_url, data["full_tools"], data.get("etag"), data["spec_hash"])
+    entry["fetched_at"] = data.get("fetched_at", 0)
+    return entry
+
+
+def _write_tool_cache_file(entry: dict) -> None:
+    path = _tool_cache_path(entry["api_base_url"])
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "version": TOOL_CACHE_VERSION,
+                "api_base_url": entry["api_base_url"],
+                "etag": entry["etag"],
+                "spec_hash": entry["spec_hash"],
+                "fetched_at": entry["fetched_at"],
+                "full_tools": entry["full_tools"],
+            }, f)
+        os.replace(tmp_path, path)
+        if not modal.is_local():
+            cache_volume.commit()
+    except Exception as e:
+        # The memory cache still works without the volume
+        print(f"Failed to persist tool cache: {e}")
+
+
+def _revalidate_tools(api_base_url: str) -> None:
+    """Conditionally re-fetch the spec and swap in new tools if it changed."""
+    with _tool_cache_lock:
+        current = _tool_cache.get(api_base_url)
+    try:
+        spec, etag = fetch_openapi_spec(api_base_url, current["etag"] if current else None)
+        if spec is None or (current and spec_hash(spec) == current["spec_hash"]):
+            stat = "unchanged"
+            entry = {**current, "etag": etag, "fetched_at": time.time()}
+        else:
+            stat = "refreshes"
+            entry = _make_tool_entry(api_base_url, openapi_to_claude_tools(spec), etag, spec_hash(spec))
+        with _tool_cache_lock:
+            _tool_cache[api_base_url] = entry
+            _tool_cache_stats[stat] += 1
+        _write_tool_cache_file(entry)
+    except Exception as e:
+        with _tool_cache_lock:
+            _tool_cache_stats["errors"] += 1
+        print(f"Failed to revalidate OpenAPI spec: {e}")
+    finally:
+        with _tool_cache_lock:
+            _tool_cache_revalidating.discard(api_base_url)
+
+
+def _revalidate_in_background(api_base_url: str) -> None:
+    with _tool_cache_lock:
+        if api_base_url in _tool_cache_revalidating:
+            return
+        _tool_cache_revalidating.add(api_base_url)
+    threading.Thread(target=_revalidate_tools, args=(api_base_url,), daemon=True).start()
+
+
+def load_tools(api_base_url: str, log_fn: Callable) -> dict:
+    """Get converted tools for an API, from memory, disk, or a fresh spec fetch.
+
+    Cached entries are served immediately and revalidated in the background once
+    older than TOOL_CACHE_REVALIDATE_SECONDS. Returns the cache entry with
+    full_tools, tool_lookup, cached_tools, their token footprint and the
+    relevance index.
+    """
+    with _tool_cache_lock:
+        entry = _tool_cache.get(api_base_url)
+        source = "hit" if entry else None
+        if entry:
+            _tool_cache_stats["hits"] += 1
+
+    if entry is None:
+        entry = _read_tool_cache_file(api_base_url)
+        if entry:
+            source = "disk"
+            with _tool_cache_lock:
+                _tool_cache[api_base_url] = entry
+                _tool_cache_stats["disk_hits"] += 1
+
+    if entry is None:
+        source = "miss"
+        log_fn("[AGENT] Fetching OpenAPI spec...")
+        spec, etag = fetch_openapi_spec(api_base_url)
+        entry = _make_tool_entry(api_base_url, openapi_to_claude_tools(spec), etag, spec_hash(spec))
+        with _tool_cache_lock:
+            _tool_cache[api_base_url] = entry
+            _tool_cache_stats["misses"] += 1
+        _write_tool_cache_file(entry)
+    elif time.time() - entry["fetched_at"] > TOOL_CACHE_REVALIDATE_SECONDS:
+        _revalidate_in_background(api_base_url)
+
+    with _tool_cache_lock:
+        stats = " ".join(f"{k}={v}" for k, v in _tool_cache_stats.items())
+    age = int(time.time() - entry["fetched_at"])
+    log_fn(f"[CACHE] OpenAPI tools: {source} (spec {entry['spec_hash'][:8]}, age {age}s) {stats}")
+    footprint = entry["footprint"]
+    log_fn(
+        f"[TOOLS] Definitions ~{footprint['tokens']} tokens for {len(entry['full_tools'])} API tools plus built-ins,"
+        f" largest {footprint['largest']} ~{footprint['largest_tokens']},"
+        f" {footprint['collapsed']} collapsed to fit {SCHEMA_TOOL_MAX_CHARS} chars"
+        + (f", still over: {', '.join(footprint['over_budget'])}" if footprint["over_budget"] else "")
+    )
+    return entry
+
+
+# Words too common in questions and tool descriptions to say anything about relevance
+TOOL_INDEX_STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from get give how i if in into is it me my of on or "
+    "show tell than that the their them then this to use using what when which who will with would "
+    "you your".split()
+)
+
+
+def index_terms(text: str) -> list[str]:
+    """Lowercase word terms for the tool index, split on camelCase and with plural 's' dropped."""
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", text).lower()
+    return [
+        word[:-1] if len(word) > 3 and word.endswith("s") and not word.endswith("ss") else word
+        for word in re.findall(r"[a-z0-9]+", text)
+        if word not in TOOL_INDEX_STOPWORDS
+    ]
+
+
+class ToolIndex:
+    """BM25 index over API tools (name, path, tags and description) for picking relevant subsets."""
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, full_tools: list[dict]):
+        self.names = [t["name"] for t in full_tools]
+        self.docs = []
+        for tool in full_tools:
+            meta = tool.get("_meta", {})
+            path_words = " ".join(p for p in meta.get("path", "").split("/") if not p.startswith("{"))
+            # Name, path and tags say more about what an operation does than its prose
+            weighted = " ".join([tool["name"], path_words, *meta.get("tags", [])])
+            self.docs.append(Counter(index_terms(weighted) * 2 + index_terms(tool["description"])))
+        lengths = [sum(doc.values()) for doc in self.docs]
+        self.avg_length = (sum(lengths) / len(lengths)) if lengths else 1
+        self.lengths = lengths
+        doc_freq = Counter(term for doc in self.docs for term in doc)
+        n = len(self.docs)
+        self.idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in doc_freq.items()}
+        # Job endpoints and their status endpoints are only useful together
+        status_tools = {
+            t["_meta"]["path"]: t["name"] for t in full_tools
+            if t.get("_meta", {}).get("job_poll")
+        }
+        self.companions = {
+            t["name"]: status_tools[t["_meta"]["job_status_path"]] for t in full_tools
+            if t.get("_meta", {}).get("job_status_path") in status_tools
+        }
+        self.core = []
+        for tool in full_tools:
+            meta = tool.get("_meta", {})
+            if (meta.get("method"), meta.get("path", "").rstrip("/")) in SYSTEM_PROMPT_ENDPOINTS:
+                self.core.append(tool["name"])
+                if tool["name"] in self.companions:
+                    self.core.append(self.companions[tool["name"]])
+
+    def rank(self, text: str) -> list[tuple[float, str]]:
+        """Tools matching any term of text, best first."""
+        query = set(index_terms(text))
+        scores = []
+        for name, doc, length in zip(self.names, self.docs, self.lengths):
+            score = 0.0
+            for term in query & doc.keys():
+                tf = doc[term]
+                score += self.idf[term] * tf * (self.K1 + 1) / (
+                    tf + self.K1 * (1 - self.B + self.B * length / self.avg_length)
+                )
+            if score > 0:
+                scores.append((score, name))
+        scores.sort(key=lambda s: -s[0])
+        return scores
+
+    def select(self, text: str, k: int, exclude: set[str] = frozenset()) -> list[str]:
+        """The k best tools for text not in exclude, plus their job status companions."""
+        selected = []
+        for _, name in self.rank(text):
+            if name not in exclude and name not in selected:
+                selected.append(name)
+                companion = self.companions.get(name)
+                if companion and companion not in exclude and companion not in selected:
+                    selected.append(companion)
+            if len(selected) >= k:
+                break
+        return selected
+
+
+class ToolSelection:
+    """The API tools offered to Claude during one run.
+
+    Starts with the system prompt's endpoints plus the tools most relevant to
+    the question and recent history, and only ever grows (through expand_tools),
+    so the tools prefix of the prompt cache changes as rarely as possible.
+    """
+
+    def __init__(self, tools: dict, question: str, history: list[dict] | None = None, enabled: bool = TOOL_SUBSET):
+        self.tools = tools
+        full_tools = tools["full_tools"]
+        if not enabled or len(full_tools) < TOOL_SUBSET_MIN_TOOLS:
+            self.active = {t["name"] for t in full_tools}
+        else:
+            recent = [
+                m["content"] for m in (history or [])[-TOOL_SUBSET_HISTORY_MESSAGES:]
+                if isinstance(m.get("content"), str)
+            ]
+            index = tools["index"]
+            self.active = set(index.core)
+            self.active.update(index.select(" ".join([*recent, question]), TOOL_SUBSET_SIZE, self.active))
+        self._claude_tools = None
+
+    @property
+    def complete(self) -> bool:
+        return len(self.active) >= len(self.tools["full_tools"])
+
+    @property
+    def expandable(self) -> bool:
+        """Whether claude_tools() includes expand_tools."""
+        return not self.complete
+
+    def expand(self, query: str, load_all: bool = False) -> list[str]:
+        """Add the tools best matching query (or all of them) and return the added names."""
+        if load_all:
+            added = [t["name"] for t in self.tools["full_tools"] if t["name"] not in self.active]
+        else:
+            added = self.tools["index"].select(query, TOOL_EXPAND_SIZE, self.active)
+        if added:
+            self.active.update(added)
+            self._claude_tools = None
+        return added
+
+    def claude_tools(self) -> list[dict]:
+        """Tools for the Claude request, rebuilt only when the selection grows."""
+        if self.complete:
+            # Identical to every other full-list run, so they share the cache prefix
+            return self.tools["cached_tools"]
+        if self._claude_tools is None:
+            subset = [t for t in self.tools["full_tools"] if t["name"] in self.active]
+            self._claude_tools = build_claude_tools(subset, expandable=True)
+        return self._claude_tools
+
+    def describe(self) -> str:
+        full_count = len(self.tools["full_tools"])
+        tokens = len(json.dumps(self.claude_tools())) // CHARS_PER_TOKEN
+        full_tokens = self.tools["footprint"]["tokens"]
+        return f"{len(self.active)} of {full_count} API tools (~{tokens} of ~{full_tokens} tool tokens)"
+
+
+class Span:
+    """One timed operation within a run's trace."""
+
+    __slots__ = ("name", "span_id", "parent_id", "attributes", "start_ns", "end_ns", "handle")
+
+    def __init__(self, name: str, parent_id: str | None, attributes: dict):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.handle = None  # exporter state, e.g. the open logfire span
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+
+class Tracer:
+    """Nestable timing spans and counters for one agent run.
+
+    Spans nest within a thread; work handed to another thread keeps its parent
+    through bind(), and spans opened on other threads otherwise hang off the
+    root. Finished spans go to the exporters, and summary() condenses them
+    into per-phase and per-turn timings.
+    """
+
+    def __init__(self, name: str, exporters: list | None = None, **attributes):
+        self.trace_id = os.urandom(16).hex()
+        self.exporters = exporters or []
+        self.spans: list[Span] = []
+        self.counters: Counter = Counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.root = self._start(name, None, attributes)
+        self._local.stack = [self.root]
+
+    def _stack(self) -> list[Span]:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def current(self) -> Span:
+        stack = self._stack()
+        return stack[-1] if stack else self.root
+
+    def _start(self, name: str, parent: Span | None, attributes: dict) -> Span:
+        span = Span(name, parent.span_id if parent else None, attributes)
+        for exporter in self.exporters:
+            try:
+                exporter.start(span)
+            except Exception as e:
+                print(f"Failed to export span start: {e}")
+        return span
+
+    def _end(self, span: Span) -> None:
+        span.end_ns = time.time_ns()
+        with self._lock:
+            self.spans.append(span)
+        for exporter in self.exporters:
+            try:
+                exporter.end(span)
+            except Exception as e:
+                print(f"Failed to export span: {e}")
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Time the enclosed block as a child of the current span."""
+        span = self._start(name, self.current(), attributes)
+        stack = self._stack()
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=type(e).__name__)
+            raise
+        finally:
+            stack.pop()
+            self._end(span)
+
+    def annotate(self, **attributes) -> None:
+        """Set attributes on the current span."""
+        self.current().set(**attributes)
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += value
+
+    def bind(self, fn: Callable) -> Callable:
+        """Wrap fn so spans it opens on another thread nest under the current span.
+
+        The caller's contextvars go along too, since that is where
+        OpenTelemetry keeps the active span, so logfire nests them the same way.
+        """
+        parent = self.current()
+        context = contextvars.copy_context()
+
+        def bound(*args, **kwargs):
+            stack = self._stack()
+            saved = list(stack)
+            stack[:] = [parent]
+            try:
+                return context.copy().run(fn, *args, **kwargs)
+            finally:
+                stack[:] = saved
+
+        return bound
+
+    def summary(self) -> dict:
+        """Per-phase totals, per-turn breakdown and counters (stored as messages.timings)."""
+        with self._lock:
+            spans = list(self.spans)
+        by_id = {s.span_id: s for s in spans}
+        phases: dict[str, dict] = {}
+        turns: dict[str, dict] = {}
+        for span in spans:
+            phase = phases.setdefault(span.name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            phase["count"] += 1
+            phase["total_ms"] += span.duration_ms
+            phase["max_ms"] = max(phase["max_ms"], span.duration_ms)
+            if span.name == "turn":
+                turns.setdefault(span.span_id, {})["turn"] = span.attributes.get("turn")
+                turns[span.span_id]["ms"] = round(span.duration_ms, 1)
+                continue
+            # Charge the span to the turn it ran in, if any
+            parent = by_id.get(span.parent_id)
+            while parent is not None and parent.name != "turn":
+                parent = by_id.get(parent.parent_id)
+            if parent is not None:
+                turn = turns.setdefault(parent.span_id, {})
+                turn[f"{span.name}_ms"] = round(turn.get(f"{span.name}_ms", 0) + span.duration_ms, 1)
+        for phase in phases.values():
+            phase["total_ms"] = round(phase["total_ms"], 1)
+            phase["max_ms"] = round(phase["max_ms"], 1)
+        return {
+            "total_ms": round(self.root.duration_ms, 1),
+            "phases": phases,
+            "turns": sorted(turns.values(), key=lambda t: t.get("turn") or 0),
+            "counters": dict(self.counters),
+        }
+
+    def close(self) -> dict:
+        """End the root span, flush the exporters and return the summary."""
+        self.root.set(**{f"counter.{k}": v for k, v in self.counters.items()})
+        self._end(self.root)
+        summary = self.summary()
+        for exporter in self.exporters:
+            try:
+                exporter.close(self)
+            except Exception as e:
+                print(f"Failed to export trace: {e}")
+        return summary
+
+
+class NullTracer:
+    """Tracer stand-in for code called outside a traced run."""
+
+    def span(self, name: str, **attributes):
+        return nullcontext(Span(name, None, attributes))
+
+    def annotate(self, **attributes) -> None:
+        pass
+
+    def count(self, name: str, value: int = 1) -> None:
+        pass
+
+    def bind(self, fn: Callable) -> Callable:
+        return fn
+
+
+NULL_TRACER = NullTracer()
+
+
+class LogfireExporter:
+    """Mirrors spans into logfire as they open and close."""
+
+    def start(self, span: Span) -> None:
+        import logfire
+
+        span.handle = logfire.span(span.name, **span.attributes)
+        span.handle.__enter__()
+
+    def end(self, span: Span) -> None:
+        if span.handle is None:
+            return
+        for key, value in span.attributes.items():
+            span.handle.set_attribute(key, value)
+        span.handle.__exit__(None, None, None)
+        span.handle = None
+
+    def close(self, tracer: Tracer) -> None:
+        pass
+
+
+def otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, str):
+        return {"stringValue": value}
+    return {"stringValue": json.dumps(value, default=str)}
+
+
+_trace_file_lock = threading.Lock()
+
+
+class OtlpFileExporter:
+    """Appends each run's trace to a file as one OTLP/JSON ExportTraceServiceRequest per line."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def start(self, span: Span) -> None:
+        pass
+
+    def end(self, span: Span) -> None:
+        pass
+
+    def close(self, tracer: Tracer) -> None:
+        spans = [
+            {
+                "traceId": tracer.trace_id,
+                "spanId": span.span_id,
+                **({"parentSpanId": span.parent_id} if span.parent_id else {}),
+                "name": span.name,
+                "kind": 1,
+                "startTimeUnixNano": str(span.start_ns),
+                "endTimeUnixNano": str(span.end_ns),
+                "attributes": [{"key": k, "value": otlp_value(v)} for k, v in span.attributes.items() if v is not None],
+            }
+            for span in tracer.spans
+        ]
+        request = {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": otlp_value(TRACE_SERVICE_NAME)}]},
+                "scopeSpans": [{"scope": {"name": TRACE_SERVICE_NAME}, "spans": spans}],
+            }]
+        }
+        line = json.dumps(request) + "\n"
+        with _trace_file_lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(line)
+
+
+def trace_exporters() -> list:
+    """Exporters named in TRACE_EXPORTERS."""
+    exporters = []
+    for name in (n.strip() for n in TRACE_EXPORTERS.split(",")):
+        if name == "logfire":
+            exporters.append(LogfireExporter())
+        elif name == "file":
+            exporters.append(OtlpFileExporter(TRACE_FILE))
+        elif name:
+            print(f"Unknown trace exporter: {name}")
+    return exporters
+
+
+def job_status(data) -> str | None:
+    """Lower-cased status of a job response, or None if it isn't one."""
+    if isinstance(data, dict) and isinstance(data.get("status"), str):
+        return data["status"].lower()
+    return None
+
+
+def poll_job(
+    status_url: str,
+    headers: dict,
+    log_fn: Callable,
+    cancel_event: threading.Event | None = None,
+    tracer: Tracer | NullTracer = NULL_TRACER,
+) -> requests.Response:
+    """Poll a job status URL with backoff until it finishes or JOB_POLL_TIMEOUT passes.
+
+    Returns the last response, which still has a running status on timeout or
+    if cancel_event is set while waiting.
+    """
+    start = time.monotonic()
+    interval = JOB_POLL_INITIAL_INTERVAL
+    polls = 0
+    while True:
+        with tracer.span("api.job_poll", poll=polls + 1):
+            resp = http_request("get", status_url, log_fn=log_fn, headers=headers, timeout=60)
+        polls += 1
+        tracer.count("job.polls")
+        if resp.status_code >= 400:
+            return resp
+        try:
+            status = job_status(resp.json())
+        except ValueError:
+            return resp
+        elapsed = time.monotonic() - start
+        if status is None or status in JOB_TERMINAL_STATUSES:
+            log_fn(f"[JOB] Finished with status {status} after {polls} polls ({elapsed:.1f}s)")
+            return resp
+        if elapsed + interval > JOB_POLL_TIMEOUT:
+            log_fn(f"[JOB] Still {status} after {elapsed:.0f}s, returning to the model")
+            return resp
+        log_fn(f"[JOB] Status {status}, checking again in {interval:.1f}s")
+        with tracer.span("api.job_sleep", seconds=interval):
+            if cancel_event is None:
+                time.sleep(interval)
+            elif cancel_event.wait(interval):
+                log_fn(f"[JOB] Stopped waiting after {elapsed:.0f}s, run cancelled")
+                return resp
+        interval = min(interval * JOB_POLL_BACKOFF, JOB_POLL_MAX_INTERVAL)
+
+
+def await_job(
+    meta: dict,
+    resp: requests.Response,
+    api_base_url: str,
+    headers: dict,
+    log_fn: Callable,
+    cancel_event: threading.Event | None = None,
+    tracer: Tracer | NullTracer = NULL_TRACER,
+) -> requests.Response:
+    """If resp is an unfinished job, poll it server-side and return the final response."""
+    try:
+        data = resp.json()
+    except ValueError:
+        return resp
+    status = job_status(data)
+    if status is None or status in JOB_TERMINAL_STATUSES:
+        return resp
+
+    if meta.get("job_poll"):
+        status_url = resp.url
+    else:
+        id_param = meta["job_id_param"]
+        job_id = data.get(id_param) or data.get("id")
+        if not job_id:
+            return resp
+        status_url = api_base_url + meta["job_status_path"].replace(f"{{{id_param}}}", str(job_id))
+
+    log_fn(f"[JOB] Waiting for job at {status_url}")
+    return poll_job(status_url, headers, log_fn, cancel_event, tracer)
+
+
 def execute_api_tool(
     tool: dict,
     tool_input: dict,
     api_base_url: str,
     log_fn: Callable,
+    cancel_event: threading.Event | None = None,
+    tracer: Tracer | NullTracer = NULL_TRACER,
 ) -> str:
     """Execute an API tool by making the HTTP request."""
     meta = tool.get("_meta", {})
@@ -484,54 +1896,206 @@ def execute_api_tool(
         if body_data:
             log_fn(f"[API] Body: {json.dumps(body_data)[:200]}")
 
-        if method == "get":
-            resp = requests.get(url, params=query_params, headers=headers, timeout=60)
-        elif method == "post":
-            resp = requests.post(
-                url, params=query_params, json=body_data, headers=headers, timeout=60
-            )
-        elif method == "put":
-            resp = requests.put(
-                url, params=query_params, json=body_data, headers=headers, timeout=60
-            )
-        elif method == "patch":
-            resp = requests.patch(
-                url, params=query_params, json=body_data, headers=headers, timeout=60
-            )
-        elif method == "delete":
-            resp = requests.delete(url, params=query_params, headers=headers, timeout=60)
-        else:
+        # Idempotent lookups are served from the response cache (job status polls never are)
+        collection = f"{api_base_url}/{path.strip('/').split('/')[0]}"
+        cache_key = None
+        cached = None
+        if method == "get" and not meta.get("job_poll"):
+            cache_key = ResponseCache.key(url, query_params, _response_cache.generation(collection))
+            cached = _response_cache.lookup(cache_key)
+            if cached and cached["expires"] > time.time():
+                _response_cache.count("hits")
+                tracer.count("api_cache.hits")
+                log_fn("[API] Response: 200 (cached)")
+                return compact_response(cached["text"], meta, log_fn)
+            if cached and cached["etag"]:
+                headers = {**headers, "If-None-Match": cached["etag"]}
+            else:
+                cached = None
+            _response_cache.count("misses")
+            tracer.count("api_cache.misses")
+
+        if method not in ("get", "delete", "post", "put", "patch"):
             return f"Unsupported method: {method}"
+        with tracer.span("api.request", method=method, path=path) as span:
+            if method in ("get", "delete"):
+                resp = http_request(
+                    method, url, log_fn=log_fn, params=query_params, headers=headers, timeout=60
+                )
+            else:
+                resp = http_request(
+                    method, url, log_fn=log_fn, params=query_params, json=body_data, headers=headers, timeout=60
+                )
+            span.set(status=resp.status_code, bytes=len(resp.content))
+
+        if cached and resp.status_code == 304:
+            _response_cache.refresh(cache_key, cached, resp)
+            tracer.count("api_cache.revalidated")
+            log_fn("[API] Response: 200 (revalidated)")
+            return compact_response(cached["text"], meta, log_fn)
 
         log_fn(f"[API] Response: {resp.status_code}")
 
+        # Jobs are polled here rather than by the model, one turn instead of N
+        if resp.status_code < 400 and (meta.get("job_status_path") or meta.get("job_poll")):
+            with tracer.span("api.job_wait"):
+                resp = await_job(meta, resp, api_base_url, headers, log_fn, cancel_event, tracer)
+
         if resp.status_code >= 400:
             return f"Error {resp.status_code}: {resp.text[:500]}"
 
-        try:
-            data = resp.json()
-            if isinstance(data, list) and len(data) > 50:
-                result = json.dumps(data[:50], indent=2)
-                result += f"\n... ({len(data) - 50} more items)"
-            else:
-                result = json.dumps(data, indent=2)
-            return result
-        except json.JSONDecodeError:
-            return resp.text[:1000]
+        if cache_key:
+            _response_cache.store(cache_key, url, resp)
+        elif method != "get":
+            # A write makes cached reads of the same collection stale
+            _response_cache.invalidate_prefix(collection)
+
+        with tracer.span("api.compact", chars=len(resp.text)):
+            return compact_response(resp.text, meta, log_fn)
 
     except requests.RequestException as e:
         return f"Request error: {str(e)}"
 
 
-def summarize_api_result(client, raw_result: str, tool_name: str, tool_input: dict) -> str:
-    """Use Haiku to extract relevant information from large API responses."""
+def compact_response(text: str, meta: dict, log_fn: Callable) -> str:
+    result = format_api_response(text, meta.get("response_shape"))
+    log_fn(f"[COMPACT] {len(text)} -> {len(result)} chars")
+    return result
+
+
+def project_response(data, shape: dict | None):
+    """Keep only the fields documented in the response schema."""
+    if shape is None:
+        return data
+    if isinstance(data, dict) and "fields" in shape:
+        fields = shape["fields"]
+        return {k: project_response(v, fields[k]) for k, v in data.items() if k in fields}
+    if isinstance(data, list) and "items" in shape:
+        return [project_response(item, shape["items"]) for item in data]
+    return data
+
+
+def strip_empty(data):
+    """Drop null and empty values from objects (list positions are kept)."""
+    if isinstance(data, dict):
+        stripped = {k: strip_empty(v) for k, v in data.items()}
+        return {k: v for k, v in stripped.items() if v not in (None, "", [], {})}
+    if isinstance(data, list):
+        return [strip_empty(item) for item in data]
+    return data
+
+
+def to_columnar(data):
+    """Turn lists of similar objects into {"columns": [...], "rows": [[...]]} tables."""
+    if isinstance(data, dict):
+        return {k: to_columnar(v) for k, v in data.items()}
+    if not isinstance(data, list):
+        return data
+    data = [to_columnar(item) for item in data]
+    if len(data) < MIN_COLUMNAR_ROWS or not all(isinstance(item, dict) for item in data):
+        return data
+    columns = list(dict.fromkeys(k for item in data for k in item))
+    # Only tabulate when rows mostly share fields, otherwise the nulls cost more than keys
+    filled = sum(len(item) for item in data)
+    if filled < 0.75 * len(columns) * len(data):
+        return data
+    return {"columns": columns, "rows": [[item.get(c) for c in columns] for item in data]}
+
+
+def format_api_response(text: str, shape: dict | None = None) -> str:
+    """Compact a response body for Claude.
+
+    Deterministic and local: projects to the schema's fields, strips empty
+    values, tabulates homogeneous lists and emits compact JSON.
+    """
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        return text[:1000]
+    omitted = 0
+    if isinstance(data, list) and len(data) > MAX_RESULT_ITEMS:
+        omitted = len(data) - MAX_RESULT_ITEMS
+        data = data[:MAX_RESULT_ITEMS]
+    data = to_columnar(strip_empty(project_response(data, shape)))
+    result = json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+    if omitted:
+        result += f"\n... ({omitted} more items)"
+    return result
+
+
+_summary_cache = LRUCache(SUMMARY_CACHE_MAX_BYTES)
+
+
+def summary_cache_key(tool_name: str, tool_input: dict, raw_result: str) -> str:
+    """Content address of a summary: the tool, its normalised input and the raw response."""
+    canonical = json.dumps([tool_name, tool_input, raw_result], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def _read_summary_file(key: str) -> str | None:
+    if not SUMMARY_CACHE_PERSIST:
+        return None
+    try:
+        with open(os.path.join(SUMMARY_CACHE_DIR, key[:2], f"{key}.txt")) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _write_summary_file(key: str, summary: str) -> None:
+    if not SUMMARY_CACHE_PERSIST:
+        return
+    path = os.path.join(SUMMARY_CACHE_DIR, key[:2], f"{key}.txt")
+    try:
+        # Committed with the volume's background commits - a lost summary is just recomputed
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(summary)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Failed to persist summary: {e}")
+
+
+def summarize_api_result(
+    client,
+    raw_result: str,
+    tool_name: str,
+    tool_input: dict,
+    log_fn: Callable = print,
+    on_usage: Callable | None = None,
+    tracer: Tracer | NullTracer = NULL_TRACER,
+) -> str:
+    """Use Haiku to extract relevant information from large API responses.
+
+    Summaries are memoised by content hash in memory and on the cache volume,
+    so an identical response is only summarised once. on_usage(model, usage)
+    is called with the token usage of any Haiku request made.
+    """
+    key = summary_cache_key(tool_name, tool_input, raw_result)
+    summary = _summary_cache.get(key)
+    if summary is not None:
+        tracer.count("summary.memory_hits")
+        log_fn(f"[HAIKU] Reused cached summary ({len(summary)} chars)")
+        return summary
+    with tracer.span("summary.read_file"):
+        summary = _read_summary_file(key)
+    if summary is not None:
+        tracer.count("summary.disk_hits")
+        _summary_cache.set(key, summary, len(summary))
+        log_fn(f"[HAIKU] Reused stored summary ({len(summary)} chars)")
+        return summary
+
+    log_fn(f"[HAIKU] Summarizing {len(raw_result)} char response...")
+    tracer.count("summary.requests")
     try:
-        response = client.messages.create(
-            model="claude-haiku-3-5-20241022",
-            max_tokens=1000,
-            messages=[{
-                "role": "user",
-                "content": f"""Extract the key information from this API response. Be concise but preserve important IDs, values, and data needed for policy analysis.
+        with tracer.span("haiku", model=SUMMARY_MODEL, chars=len(raw_result)) as span:
+            response = client.messages.create(
+                model=SUMMARY_MODEL,
+                max_tokens=1000,
+                messages=[{
+                    "role": "user",
+                    "content": f"""Extract the key information from this API response. Be concise but preserve important IDs, values, and data needed for policy analysis.
 
 Tool: {tool_name}
 Input: {json.dumps(tool_input)[:500]}
@@ -540,282 +2104,1121 @@ Response:
 {raw_result[:15000]}
 
 Return only the essential information in a compact format."""
-            }]
-        )
-        return response.content[0].text
+                }]
+            )
+            span.set(input_tokens=response.usage.input_tokens, output_tokens=response.usage.output_tokens)
+        if on_usage:
+            on_usage(SUMMARY_MODEL, response.usage)
+        summary = response.content[0].text
     except Exception as e:
-        # Fall back to truncation if Haiku fails
+        # Fall back to truncation if Haiku fails (not cached, so the next call retries)
+        log_fn(f"[HAIKU] Failed: {e}")
         return raw_result[:2000] + f"\n...[truncated, {len(raw_result)} total chars]"
 
+    log_fn(f"[HAIKU] Compressed to {len(summary)} chars")
+    _summary_cache.set(key, summary, len(summary))
+    _write_summary_file(key, summary)
+    return summary
+
+
+def with_cache_breakpoint(message: dict) -> dict:
+    """Copy of a message with cache_control on its last content block."""
+    content = message["content"]
+    if isinstance(content, str):
+        blocks = [{"type": "text", "text": content}]
+    else:
+        blocks = [
+            block if isinstance(block, dict) else block.model_dump(exclude_none=True)
+            for block in content
+        ]
+    if not blocks:
+        return message
+    blocks[-1] = {**blocks[-1], "cache_control": {"type": "ephemeral"}}
+    return {**message, "content": blocks}
+
+
+def add_history_cache_breakpoints(messages: list[dict], history_len: int) -> list[dict]:
+    """Place the two conversation cache breakpoints for a request.
+
+    Tools and the system prompt use two of the API's four breakpoints. The
+    other two go at the end of the incoming thread history (stable for the
+    whole run, and across follow-up questions) and on the latest message, so
+    each turn reads the previous turn's prefix from cache. Messages are
+    copied, never mutated, so the breakpoint moves cleanly each turn.
+    """
+    anchors = {len(messages) - 1}
+    if history_len > 0:
+        anchors.add(history_len - 1)
+    return [
+        with_cache_breakpoint(message) if i in anchors else message
+        for i, message in enumerate(messages)
+    ]
+
+
+UUID_RE = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", re.IGNORECASE)
+NUMBER_FIELD_RE = re.compile(r'"(\w+)"\s*:\s*(-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)')
+COMPACTED_MARKER = "[Compacted earlier result"
+
+
+def _collect_values(data, key: str, values: list[str]) -> None:
+    """Collect key=number pairs from a JSON value, reading column/row tables by column."""
+    if isinstance(data, dict):
+        if set(data) == {"columns", "rows"}:
+            for row in data["rows"]:
+                _collect_values(dict(zip(data["columns"], row)), key, values)
+            return
+        for k, v in data.items():
+            _collect_values(v, k, values)
+    elif isinstance(data, list):
+        for item in data:
+            _collect_values(item, key, values)
+    elif isinstance(data, (int, float)) and not isinstance(data, bool):
+        values.append(f"{key}={data}")
+
+
+def stub_tool_result(content: str) -> str:
+    """Short stand-in for a tool result the model has already used.
+
+    Keeps every ID and numeric field so later turns can still refer to them.
+    """
+    ids = list(dict.fromkeys(UUID_RE.findall(content)))
+    try:
+        found: list[str] = []
+        _collect_values(json.loads(content), "value", found)
+    except ValueError:
+        found = [f"{k}={v}" for k, v in NUMBER_FIELD_RE.findall(content)]
+    values = list(dict.fromkeys(found))
+    stub = f"{COMPACTED_MARKER} - {len(content)} chars] {content[:200]}"
+    if ids:
+        stub += f"\nIDs: {', '.join(ids[:50])}"
+    if values:
+        stub += f"\nValues: {', '.join(values[:100])}"
+    return stub
+
+
+class ConversationContext:
+    """Tracks approximate token counts of the agent's messages and compacts stale tool results.
+
+    Tool results older than the last keep_recent_turns turns are replaced with
+    stubs, but only once they add up to threshold tokens. Compacting in one
+    batch means the prompt-cache prefix changes rarely rather than every turn.
+    """
 
-@app.function(image=image, secrets=[anthropic_secret, supabase_secret, logfire_secret], timeout=600)
-def run_agent(
-    question: str,
-    thread_id: str,
-    api_base_url: str = "https://v2.api.policyengine.org",
-    history: list[dict] | None = None,
-    max_turns: int = 30,
-    user_id: str | None = None,
-    model: str = "claude-opus-4-5",
-) -> dict:
-    """Run agentic loop to answer a policy question.
-
-    Stores logs in Supabase agent_logs table and final result as a message.
+    def __init__(self, messages: list, threshold: int = CONTEXT_COMPACT_THRESHOLD, keep_recent_turns: int = CONTEXT_KEEP_RECENT_TURNS):
+        self.messages = messages
+        self.threshold = threshold
+        self.keep_recent_turns = keep_recent_turns
+
+    @staticmethod
+    def estimate_tokens(content) -> int:
+        if isinstance(content, str):
+            return len(content) // CHARS_PER_TOKEN
+        if isinstance(content, list):
+            return sum(ConversationContext.estimate_tokens(block) for block in content)
+        if isinstance(content, dict):
+            if "input" in content:
+                return len(json.dumps(content["input"])) // CHARS_PER_TOKEN
+            return ConversationContext.estimate_tokens(content.get("content") or content.get("text") or "")
+        if hasattr(content, "model_dump_json"):
+            return len(content.model_dump_json()) // CHARS_PER_TOKEN
+        return 0
+
+    def token_counts(self) -> list[int]:
+        return [self.estimate_tokens(m["content"]) for m in self.messages]
+
+    def _stale_results(self) -> list[dict]:
+        # Each turn adds an assistant message and a user tool_result message
+        cutoff = len(self.messages) - 2 * self.keep_recent_turns
+        stale = []
+        for message in self.messages[:max(cutoff, 0)]:
+            if message["role"] != "user" or not isinstance(message["content"], list):
+                continue
+            for block in message["content"]:
+                if (
+                    isinstance(block, dict)
+                    and block.get("type") == "tool_result"
+                    and isinstance(block.get("content"), str)
+                    and not block["content"].startswith(COMPACTED_MARKER)
+                ):
+                    stale.append(block)
+        return stale
+
+    def compact(self, log_fn: Callable) -> None:
+        stale = self._stale_results()
+        stale_tokens = sum(self.estimate_tokens(block["content"]) for block in stale)
+        before = sum(self.token_counts())
+        if stale_tokens < self.threshold:
+            log_fn(f"[CONTEXT] ~{before} tokens in {len(self.messages)} messages (~{stale_tokens} in stale tool results)")
+            return
+        for block in stale:
+            stub = stub_tool_result(block["content"])
+            if len(stub) < len(block["content"]):
+                block["content"] = stub
+        after = sum(self.token_counts())
+        log_fn(f"[CONTEXT] Compacted {len(stale)} tool results: ~{before} -> ~{after} tokens")
+
+
+class LogWriter:
+    """Writes agent_logs rows to Supabase in batches from a background thread.
+
+    Rows are queued in order and inserted with multi-row inserts, flushed every
+    LOG_BATCH_SIZE rows or LOG_FLUSH_INTERVAL seconds. Each row gets a strictly
+    increasing created_at so readers ordering by timestamp see log order even
+    when a batch lands in one transaction. The per-thread seq used for
+    cursor-based reads is assigned by the database in insert order.
     """
-    import anthropic
-    import logfire
-    from supabase import create_client
 
-    # Configure logfire for token tracking
-    logfire.configure()
+    def __init__(
+        self,
+        supabase,
+        table: str = "agent_logs",
+        batch_size: int = LOG_BATCH_SIZE,
+        flush_interval: float = LOG_FLUSH_INTERVAL,
+        max_queue: int = LOG_QUEUE_SIZE,
+        max_retries: int = 4,
+        tracer: Tracer | NullTracer = NULL_TRACER,
+    ):
+        self._supabase = supabase
+        self._tracer = tracer
+        self._table = table
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_retries = max_retries
+        # Bounded so a stalled database applies backpressure instead of growing memory
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._stamp_lock = threading.Lock()
+        self._last_stamp = datetime.now(timezone.utc)
+        self._closed = False
+        # Run in the creator's context so log flush spans join its trace in logfire
+        self._thread = threading.Thread(target=contextvars.copy_context().run, args=(self._run,), daemon=True)
+        self._thread.start()
+
+    def write(self, row: dict) -> None:
+        """Queue a row for insertion (blocks if the queue is full)."""
+        if self._closed:
+            return
+        with self._stamp_lock:
+            stamp = max(datetime.now(timezone.utc), self._last_stamp + timedelta(microseconds=1))
+            self._last_stamp = stamp
+            self._queue.put({**row, "created_at": stamp.isoformat()})
+
+    def flush(self, timeout: float = 30) -> bool:
+        """Block until every row queued so far has been written."""
+        if self._closed:
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout: float = 30) -> None:
+        """Flush remaining rows and stop the writer thread."""
+        if self._closed:
+            return
+        self.flush(timeout)
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch: list[dict] = []
+            markers: list[threading.Event] = []
+            deadline = time.monotonic() + self._flush_interval
+            stop = False
+            while True:
+                if isinstance(item, threading.Event):
+                    # Flush requested - write what we have now
+                    markers.append(item)
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+                if len(batch) >= self._batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            if batch:
+                self._insert(batch)
+            for marker in markers:
+                marker.set()
+            if stop:
+                return
+
+    def _insert(self, rows: list[dict]) -> None:
+        self._tracer.count("db.log_rows", len(rows))
+        for attempt in range(self._max_retries):
+            try:
+                with self._tracer.span("db.log_batch", rows=len(rows), attempt=attempt):
+                    self._supabase.table(self._table).insert(rows).execute()
+                return
+            except Exception as e:
+                if attempt == self._max_retries - 1:
+                    print(f"Failed to log {len(rows)} rows to Supabase: {e}")
+                    return
+                time.sleep(0.2 * (2 ** attempt))
 
-    # Connect to Supabase
-    supabase_url = os.environ["SUPABASE_URL"]
-    supabase_key = os.environ["SUPABASE_SERVICE_KEY"]
-    supabase = create_client(supabase_url, supabase_key)
 
-    # Track logs in memory for saving with the message
-    collected_logs: list[str] = []
+class AgentCancelled(Exception):
+    """Raised inside the agent loop when the user cancels the run."""
 
-    def log(msg: str) -> None:
-        print(msg)
-        collected_logs.append(msg)
-        try:
-            supabase.table("agent_logs").insert({
-                "thread_id": thread_id,
-                "message": msg,
-            }).execute()
-        except Exception as e:
-            print(f"Failed to log to Supabase: {e}")
 
-    log(f"[AGENT] Starting: {question[:200]}")
+class CancelWatcher:
+    """Watch threads.cancel_requested_at for one run from a background thread.
 
-    # Fetch and convert OpenAPI spec to tools
-    log("[AGENT] Fetching OpenAPI spec...")
-    spec = fetch_openapi_spec(api_base_url)
-    full_tools = openapi_to_claude_tools(spec)
-    log(f"[AGENT] Loaded {len(full_tools)} API tools")
+    The agent loop only checks an in-process Event, so cancellation costs one
+    primary-key lookup per CANCEL_POLL_INTERVAL rather than a log scan per
+    turn, and anything waiting on the event wakes as soon as it is set.
+    """
 
-    # Create lookup for API execution (needs full tool with _meta)
-    tool_lookup = {t["name"]: t for t in full_tools}
+    def __init__(self, supabase, thread_id: str, reset: bool = True, interval: float = CANCEL_POLL_INTERVAL):
+        self.event = threading.Event()
+        self._supabase = supabase
+        self._thread_id = thread_id
+        self._interval = interval
+        self._stopped = threading.Event()
+
+        # A request left over from an earlier run must not cancel this one.
+        # Queued runs skip this: the flag was cleared at enqueue time, and a
+        # cancel sent while queued should still apply.
+        if reset:
+            try:
+                supabase.table("threads").update({"cancel_requested_at": None}).eq("id", thread_id).execute()
+            except Exception as e:
+                print(f"Failed to reset cancellation flag: {e}")
 
-    # Strip _meta from tools for Claude (it's only used internally for API execution)
-    claude_tools = [
-        {k: v for k, v in t.items() if k != "_meta"}
-        for t in full_tools
-    ] + [SLEEP_TOOL, CREATE_ARTIFACT_TOOL]
+        self._thread = threading.Thread(target=self._run, name="cancel-watcher", daemon=True)
+        self._thread.start()
 
-    client = anthropic.Anthropic()
-    logfire.instrument_anthropic(client)
+    def is_set(self) -> bool:
+        return self.event.is_set()
+
+    def wait(self, timeout: float) -> bool:
+        """Sleep for up to timeout seconds, returning True early if cancelled."""
+        return self.event.wait(timeout)
 
-    messages = []
-    if history:
-        for msg in history:
-            messages.append({"role": msg["role"], "content": msg["content"]})
-    messages.append({"role": "user", "content": question})
-
-    final_response = None
-    turns = 0
-    total_input_tokens = 0
-    total_output_tokens = 0
-    total_cache_read_tokens = 0
-    total_cache_creation_tokens = 0
-    artifact_created = False  # Only allow ONE artifact per agent run
-
-    # Add cache_control to tools (only last item needs it to cache the whole prefix)
-    cached_tools = claude_tools[:-1] + [{**claude_tools[-1], "cache_control": {"type": "ephemeral"}}]
-    cached_system = [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}]
-
-    def call_claude_with_retry(max_retries: int = 3) -> anthropic.types.Message:
-        """Call Claude API with retry logic for transient errors."""
-        for attempt in range(max_retries):
+    def check(self) -> None:
+        if self.event.is_set():
+            raise AgentCancelled()
+
+    def close(self) -> None:
+        self._stopped.set()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self._interval):
             try:
-                return client.messages.create(
-                    model=model,
-                    max_tokens=4096,
-                    system=cached_system,
-                    tools=cached_tools,
-                    messages=messages,
+                result = (
+                    self._supabase.table("threads")
+                    .select("cancel_requested_at")
+                    .eq("id", self._thread_id)
+                    .single()
+                    .execute()
                 )
-            except anthropic.APIStatusError as e:
-                if e.status_code in (529, 503, 500) and attempt < max_retries - 1:
-                    wait_time = (2 ** attempt) * 5  # 5s, 10s, 20s
-                    log(f"[AGENT] API error {e.status_code}, retrying in {wait_time}s...")
-                    time.sleep(wait_time)
-                else:
-                    raise
-
-    def is_cancelled() -> bool:
-        """Check if the thread has been cancelled by the user."""
-        try:
-            result = supabase.table("agent_logs").select("message").eq("thread_id", thread_id).eq("message", "[CANCELLED]").execute()
-            return len(result.data) > 0
-        except Exception:
-            return False
-
-    with logfire.span("agent_conversation", thread_id=thread_id, user_id=user_id or "anonymous"):
-        while turns < max_turns:
-            # Check for cancellation before each turn
-            if is_cancelled():
-                log("[AGENT] Cancelled by user")
-                final_response = "Cancelled by user."
-                break
-
-            turns += 1
-            log(f"[AGENT] Turn {turns}")
-
-            response = call_claude_with_retry()
-
-            # Track token usage
-            total_input_tokens += response.usage.input_tokens
-            total_output_tokens += response.usage.output_tokens
-            total_cache_read_tokens += getattr(response.usage, "cache_read_input_tokens", 0) or 0
-            total_cache_creation_tokens += getattr(response.usage, "cache_creation_input_tokens", 0) or 0
-
-            log(f"[AGENT] Stop reason: {response.stop_reason}")
-
-            assistant_content = []
-            tool_results = []
-
-            for block in response.content:
-                if block.type == "text":
-                    log(f"[ASSISTANT] {block.text[:500]}")
-                    assistant_content.append(block)
-                    final_response = block.text
-                elif block.type == "tool_use":
-                    log(f"[TOOL_USE] {block.name}: {json.dumps(block.input)[:200]}")
-                    # For artifacts, don't store full HTML in history (saves tokens)
-                    if block.name == "create_artifact":
-                        truncated_block = type(block)(
-                            type="tool_use",
-                            id=block.id,
-                            name=block.name,
-                            input={
-                                "title": block.input.get("title", ""),
-                                "type": block.input.get("type", "html"),
-                                "content": "[HTML content stored separately]",
-                            }
-                        )
-                        assistant_content.append(truncated_block)
-                    else:
-                        assistant_content.append(block)
-
-                    if block.name == "sleep":
-                        seconds = min(max(block.input.get("seconds", 5), 1), 60)
-                        log(f"[SLEEP] Waiting {seconds} seconds...")
-                        time.sleep(seconds)
-                        result = f"Slept for {seconds} seconds"
-                    elif block.name == "create_artifact":
-                        # Only allow ONE artifact per agent run
-                        if artifact_created:
-                            log(f"[ARTIFACT] Rejected - already created one this run")
-                            result = "ERROR: You already created an artifact. Do NOT create another. Provide your final text response now."
-                        else:
-                            title = block.input.get("title", "Untitled")
-                            artifact_type = block.input.get("type", "html")
-                            content = block.input.get("content", "")
-                            dependencies = block.input.get("dependencies", [])
-                            log(f"[ARTIFACT] Creating: {title} (type: {artifact_type})")
-                            try:
-                                artifact_data = supabase.table("artifacts").insert({
-                                    "thread_id": thread_id,
-                                    "type": artifact_type,
-                                    "title": title,
-                                    "content": content,
-                                    "dependencies": dependencies,
-                                }).execute()
-                                artifact_id = artifact_data.data[0]["id"]
-                                artifact_created = True
-                                artifact_url = f"https://nikhilwoodruff--policyengine-chat-agent-serve-artifact.modal.run?id={artifact_id}"
-                                result = f"Artifact successfully created and displayed to user. Title: {title}. Do NOT create another artifact - provide your final text response summarizing the results."
-                                log(f"[ARTIFACT] Created with ID: {artifact_id}")
-                            except Exception as e:
-                                result = f"Failed to create artifact: {str(e)}"
-                                log(f"[ARTIFACT] Error: {str(e)}")
-                    else:
-                        tool = tool_lookup.get(block.name)
-                        if tool:
-                            raw_result = execute_api_tool(tool, block.input, api_base_url, log)
-                            # Use Haiku to summarize large API responses
-                            if len(raw_result) > 2000:
-                                log(f"[HAIKU] Summarizing {len(raw_result)} char response...")
-                                result = summarize_api_result(client, raw_result, block.name, block.input)
-                                log(f"[HAIKU] Compressed to {len(result)} chars")
-                            else:
-                                result = raw_result
-                        else:
-                            result = f"Unknown tool: {block.name}"
+            except Exception as e:
+                print(f"Failed to check cancellation: {e}")
+                continue
+            if result.data and result.data.get("cancel_requested_at"):
+                self.event.set()
+                return
 
-                    log(f"[TOOL_RESULT] {result[:2000]}")
 
-                    tool_results.append({
-                        "type": "tool_result",
-                        "tool_use_id": block.id,
-                        "content": result,
-                    })
+def iter_agent_logs(
+    supabase,
+    thread_id: str,
+    after_seq: int = 0,
+    page_size: int = 500,
+    run_id: str | None = None,
+):
+    """Yield a thread's agent_logs rows with seq > after_seq, in order.
+
+    Pages through the (thread_id, seq) index, or (run_id, seq) when run_id is
+    given, so memory stays bounded by page_size.
+    """
+    while True:
+        query = supabase.table("agent_logs").select("seq, message, created_at")
+        query = query.eq("run_id", run_id) if run_id else query.eq("thread_id", thread_id)
+        page = query.gt("seq", after_seq).order("seq").limit(page_size).execute().data
+        yield from page
+        if len(page) < page_size:
+            return
+        after_seq = page[-1]["seq"]
+
+
+def add_usage(model_usage: dict, model: str, usage) -> None:
+    """Add one Anthropic response's usage to per-model counters."""
+    totals = model_usage.setdefault(model, {"requests": 0, **{field: 0 for field in USAGE_FIELDS}})
+    totals["requests"] += 1
+    totals["input_tokens"] += usage.input_tokens
+    totals["output_tokens"] += usage.output_tokens
+    totals["cache_read_tokens"] += getattr(usage, "cache_read_input_tokens", 0) or 0
+    totals["cache_creation_tokens"] += getattr(usage, "cache_creation_input_tokens", 0) or 0
+
+
+def merge_usage(model_usage: dict, other: dict) -> None:
+    """Add per-model counters from other into model_usage."""
+    for model, counters in other.items():
+        totals = model_usage.setdefault(model, {"requests": 0, **{field: 0 for field in USAGE_FIELDS}})
+        for field, value in counters.items():
+            totals[field] = totals.get(field, 0) + value
+
+
+def usage_cost(model_usage: dict) -> float:
+    """USD cost of per-model usage counters."""
+    return sum(
+        token_cost(model, u["input_tokens"], u["output_tokens"], u["cache_read_tokens"], u["cache_creation_tokens"])
+        for model, u in model_usage.items()
+    )
 
-            messages.append({"role": "assistant", "content": assistant_content})
 
-            if tool_results:
-                messages.append({"role": "user", "content": tool_results})
-            else:
-                break
+def increment_thread_usage(supabase, thread_id: str, model_usage: dict, run_id: str | None = None) -> bool:
+    """Add a run's token usage to the thread's counters in one atomic RPC.
 
-    log(f"[AGENT] Completed in {turns} turns, {total_input_tokens} input tokens, {total_output_tokens} output tokens, {total_cache_read_tokens} cache read, {total_cache_creation_tokens} cache created")
+    With a run_id the RPC applies it at most once per run. Returns False if
+    an earlier call already did.
+    """
+    applied = supabase.rpc("increment_thread_usage", {
+        "p_thread_id": thread_id,
+        **{f"p_{field}": sum(u[field] for u in model_usage.values()) for field in USAGE_FIELDS},
+        "p_model_usage": model_usage,
+        "p_run_id": run_id,
+    }).execute().data
+    return applied is not False
+
+
+def token_cost(model: str, input_tokens: int, output_tokens: int, cache_read: int = 0, cache_creation: int = 0) -> float:
+    """USD cost of a model's token usage, including prompt cache reads and writes."""
+    input_price, output_price = MODEL_PRICES.get(model, MODEL_PRICES["claude-sonnet-4-5"])
+    billed_input = (
+        input_tokens
+        + cache_read * CACHE_READ_PRICE_FACTOR
+        + cache_creation * CACHE_WRITE_PRICE_FACTOR
+    )
+    return (billed_input * input_price + output_tokens * output_price) / 1_000_000
 
-    # Calculate cost (Claude Sonnet pricing: $3/1M input, $15/1M output)
-    input_cost = (total_input_tokens / 1_000_000) * 3
-    output_cost = (total_output_tokens / 1_000_000) * 15
-    total_cost = input_cost + output_cost
 
-    # Update thread with token usage
+def start_run(
+    supabase,
+    thread_id: str,
+    model: str,
+    question: str,
+    run_id: str | None = None,
+    user_id: str | None = None,
+) -> str | None:
+    """Mark an agent_runs row as running, creating it unless the caller queued one."""
+    started_at = datetime.now(timezone.utc).isoformat()
     try:
-        # Get current token counts
-        thread_data = supabase.table("threads").select("input_tokens, output_tokens").eq("id", thread_id).single().execute()
-        current_input = thread_data.data.get("input_tokens") or 0
-        current_output = thread_data.data.get("output_tokens") or 0
-
-        supabase.table("threads").update({
-            "input_tokens": current_input + total_input_tokens,
-            "output_tokens": current_output + total_output_tokens,
-        }).eq("id", thread_id).execute()
+        if run_id:
+            supabase.table("agent_runs").update({
+                "status": "running",
+                "started_at": started_at,
+            }).eq("id", run_id).execute()
+            return run_id
+        result = supabase.table("agent_runs").insert({
+            "thread_id": thread_id,
+            "user_id": user_id,
+            "model": model,
+            "question": question[:1000],
+            "status": "running",
+            "started_at": started_at,
+        }).execute()
+        return result.data[0]["id"]
     except Exception as e:
-        print(f"Failed to update token counts: {e}")
+        print(f"Failed to record agent run: {e}")
+        return run_id
 
-    # Save the assistant message to Supabase with tool logs
-    if final_response:
-        try:
-            supabase.table("messages").insert({
-                "thread_id": thread_id,
-                "role": "assistant",
-                "content": final_response,
-                "tool_logs": collected_logs,
-            }).execute()
-        except Exception as e:
-            print(f"Failed to save message: {e}")
 
-        # Generate a title for the thread
-        try:
+def is_placeholder_title(title: str | None, question: str) -> bool:
+    """Whether a thread title is still the default or the truncated first question set at admission."""
+    if not title or title == DEFAULT_THREAD_TITLE:
+        return True
+    return title == question[:50] + ("..." if len(question) > 50 else "")
+
+
+def finalize(
+    supabase,
+    client,
+    thread_id: str,
+    run_id: str | None,
+    question: str,
+    answer: str | None,
+    model_usage: dict,
+    log_fn: Callable = print,
+) -> None:
+    """Title the thread if it still has a placeholder title, then record the run's usage.
+
+    Safe to retry: a title set on a previous attempt is kept and its usage is
+    read back from the run, and the usage increment is applied at most once
+    per run (runs without an id have no such guard, so it comes last).
+    """
+    model_usage = {m: dict(u) for m, u in model_usage.items()}
+    title_usage: dict = {}
+
+    if answer:
+        thread = supabase.table("threads").select("title").eq("id", thread_id).single().execute().data
+        if thread and is_placeholder_title(thread.get("title"), question):
             title_response = client.messages.create(
-                model="claude-sonnet-4-5",
+                model=TITLE_MODEL,
                 max_tokens=50,
                 messages=[
                     {"role": "user", "content": question},
-                    {"role": "assistant", "content": final_response},
+                    {"role": "assistant", "content": answer},
                     {"role": "user", "content": "Generate a short title (max 6 words) for this conversation in sentence case (only capitalise first word and proper nouns). Reply with just the title, no quotes or punctuation."},
                 ],
             )
+            add_usage(title_usage, TITLE_MODEL, title_response.usage)
+            if run_id:
+                # Saved before the title, so a retry that finds the title set still counts it
+                supabase.table("agent_runs").update({"title_usage": title_usage}).eq("id", run_id).execute()
             title = title_response.content[0].text.strip()[:60]
             supabase.table("threads").update({"title": title}).eq("id", thread_id).execute()
-            log(f"[AGENT] Set title: {title}")
+            log_fn(f"[AGENT] Set title: {title}")
+        elif run_id:
+            run = supabase.table("agent_runs").select("title_usage").eq("id", run_id).single().execute().data
+            title_usage = (run or {}).get("title_usage") or {}
+    merge_usage(model_usage, title_usage)
+
+    if run_id:
+        supabase.table("agent_runs").update({
+            "model_usage": model_usage,
+            "cost_usd": round(usage_cost(model_usage), 6),
+        }).eq("id", run_id).execute()
+
+    # One atomic increment covering every model used in the run
+    if not increment_thread_usage(supabase, thread_id, model_usage, run_id):
+        log_fn(f"[AGENT] Usage for run {run_id} was already recorded")
+
+
+def finalize_inline(supabase, client, *args, log_fn: Callable = print) -> None:
+    """Run finalize in-process with retries, for when finalize_run can't be spawned."""
+    for attempt in range(FINALIZE_RETRIES):
+        try:
+            finalize(supabase, client, *args, log_fn=log_fn)
+            return
         except Exception as e:
-            print(f"Failed to set title: {e}")
+            if attempt == FINALIZE_RETRIES - 1:
+                print(f"Failed to finalize run: {e}")
+                return
+            time.sleep(2 ** attempt)
 
-    return {
-        "status": "completed",
-        "answer": final_response,
-        "turns": turns,
-    }
+
+def finish_run(supabase, run_id: str | None, status: str, **fields) -> None:
+    """Record a run's final status along with its totals."""
+    if not run_id:
+        return
+    try:
+        supabase.table("agent_runs").update({
+            "status": status,
+            "completed_at": datetime.now(timezone.utc).isoformat(),
+            **fields,
+        }).eq("id", run_id).execute()
+    except Exception as e:
+        print(f"Failed to update agent run: {e}")
+
+
+def create_clients():
+    """Configure logfire and create the Supabase and (instrumented) Anthropic clients."""
+    import anthropic
+    import logfire
+    from supabase import create_client
+
+    logfire.configure()
+    supabase = create_client(os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_KEY"])
+    client = anthropic.Anthropic()
+    logfire.instrument_anthropic(client)
+    return supabase, client
+
+
+def describe_startup(startup: dict | None) -> str:
+    """One-line summary of how warm the container was for a run."""
+    if not startup:
+        return "Direct call, no agent container"
+    if startup["cold"]:
+        phases = ", ".join(f"{name} {ms:.0f}ms" for name, ms in startup["phases"].items())
+        return f"Cold start ({phases})"
+    return f"Warm container (run {startup['run']}, up {startup['uptime_s']:.0f}s)"
+
+
+@app.function(
+    image=image,
+    secrets=[anthropic_secret, supabase_secret, logfire_secret],
+    retries=modal.Retries(max_retries=FINALIZE_RETRIES, initial_delay=1.0, backoff_coefficient=2.0),
+    timeout=120,
+)
+def finalize_run(
+    thread_id: str,
+    run_id: str | None,
+    question: str,
+    answer: str | None,
+    model_usage: dict,
+) -> None:
+    """Detached post-completion stage: thread title and usage accounting.
+
+    Its log lines go to agent_logs under the run, like the run's own.
+    """
+    supabase, client = create_clients()
+    log_writer = LogWriter(supabase)
+
+    def log(msg: str) -> None:
+        print(msg)
+        log_writer.write({"thread_id": thread_id, "run_id": run_id, "message": msg})
+
+    try:
+        finalize(supabase, client, thread_id, run_id, question, answer, model_usage, log_fn=log)
+    finally:
+        log_writer.close()
+
+
+def run_agent(
+    question: str,
+    thread_id: str,
+    api_base_url: str = DEFAULT_API_BASE_URL,
+    history: list[dict] | None = None,
+    max_turns: int = 30,
+    user_id: str | None = None,
+    model: str = "claude-opus-4-5",
+    max_parallel_tools: int = MAX_PARALLEL_TOOLS,
+    stream: bool = True,
+    on_event: Callable | None = None,
+    run_id: str | None = None,
+    supabase=None,
+    client=None,
+    startup: dict | None = None,
+    tool_subset: bool = TOOL_SUBSET,
+) -> dict:
+    """Run agentic loop to answer a policy question.
+
+    Tracks the run's lifecycle in agent_runs (using run_id if the caller
+    already queued one) and stores logs in agent_logs and the final result as
+    a message, both keyed to the run. Title generation and usage accounting
+    run afterwards in finalize_run, so they don't delay the response.
+    API tool calls from the same turn run concurrently, up to max_parallel_tools.
+    With stream=True, Claude's text is relayed as delta events while it is
+    generated (never stored; the final text is saved as the message) and GET
+    tool calls start as soon as their tool_use block closes.
+    With tool_subset=True, Claude starts with the most relevant API tools and
+    can load more with expand_tools (see ToolSelection).
+
+    on_event receives typed events as they happen: run, log, delta,
+    tool_result, result and done.
+
+    Runs on Modal go through the Agent class, which passes container-lifetime
+    supabase/client objects and a startup description; called directly (e.g.
+    locally), the clients are created here.
+    """
+    import anthropic
+
+    run_started = time.perf_counter()
+    if supabase is None or client is None:
+        supabase, client = create_clients()
+
+    # Spans at every hot point, exported as configured and summarised on the message
+    tracer = Tracer(
+        "agent_conversation",
+        trace_exporters(),
+        thread_id=thread_id,
+        user_id=user_id or "anonymous",
+        model=model,
+    )
+    queued = run_id is not None
+    with tracer.span("db.start_run"):
+        run_id = start_run(supabase, thread_id, model, question, run_id=run_id, user_id=user_id)
+    tracer.root.set(run_id=run_id)
+
+    # Track logs in memory for saving with the message
+    collected_logs: list[str] = []
+    # Token usage per model, including Haiku summaries made on tool threads
+    model_usage: dict[str, dict[str, int]] = {}
+    usage_lock = threading.Lock()
+    # Logs continue the thread's sequence so readers can fetch seq > last_seen
+    log_writer = LogWriter(supabase, tracer=tracer)
+
+    def emit(event: dict) -> None:
+        if on_event:
+            try:
+                on_event(event)
+            except Exception as e:
+                print(f"Failed to emit event: {e}")
+
+    def log(msg: str) -> None:
+        print(msg)
+        collected_logs.append(msg)
+        emit({"type": "log", "message": msg})
+        log_writer.write({
+            "thread_id": thread_id,
+            "run_id": run_id,
+            "message": msg,
+        })
+
+    def record_usage(usage_model: str, usage) -> None:
+        with usage_lock:
+            add_usage(model_usage, usage_model, usage)
+
+    tool_pool = ThreadPoolExecutor(max_workers=max(max_parallel_tools, 1), thread_name_prefix="api-tool")
+    cancel = CancelWatcher(supabase, thread_id, reset=not queued)
+
+    api_cache_start = _response_cache.snapshot()
+
+    try:
+        emit({"type": "run", "run_id": run_id})
+        log(f"[AGENT] Starting: {question[:200]}")
+
+        # Converted tools are cached per API base URL and revalidated in the background
+        with tracer.span("load_tools"):
+            tools = load_tools(api_base_url, log)
+        full_tools = tools["full_tools"]
+        log(f"[AGENT] Loaded {len(full_tools)} API tools")
+        setup_ms = (time.perf_counter() - run_started) * 1000
+        log(f"[STARTUP] {describe_startup(startup)}, run setup {setup_ms:.0f}ms")
+
+        # Lookup for API execution (needs full tool with _meta)
+        tool_lookup = tools["tool_lookup"]
+        tool_selection = ToolSelection(tools, question, history, enabled=tool_subset)
+        log(f"[TOOLS] Offering {tool_selection.describe()}")
+
+        messages = []
+        history_len = len(history) if history else 0
+        if history:
+            for msg in history:
+                messages.append({"role": msg["role"], "content": msg["content"]})
+        messages.append({"role": "user", "content": question})
+        context = ConversationContext(messages)
+
+        final_response = None
+        status = "completed"
+        turns = 0
+        total_input_tokens = 0
+        total_output_tokens = 0
+        total_cache_read_tokens = 0
+        total_cache_creation_tokens = 0
+        artifact_created = False  # Only allow ONE artifact per agent run
+
+        def cached_system() -> list[dict]:
+            # Changes only when the tool list does, which already starts a new cache prefix
+            text = system_prompt(tool_selection.expandable)
+            return [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}]
+
+        def stream_claude(request: dict, on_tool_block: Callable | None) -> anthropic.types.Message:
+            """Stream a Claude response, relaying text deltas and closed tool_use blocks."""
+            start = time.perf_counter()
+            first_token = None
+            pending_text: list[str] = []
+            last_flush = start
+
+            def flush_text() -> None:
+                nonlocal last_flush
+                if pending_text:
+                    emit({"type": "delta", "text": "".join(pending_text)})
+                    pending_text.clear()
+                last_flush = time.perf_counter()
+
+            with client.messages.stream(**request) as claude_stream:
+                for event in claude_stream:
+                    # Leaving the block closes the connection, ending generation
+                    cancel.check()
+                    if event.type == "content_block_delta":
+                        if first_token is None:
+                            first_token = time.perf_counter()
+                        if event.delta.type == "text_delta":
+                            pending_text.append(event.delta.text)
+                            if (
+                                time.perf_counter() - last_flush > STREAM_FLUSH_INTERVAL
+                                or sum(len(t) for t in pending_text) > STREAM_FLUSH_CHARS
+                            ):
+                                flush_text()
+                    elif event.type == "content_block_stop":
+                        if event.content_block.type == "text":
+                            flush_text()
+                        elif event.content_block.type == "tool_use" and on_tool_block:
+                            on_tool_block(event.content_block)
+                flush_text()
+                message = claude_stream.get_final_message()
+
+            total = time.perf_counter() - start
+            ttft = (first_token - start) if first_token else total
+            tracer.annotate(ttft_ms=round(ttft * 1000))
+            log(f"[STREAM] Time to first token {ttft * 1000:.0f}ms, complete after {total * 1000:.0f}ms")
+            return message
+
+        def call_claude_with_retry(max_retries: int = 3, on_tool_block: Callable | None = None) -> anthropic.types.Message:
+            """Call Claude API with retry logic for transient errors."""
+            for attempt in range(max_retries):
+                try:
+                    request = dict(
+                        model=model,
+                        max_tokens=4096,
+                        system=cached_system(),
+                        tools=tool_selection.claude_tools(),
+                        messages=add_history_cache_breakpoints(messages, history_len),
+                    )
+                    if stream:
+                        return stream_claude(request, on_tool_block)
+                    return client.messages.create(**request)
+                except anthropic.APIStatusError as e:
+                    if e.status_code in (529, 503, 500) and attempt < max_retries - 1:
+                        wait_time = (2 ** attempt) * 5  # 5s, 10s, 20s
+                        log(f"[AGENT] API error {e.status_code}, retrying in {wait_time}s...")
+                        tracer.count("claude.retries")
+                        with tracer.span("claude.backoff", status=e.status_code, seconds=wait_time):
+                            if cancel.wait(wait_time):
+                                raise AgentCancelled()
+                    else:
+                        raise
+
+        def run_api_tool(tool: dict, block) -> str:
+            """Call the API and summarise a large response (runs on the tool pool)."""
+            with tracer.span("api_tool", tool=block.name, method=tool["_meta"]["method"]):
+                raw_result = execute_api_tool(tool, block.input, api_base_url, log, cancel.event, tracer)
+                # Use Haiku to summarize large API responses
+                if len(raw_result) > SUMMARY_THRESHOLD:
+                    with tracer.span("summary", chars=len(raw_result)):
+                        return summarize_api_result(client, raw_result, block.name, block.input, log, record_usage, tracer)
+                return raw_result
+
+        def tool_result(future) -> str:
+            """Wait for a tool call, giving up early if the run is cancelled."""
+            while not wait_futures([future], timeout=CANCEL_POLL_INTERVAL).done:
+                cancel.check()
+            return future.result()
+
+        try:
+            while turns < max_turns:
+                cancel.check()
+
+                turns += 1
+                with tracer.span("turn", turn=turns):
+                    log(f"[AGENT] Turn {turns}")
+
+                    # GET calls start while Claude is still writing the rest of the turn.
+                    # Writes wait for the full response, as a retried stream would repeat them.
+                    early_calls = {}
+
+                    def start_early(block) -> None:
+                        tool = tool_lookup.get(block.name)
+                        if tool and tool["_meta"]["method"] == "get" and block.id not in early_calls:
+                            early_calls[block.id] = tool_pool.submit(tracer.bind(run_api_tool), tool, block)
+
+                    with tracer.span("claude", model=model, tools=len(tool_selection.claude_tools())) as claude_span:
+                        response = call_claude_with_retry(on_tool_block=start_early)
+
+                    # Track token usage
+                    record_usage(model, response.usage)
+                    cache_read = getattr(response.usage, "cache_read_input_tokens", 0) or 0
+                    cache_creation = getattr(response.usage, "cache_creation_input_tokens", 0) or 0
+                    claude_span.set(
+                        input_tokens=response.usage.input_tokens,
+                        output_tokens=response.usage.output_tokens,
+                        cache_read_tokens=cache_read,
+                        cache_creation_tokens=cache_creation,
+                        stop_reason=response.stop_reason,
+                    )
+                    total_input_tokens += response.usage.input_tokens
+                    total_output_tokens += response.usage.output_tokens
+                    total_cache_read_tokens += cache_read
+                    total_cache_creation_tokens += cache_creation
+                    prompt_tokens = response.usage.input_tokens + cache_read + cache_creation
+                    hit_ratio = cache_read / prompt_tokens if prompt_tokens else 0
+                    log(f"[CACHE] Turn {turns}: {cache_read} read, {cache_creation} written, {response.usage.input_tokens} uncached ({hit_ratio:.0%} from cache)")
+
+                    log(f"[AGENT] Stop reason: {response.stop_reason}")
+
+                    assistant_content = []
+                    tool_results = []
+                    tool_blocks = []
+                    # API calls start immediately and run concurrently, keyed by tool_use id
+                    pending_api_calls = {}
+
+                    for block in response.content:
+                        if block.type == "text":
+                            log(f"[ASSISTANT] {block.text[:500]}")
+                            assistant_content.append(block)
+                            final_response = block.text
+                        elif block.type == "tool_use":
+                            log(f"[TOOL_USE] {block.name}: {json.dumps(block.input)[:200]}")
+                            tool_blocks.append(block)
+                            # For artifacts, don't store full HTML in history (saves tokens)
+                            if block.name == "create_artifact":
+                                truncated_block = type(block)(
+                                    type="tool_use",
+                                    id=block.id,
+                                    name=block.name,
+                                    input={
+                                        "title": block.input.get("title", ""),
+                                        "type": block.input.get("type", "html"),
+                                        "content": "[HTML content stored separately]",
+                                    }
+                                )
+                                assistant_content.append(truncated_block)
+                            else:
+                                assistant_content.append(block)
+
+                            tool = tool_lookup.get(block.name)
+                            if tool:
+                                pending_api_calls[block.id] = (
+                                    early_calls.get(block.id) or tool_pool.submit(tracer.bind(run_api_tool), tool, block)
+                                )
+
+                    # Collect results in tool_use order so they line up with the ids
+                    for block in tool_blocks:
+                        if block.name == "sleep":
+                            seconds = min(max(block.input.get("seconds", 5), 1), 60)
+                            log(f"[SLEEP] Waiting {seconds} seconds...")
+                            with tracer.span("sleep", seconds=seconds):
+                                if cancel.wait(seconds):
+                                    raise AgentCancelled()
+                            result = f"Slept for {seconds} seconds"
+                        elif block.name == "expand_tools":
+                            added = tool_selection.expand(block.input.get("query", ""), block.input.get("all", False))
+                            if added:
+                                log(f"[TOOLS] Expanded with {', '.join(added)}, now {tool_selection.describe()}")
+                                result = f"Loaded {len(added)} more tools, available from your next turn: {', '.join(added)}"
+                            elif tool_selection.complete:
+                                result = "All API tools are already loaded."
+                            else:
+                                result = "No unloaded tools match that description. Try different wording, or set all to true."
+                        elif block.name == "create_artifact":
+                            # Only allow ONE artifact per agent run
+                            if artifact_created:
+                                log(f"[ARTIFACT] Rejected - already created one this run")
+                                result = "ERROR: You already created an artifact. Do NOT create another. Provide your final text response now."
+                            else:
+                                title = block.input.get("title", "Untitled")
+                                artifact_type = block.input.get("type", "html")
+                                content = block.input.get("content", "")
+                                dependencies = block.input.get("dependencies", [])
+                                log(f"[ARTIFACT] Creating: {title} (type: {artifact_type})")
+                                try:
+                                    with tracer.span("db.insert_artifact", type=artifact_type, chars=len(content)):
+                                        artifact_data = supabase.table("artifacts").insert({
+                                            "thread_id": thread_id,
+                                            "type": artifact_type,
+                                            "title": title,
+                                            "content": content,
+                                            "dependencies": dependencies,
+                                        }).execute()
+                                    artifact_id = artifact_data.data[0]["id"]
+                                    artifact_created = True
+                                    if artifact_type in ARTIFACT_BUILT_TYPES:
+                                        # Build now so the first view is served from cache
+                                        try:
+                                            prebuild_artifact.spawn(artifact_id)
+                                        except Exception as e:
+                                            print(f"Failed to spawn artifact prebuild: {e}")
+                                    artifact_url = f"https://nikhilwoodruff--policyengine-chat-agent-serve-artifact.modal.run?id={artifact_id}"
+                                    result = f"Artifact successfully created and displayed to user. Title: {title}. Do NOT create another artifact - provide your final text response summarizing the results."
+                                    log(f"[ARTIFACT] Created with ID: {artifact_id}")
+                                except Exception as e:
+                                    result = f"Failed to create artifact: {str(e)}"
+                                    log(f"[ARTIFACT] Error: {str(e)}")
+                        elif block.id in pending_api_calls:
+                            with tracer.span("tool_wait", tool=block.name):
+                                result = tool_result(pending_api_calls[block.id])
+                        else:
+                            result = f"Unknown tool: {block.name}"
+
+                        log(f"[TOOL_RESULT] {result[:2000]}")
+                        emit({"type": "tool_result", "tool_use_id": block.id, "name": block.name, "content": result})
+
+                        tool_results.append({
+                            "type": "tool_result",
+                            "tool_use_id": block.id,
+                            "content": result,
+                        })
+
+                    messages.append({"role": "assistant", "content": assistant_content})
+
+                    if tool_results:
+                        messages.append({"role": "user", "content": tool_results})
+                        with tracer.span("compact_context"):
+                            context.compact(log)
+                    else:
+                        break
+        except AgentCancelled:
+            log("[AGENT] Cancelled by user")
+            final_response = "Cancelled by user."
+            status = "cancelled"
+
+        total_prompt_tokens = total_input_tokens + total_cache_read_tokens + total_cache_creation_tokens
+        if total_prompt_tokens:
+            log(f"[CACHE] Prompt cache hit ratio for run: {total_cache_read_tokens / total_prompt_tokens:.0%}")
+        api_cache = {k: v - api_cache_start[k] for k, v in _response_cache.snapshot().items()}
+        api_lookups = api_cache["hits"] + api_cache["misses"]
+        api_hit_rate = (api_cache["hits"] + api_cache["revalidated"]) / api_lookups if api_lookups else 0
+        log(f"[AGENT] Completed in {turns} turns, {total_input_tokens} input tokens, {total_output_tokens} output tokens, {total_cache_read_tokens} cache read, {total_cache_creation_tokens} cache created, API cache {api_cache['hits']} hits/{api_cache['revalidated']} revalidated/{api_cache['misses']} misses ({api_hit_rate:.0%} hit rate)")
+        # Readers wait for the completion line, so don't leave it sitting in the batch
+        with tracer.span("db.flush_logs"):
+            log_writer.flush()
+
+        with tracer.span("db.finish_run"):
+            finish_run(
+                supabase,
+                run_id,
+                status,
+                turns=turns,
+                input_tokens=total_input_tokens,
+                output_tokens=total_output_tokens,
+                cache_read_tokens=total_cache_read_tokens,
+                cache_creation_tokens=total_cache_creation_tokens,
+                cost_usd=round(usage_cost(model_usage), 6),
+                model_usage=model_usage,
+                duration_ms=int((time.perf_counter() - run_started) * 1000),
+            )
+
+        # Save the assistant message to Supabase with tool logs and the run's timings
+        if final_response:
+            timings = tracer.summary()
+            try:
+                with tracer.span("db.insert_message"):
+                    supabase.table("messages").insert({
+                        "thread_id": thread_id,
+                        "run_id": run_id,
+                        "role": "assistant",
+                        "content": final_response,
+                        "tool_logs": collected_logs,
+                        "timings": timings,
+                    }).execute()
+            except Exception as e:
+                print(f"Failed to save message: {e}")
+            emit({"type": "result", "content": final_response})
+
+        finalize_args = (thread_id, run_id, question, final_response, model_usage)
+        with tracer.span("finalize"):
+            try:
+                finalize_run.spawn(*finalize_args)
+            except Exception as e:
+                print(f"Failed to spawn finalize_run: {e}")
+                log("[AGENT] Finalizing in-process")
+                finalize_inline(supabase, client, *finalize_args, log_fn=log)
+
+        emit({"type": "done", "turns": turns, "run_id": run_id})
+        return {
+            "status": status,
+            "run_id": run_id,
+            "answer": final_response,
+            "turns": turns,
+        }
+    except Exception as e:
+        log(f"[AGENT] Failed: {e}")
+        tracer.root.set(error=type(e).__name__)
+        with tracer.span("db.finish_run"):
+            finish_run(
+                supabase,
+                run_id,
+                "failed",
+                error=str(e)[:1000],
+                duration_ms=int((time.perf_counter() - run_started) * 1000),
+            )
+        raise
+    finally:
+        cancel.close()
+        # Queued tool calls are dropped; running ones stop at their next cancel check
+        tool_pool.shutdown(wait=False, cancel_futures=True)
+        # Everything logged must reach Supabase, including on errors and cancellation
+        log_writer.close()
+        tracer.close()
+
+
+@app.cls(
+    image=image,
+    secrets=[anthropic_secret, supabase_secret, logfire_secret],
+    volumes={CACHE_MOUNT: cache_volume},
+    timeout=600,
+    concurrency_limit=AGENT_MAX_CONCURRENCY,
+    keep_warm=AGENT_KEEP_WARM,
+    container_idle_timeout=AGENT_IDLE_TIMEOUT,
+)
+class Agent:
+    """Agent container. Clients, HTTP pools and the tool cache live as long as the container."""
+
+    @modal.enter()
+    def setup(self) -> None:
+        phases = {}
+        start = time.perf_counter()
+        import anthropic  # noqa: F401
+        import logfire  # noqa: F401
+        import supabase  # noqa: F401
+        phases["imports"] = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        self.supabase, self.client = create_clients()
+        phases["clients"] = (time.perf_counter() - start) * 1000
+
+        # Pre-warm the spec and tool cache for the default API
+        start = time.perf_counter()
+        try:
+            load_tools(DEFAULT_API_BASE_URL, print)
+        except Exception as e:
+            print(f"Failed to pre-warm tools: {e}")
+        get_http_session()
+        phases["tools"] = (time.perf_counter() - start) * 1000
+
+        self.phases = phases
+        self.runs = 0
+        self.ready_at = time.time()
+        print(f"[STARTUP] Container ready: {describe_startup({'cold': True, 'phases': phases})}")
+
+    def _startup(self, requested_at: float | None) -> dict:
+        """How warm this container was for a run requested at requested_at (epoch seconds).
+
+        A run is cold only if it was requested before setup finished, so a
+        keep_warm container's first run counts as warm. Without a request
+        time, a first run that starts right after setup is taken as cold.
+        """
+        self.runs += 1
+        if requested_at is not None:
+            cold = requested_at < self.ready_at
+        else:
+            cold = self.runs == 1 and time.time() - self.ready_at < COLD_START_GRACE_SECONDS
+        return {
+            "cold": cold,
+            "run": self.runs,
+            "uptime_s": time.monotonic() - CONTAINER_STARTED_AT,
+            "phases": self.phases,
+        }
+
+    @modal.method()
+    def run(self, question: str, thread_id: str, requested_at: float | None = None, **kwargs) -> dict:
+        """Run the agent (see run_agent for arguments)."""
+        return run_agent(
+            question,
+            thread_id,
+            supabase=self.supabase,
+            client=self.client,
+            startup=self._startup(requested_at),
+            **kwargs,
+        )
+
+    @modal.method()
+    def stream(self, question: str, thread_id: str, requested_at: float | None = None, **kwargs):
+        """Run the agent, yielding its events as they happen (call with .remote_gen)."""
+        events: queue.Queue = queue.Queue()
+        startup = self._startup(requested_at)
+
+        def run() -> None:
+            try:
+                run_agent(
+                    question,
+                    thread_id,
+                    supabase=self.supabase,
+                    client=self.client,
+                    startup=startup,
+                    on_event=events.put,
+                    **kwargs,
+                )
+            except Exception as e:
+                events.put({"type": "error", "message": str(e)})
+                events.put({"type": "done"})
+
+        threading.Thread(target=run, daemon=True).start()
+        while True:
+            event = events.get()
+            yield event
+            if event["type"] == "done":
+                return
 
 
 from fastapi import Request
@@ -825,75 +3228,392 @@ from pydantic import BaseModel
 class AgentRequest(BaseModel):
     question: str
     thread_id: str
-    api_base_url: str = "https://v2.api.policyengine.org"
+    api_base_url: str = DEFAULT_API_BASE_URL
     history: list[dict] | None = None
     user_id: str | None = None
     model: str = "claude-sonnet-4-5"
 
 
-@app.function(image=image, secrets=[anthropic_secret, supabase_secret, logfire_secret], timeout=600)
+def admit_agent_run(request: AgentRequest):
+    """Check admission for a run and queue its agent_runs row.
+
+    Admission is checked atomically in Postgres against per-user and global
+    limits. Returns (supabase, admission, None) when admitted, or
+    (supabase, admission, response) with the 429 or 503 to send back.
+    """
+    from fastapi.responses import JSONResponse
+    from supabase import create_client
+
+    supabase = create_client(os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_KEY"])
+
+    try:
+        admission = supabase.rpc("enqueue_agent_run", {
+            "p_thread_id": request.thread_id,
+            "p_user_id": request.user_id,
+            "p_model": request.model,
+            "p_question": request.question,
+            "p_max_active": AGENT_MAX_CONCURRENCY,
+            "p_max_queued": AGENT_MAX_QUEUED,
+            "p_max_per_user": AGENT_MAX_RUNS_PER_USER,
+            "p_stale_after_seconds": AGENT_STALE_RUN_SECONDS,
+        }).execute().data
+    except Exception as e:
+        response = JSONResponse({"status": "error", "message": f"Failed to queue run: {e}"}, status_code=503)
+        return supabase, {}, response
+
+    if not admission.get("admitted"):
+        print(f"[QUEUE] Rejected run for thread {request.thread_id}: {admission.get('reason')}")
+        response = JSONResponse(
+            {"status": "rejected", **admission},
+            status_code=429,
+            headers={"Retry-After": "10"},
+        )
+        return supabase, admission, response
+    return supabase, admission, None
+
+
+@app.function(image=image, secrets=[supabase_secret], timeout=600)
 @modal.web_endpoint(method="POST")
-def run_agent_web(request: AgentRequest) -> dict:
-    """Web endpoint wrapper for run_agent."""
-    return run_agent.local(
-        question=request.question,
-        thread_id=request.thread_id,
-        api_base_url=request.api_base_url,
-        history=request.history,
-        user_id=request.user_id,
-        model=request.model,
+def run_agent_web(request: AgentRequest):
+    """Web endpoint wrapper for run_agent, run on a warm Agent container once admitted."""
+    requested_at = time.time()
+    supabase, admission, rejected = admit_agent_run(request)
+    if rejected:
+        return rejected
+
+    run_id = admission["run_id"]
+    try:
+        return Agent().run.remote(
+            question=request.question,
+            thread_id=request.thread_id,
+            api_base_url=request.api_base_url,
+            history=request.history,
+            user_id=request.user_id,
+            model=request.model,
+            run_id=run_id,
+            requested_at=requested_at,
+        )
+    except Exception as e:
+        # Usually already recorded by the run itself; this covers failing to start
+        finish_run(supabase, run_id, "failed", error=str(e)[:1000])
+        raise
+
+
+@app.function(image=image, secrets=[supabase_secret], timeout=600)
+@modal.web_endpoint(method="POST")
+def run_agent_stream(request: AgentRequest):
+    """Streaming web endpoint: runs the agent and pushes its events as server-sent events.
+
+    Event types: run (first, with the run_id), log, delta, tool_result, result,
+    error and done. Supabase still gets the durable logs and message, but
+    callers don't need to poll it.
+    Runs go through the same admission check as enqueue_agent; a rejected run
+    gets a 429 instead of a stream.
+    """
+    from fastapi.responses import StreamingResponse
+
+    requested_at = time.time()
+    supabase, admission, rejected = admit_agent_run(request)
+    if rejected:
+        return rejected
+
+    run_id = admission["run_id"]
+    events: queue.Queue = queue.Queue()
+
+    def run() -> None:
+        try:
+            for event in Agent().stream.remote_gen(
+                question=request.question,
+                thread_id=request.thread_id,
+                api_base_url=request.api_base_url,
+                history=request.history,
+                user_id=request.user_id,
+                model=request.model,
+                run_id=run_id,
+                requested_at=requested_at,
+            ):
+                events.put(event)
+        except Exception as e:
+            finish_run(supabase, run_id, "failed", error=str(e)[:1000])
+            events.put({"type": "error", "message": str(e)})
+            events.put({"type": "done"})
+
+    threading.Thread(target=run, daemon=True).start()
+
+    def event_stream():
+        while True:
+            try:
+                event = events.get(timeout=15)
+            except queue.Empty:
+                # SSE comment keeps proxies from closing an idle connection
+                yield ": keep-alive\n\n"
+                continue
+            yield f"data: {json.dumps(event)}\n\n"
+            if event["type"] == "done":
+                return
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
     )
 
 
-@app.function(image=artifact_image, secrets=[supabase_secret], timeout=120)
+@app.function(image=image, secrets=[supabase_secret], timeout=30)
+@modal.web_endpoint(method="POST")
+def enqueue_agent(request: AgentRequest):
+    """Queue a run and return its id straight away; progress arrives via agent_runs and agent_logs.
+
+    Rejected requests get a 429 with the reason and a Retry-After (see admit_agent_run).
+    """
+    from fastapi.responses import JSONResponse
+
+    requested_at = time.time()
+    supabase, admission, rejected = admit_agent_run(request)
+    if rejected:
+        return rejected
+
+    run_id = admission["run_id"]
+    try:
+        call = Agent().run.spawn(
+            question=request.question,
+            thread_id=request.thread_id,
+            api_base_url=request.api_base_url,
+            history=request.history,
+            user_id=request.user_id,
+            model=request.model,
+            run_id=run_id,
+            requested_at=requested_at,
+        )
+    except Exception as e:
+        finish_run(supabase, run_id, "failed", error=f"Failed to start: {e}"[:1000])
+        return JSONResponse({"status": "error", "run_id": run_id, "message": str(e)}, status_code=503)
+
+    print(f"[QUEUE] Queued run {run_id} at position {admission['queue_position']} ({admission['active']} active)")
+    return {
+        "status": "queued",
+        "run_id": run_id,
+        "call_id": call.object_id,
+        "queue_position": admission["queue_position"],
+    }
+
+
+@app.function(image=image, secrets=[supabase_secret], timeout=30)
 @modal.web_endpoint(method="GET")
-def serve_artifact(id: str):
-    """Serve an artifact's content, building with bun if needed."""
-    import os
-    import subprocess
-    import tempfile
-    from fastapi.responses import HTMLResponse, PlainTextResponse
+def agent_queue_stats() -> dict:
+    """Queue depth, running runs and recent queue wait times, with the configured limits."""
     from supabase import create_client
 
-    supabase_url = os.environ["SUPABASE_URL"]
-    supabase_key = os.environ["SUPABASE_SERVICE_KEY"]
-    supabase = create_client(supabase_url, supabase_key)
+    supabase = create_client(os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_KEY"])
+    stats = supabase.rpc("agent_queue_stats", {
+        "p_window_seconds": QUEUE_STATS_WINDOW_SECONDS,
+        "p_stale_after_seconds": AGENT_STALE_RUN_SECONDS,
+    }).execute().data
+    return {
+        **stats,
+        "max_concurrency": AGENT_MAX_CONCURRENCY,
+        "max_queued": AGENT_MAX_QUEUED,
+        "max_runs_per_user": AGENT_MAX_RUNS_PER_USER,
+        "window_seconds": QUEUE_STATS_WINDOW_SECONDS,
+    }
 
-    csp_headers = {
-        "Content-Security-Policy": "default-src * 'unsafe-inline' 'unsafe-eval' data: blob:;",
-        "X-Frame-Options": "ALLOWALL",
+
+BENCHMARK_QUESTIONS = (
+    "What is the UK personal allowance amount?",
+    "How much tax would a single earner on £50,000 pay in the UK?",
+    "What would raising the basic rate of income tax to 21% cost, and who would be affected?",
+    "Which datasets are available for US microsimulation?",
+    "Compare child benefit for a family with two children before and after abolishing the two-child limit.",
+)
+
+
+@app.function(image=image, secrets=[anthropic_secret], volumes={CACHE_MOUNT: cache_volume}, timeout=900)
+def benchmark_tool_subsets(
+    questions: str = "",
+    api_base_url: str = DEFAULT_API_BASE_URL,
+    model: str = "claude-opus-4-5",
+    measure_latency: bool = True,
+) -> list[dict]:
+    """Compare the relevance-ranked tool subset against the full tool list.
+
+    For each question (separated by "|", defaulting to BENCHMARK_QUESTIONS)
+    counts prompt tokens with count_tokens and, with measure_latency, times the
+    first streamed token. Prompt caching is left off so both sides pay full
+    price. Run with `modal run agent.py::benchmark_tool_subsets`.
+    """
+    import anthropic
+
+    client = anthropic.Anthropic()
+    tools = load_tools(api_base_url, print)
+    results = []
+
+    def time_to_first_token(request: dict) -> float:
+        start = time.perf_counter()
+        with client.messages.stream(max_tokens=1, **request) as claude_stream:
+            for event in claude_stream:
+                if event.type in ("content_block_start", "content_block_delta"):
+                    break
+        return (time.perf_counter() - start) * 1000
+
+    for question in (questions.split("|") if questions else BENCHMARK_QUESTIONS):
+        selection = ToolSelection(tools, question, enabled=True)
+        row = {"question": question, "subset": sorted(selection.active)}
+        for variant, variant_tools in (("full", tools["cached_tools"]), ("subset", selection.claude_tools())):
+            request = dict(
+                model=model,
+                system=system_prompt(variant == "subset" and selection.expandable),
+                tools=[{k: v for k, v in t.items() if k != "cache_control"} for t in variant_tools],
+                messages=[{"role": "user", "content": question}],
+            )
+            row[f"{variant}_tools"] = len(variant_tools)
+            row[f"{variant}_tokens"] = client.messages.count_tokens(**request).input_tokens
+            if measure_latency:
+                row[f"{variant}_ttft_ms"] = round(time_to_first_token(request))
+        line = f"[BENCHMARK] {question[:60]}: tools {row['full_tools']} -> {row['subset_tools']}, tokens {row['full_tokens']} -> {row['subset_tokens']}"
+        if measure_latency:
+            line += f", first token {row['full_ttft_ms']}ms -> {row['subset_ttft_ms']}ms"
+        print(line)
+        results.append(row)
+
+    saved = sum(r["full_tokens"] - r["subset_tokens"] for r in results)
+    total = sum(r["full_tokens"] for r in results)
+    print(f"[BENCHMARK] Subsets saved {saved} of {total} prompt tokens ({saved / max(total, 1):.0%})")
+    return results
+
+
+class ArtifactBuildError(Exception):
+    """A react or script artifact failed to build or run."""
+
+
+def artifact_build_key(content: str, artifact_type: str, dependencies: list) -> str:
+    """Cache key for built artifact output: content hash plus the dependency set."""
+    payload = json.dumps([ARTIFACT_BUILD_VERSION, artifact_type, sorted(dependencies), content])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def dependency_set(artifact_type: str, dependencies: list) -> dict:
+    """package.json dependencies for an artifact."""
+    package_deps = {dep: "*" for dep in sorted(dependencies)}
+    if artifact_type == "react":
+        package_deps = {"react": "^18", "react-dom": "^18", **package_deps}
+    return package_deps
+
+
+def bun_env(home: str, cache_dir: str = ARTIFACT_BUN_CACHE_DIR) -> dict:
+    """Minimal environment for bun: no secrets, and the given package cache."""
+    return {
+        "PATH": os.environ.get("PATH", "/usr/bin:/bin"),
+        "HOME": home,
+        "BUN_INSTALL_CACHE_DIR": cache_dir,
     }
 
-    try:
-        result = supabase.table("artifacts").select("content, title, type, dependencies").eq("id", id).single().execute()
-        if not result.data:
-            return PlainTextResponse("Artifact not found", status_code=404)
 
-        content = result.data["content"]
-        artifact_type = result.data.get("type", "html")
-        dependencies = result.data.get("dependencies") or []
+def artifact_run_user() -> dict:
+    """subprocess kwargs that drop to ARTIFACT_RUN_USER when running as root (as in Modal)."""
+    if not hasattr(os, "geteuid") or os.geteuid() != 0:
+        return {}
+    import pwd
 
-        # Static HTML - serve directly
-        if artifact_type == "html":
-            return HTMLResponse(content=content, headers=csp_headers)
+    user = pwd.getpwnam(ARTIFACT_RUN_USER)
+    return {"user": user.pw_uid, "group": user.pw_gid, "extra_groups": []}
 
-        # React or script - build with bun
-        with tempfile.TemporaryDirectory() as tmpdir:
-            if artifact_type == "react":
-                # Create package.json
-                pkg = {
-                    "name": "artifact",
-                    "type": "module",
-                    "dependencies": {
-                        "react": "^18",
-                        "react-dom": "^18",
-                        **{dep: "*" for dep in dependencies}
-                    }
-                }
-                with open(f"{tmpdir}/package.json", "w") as f:
-                    import json
-                    json.dump(pkg, f)
 
+_deps_locks: dict[str, threading.Lock] = {}
+_deps_locks_guard = threading.Lock()
+
+
+def prepare_dependencies(package_deps: dict) -> tuple[str, str, float]:
+    """Directory with node_modules installed for a dependency set.
+
+    Installs once per container per dependency set. The first install anywhere
+    resolves versions and pins the lockfile on the cache volume; later installs
+    use that lockfile with --frozen-lockfile, so every build of a dependency
+    set gets the same versions.
+
+    Returns (deps_dir, source, install_ms) where source is warm (already
+    installed in this container), lockfile, resolved or none.
+    """
+    import shutil
+    import subprocess
+
+    key = hashlib.sha256(json.dumps(package_deps, sort_keys=True).encode()).hexdigest()[:32]
+    deps_dir = os.path.join(ARTIFACT_DEPS_DIR, key)
+    with _deps_locks_guard:
+        lock = _deps_locks.setdefault(key, threading.Lock())
+
+    with lock:
+        marker = os.path.join(deps_dir, ".installed")
+        if os.path.exists(marker):
+            return deps_dir, "warm", 0.0
+        os.makedirs(deps_dir, exist_ok=True)
+        if not package_deps:
+            open(marker, "w").close()
+            return deps_dir, "none", 0.0
+
+        with open(os.path.join(deps_dir, "package.json"), "w") as f:
+            json.dump({"name": "artifact", "type": "module", "dependencies": package_deps}, f)
+
+        lock_dir = os.path.join(ARTIFACT_LOCK_DIR, key)
+        pinned = [name for name in BUN_LOCKFILES if os.path.exists(os.path.join(lock_dir, name))]
+        for name in pinned:
+            shutil.copy(os.path.join(lock_dir, name), deps_dir)
+
+        start = time.perf_counter()
+        try:
+            subprocess.run(
+                ["bun", "install", *(["--frozen-lockfile"] if pinned else [])],
+                cwd=deps_dir, check=True, capture_output=True, text=True, env=bun_env(deps_dir),
+            )
+        except subprocess.CalledProcessError as e:
+            raise ArtifactBuildError(f"Install error: {e.stderr}")
+        install_ms = (time.perf_counter() - start) * 1000
+
+        if not pinned:
+            try:
+                os.makedirs(lock_dir, exist_ok=True)
+                for name in BUN_LOCKFILES:
+                    if os.path.exists(os.path.join(deps_dir, name)):
+                        shutil.copy(os.path.join(deps_dir, name), lock_dir)
+                if not modal.is_local():
+                    artifact_build_volume.commit()
+            except Exception as e:
+                print(f"Failed to pin lockfile: {e}")
+
+        open(marker, "w").close()
+        return deps_dir, "lockfile" if pinned else "resolved", install_ms
+
+
+def build_artifact(content: str, artifact_type: str, dependencies: list) -> tuple[str, dict]:
+    """Build a react or script artifact with bun and return (html, metrics).
+
+    The artifact's code (a script, or bun macros in a react build) runs in a
+    throwaway copy of the dependency set, as an unprivileged user with a
+    private package cache, so it has no write path to the shared node_modules,
+    the builder's volume or later builds.
+    """
+    import shutil
+    import subprocess
+    import tempfile
+
+    if artifact_type not in ARTIFACT_BUILT_TYPES:
+        raise ArtifactBuildError(f"Unknown artifact type: {artifact_type}")
+
+    start = time.perf_counter()
+    deps_dir, dependency_cache, install_ms = prepare_dependencies(dependency_set(artifact_type, dependencies))
+
+    os.makedirs(ARTIFACT_BUILDS_DIR, exist_ok=True)
+    run_as = artifact_run_user()
+    try:
+        with tempfile.TemporaryDirectory(dir=ARTIFACT_BUILDS_DIR) as build_dir:
+            # Module resolution finds the copied node_modules one level up
+            shutil.copytree(deps_dir, build_dir, symlinks=True, dirs_exist_ok=True)
+            tmpdir = os.path.join(build_dir, "src")
+            os.makedirs(tmpdir)
+            if run_as:
+                for path in (build_dir, tmpdir):
+                    os.chown(path, run_as["user"], run_as["group"])
+            env = bun_env(tmpdir, cache_dir=os.path.join(tmpdir, ".bun-cache"))
+            if artifact_type == "react":
                 # Write App component
                 with open(f"{tmpdir}/App.tsx", "w") as f:
                     f.write(content)
@@ -908,14 +3628,13 @@ createRoot(document.getElementById("root")!).render(<App />);
                 with open(f"{tmpdir}/index.tsx", "w") as f:
                     f.write(entry)
 
-                # Install deps and build
-                subprocess.run(["bun", "install"], cwd=tmpdir, check=True, capture_output=True)
                 result = subprocess.run(
                     ["bun", "build", "index.tsx", "--outfile=bundle.js"],
-                    cwd=tmpdir, capture_output=True, text=True
+                    cwd=tmpdir, capture_output=True, text=True, env=env,
+                    timeout=ARTIFACT_SCRIPT_TIMEOUT, **run_as,
                 )
                 if result.returncode != 0:
-                    return PlainTextResponse(f"Build error: {result.stderr}", status_code=500)
+                    raise ArtifactBuildError(f"Build error: {result.stderr}")
 
                 with open(f"{tmpdir}/bundle.js") as f:
                     bundle = f.read()
@@ -924,37 +3643,234 @@ createRoot(document.getElementById("root")!).render(<App />);
 <html><head><meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1">
 <style>*{{margin:0;padding:0;box-sizing:border-box}}body{{font-family:system-ui,sans-serif}}</style>
 </head><body><div id="root"></div><script>{bundle}</script></body></html>'''
-                return HTMLResponse(content=html, headers=csp_headers)
-
-            elif artifact_type == "script":
-                # Create package.json if deps
-                if dependencies:
-                    pkg = {"name": "artifact", "type": "module", "dependencies": {dep: "*" for dep in dependencies}}
-                    with open(f"{tmpdir}/package.json", "w") as f:
-                        import json
-                        json.dump(pkg, f)
-                    subprocess.run(["bun", "install"], cwd=tmpdir, check=True, capture_output=True)
-
-                # Write and run script
+
+            else:
+                # Write and run script; its output is the HTML
                 ext = ".ts" if "typescript" in str(dependencies).lower() else ".js"
                 with open(f"{tmpdir}/script{ext}", "w") as f:
                     f.write(content)
 
                 result = subprocess.run(
                     ["bun", f"script{ext}"],
-                    cwd=tmpdir, capture_output=True, text=True, timeout=30
+                    cwd=tmpdir, capture_output=True, text=True, env=env,
+                    timeout=ARTIFACT_SCRIPT_TIMEOUT, **run_as,
                 )
                 if result.returncode != 0:
-                    return PlainTextResponse(f"Script error: {result.stderr}", status_code=500)
+                    raise ArtifactBuildError(f"Script error: {result.stderr}")
+                html = result.stdout
+    except subprocess.TimeoutExpired:
+        raise ArtifactBuildError("Build timed out" if artifact_type == "react" else "Script timed out")
 
-                # Script output is the HTML
-                return HTMLResponse(content=result.stdout, headers=csp_headers)
+    return html, {
+        "dependency_cache": dependency_cache,
+        "install_ms": round(install_ms),
+        "build_ms": round((time.perf_counter() - start) * 1000),
+        "bundle_bytes": len(html.encode()),
+    }
 
-        return PlainTextResponse(f"Unknown artifact type: {artifact_type}", status_code=400)
-    except subprocess.TimeoutExpired:
-        return PlainTextResponse("Script timed out", status_code=500)
+
+@app.cls(
+    image=artifact_image,
+    volumes={ARTIFACT_BUILD_MOUNT: artifact_build_volume},
+    timeout=120,
+    concurrency_limit=ARTIFACT_MAX_CONCURRENT_BUILDS,
+    keep_warm=ARTIFACT_BUILDER_KEEP_WARM,
+    container_idle_timeout=AGENT_IDLE_TIMEOUT,
+)
+class ArtifactBuilder:
+    """Pool of bun build containers. They hold no secrets and mount only the bun cache volume."""
+
+    @modal.enter()
+    def setup(self) -> None:
+        # Most react artifacts need nothing beyond react itself
+        try:
+            _, source, install_ms = prepare_dependencies(dependency_set("react", []))
+            print(f"[ARTIFACT] Builder ready (react deps {source}, {install_ms:.0f}ms)")
+        except ArtifactBuildError as e:
+            print(f"[ARTIFACT] Failed to pre-install react: {e}")
+
+    @modal.method()
+    def build(self, content: str, artifact_type: str, dependencies: list) -> dict:
+        """Build an artifact, returning {html, metrics} or {error}."""
+        try:
+            html, metrics = build_artifact(content, artifact_type, dependencies)
+            return {"html": html, "metrics": metrics}
+        except ArtifactBuildError as e:
+            return {"error": str(e)}
+
+
+_artifact_cache = LRUCache(ARTIFACT_CACHE_MAX_BYTES)
+
+
+def _artifact_cache_path(key: str) -> str:
+    return os.path.join(ARTIFACT_CACHE_DIR, key[:2], f"{key}.html")
+
+
+def _read_artifact_file(key: str) -> str | None:
+    try:
+        with open(_artifact_cache_path(key)) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _write_artifact_file(key: str, html: str) -> None:
+    path = _artifact_cache_path(key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(html)
+        os.replace(tmp_path, path)
+        if not modal.is_local():
+            cache_volume.commit()
+    except Exception as e:
+        # The memory cache still works without the volume
+        print(f"Failed to persist artifact build: {e}")
+
+
+def get_built_artifact(content: str, artifact_type: str, dependencies: list) -> tuple[str, str, str, dict | None]:
+    """Built HTML for an artifact from memory, the cache volume or a fresh build.
+
+    Returns (key, html, source, metrics) where source is memory, volume or
+    build, and metrics is only set for a fresh build. Builds run on the
+    ArtifactBuilder pool (in-process when running locally). Failed builds
+    raise ArtifactBuildError and are not cached.
+    """
+    key = artifact_build_key(content, artifact_type, dependencies)
+    html = _artifact_cache.get(key)
+    if html is not None:
+        return key, html, "memory", None
+
+    html = _read_artifact_file(key)
+    if html is None and not modal.is_local():
+        # Another container may have built it since this one mounted the volume
+        try:
+            cache_volume.reload()
+        except Exception as e:
+            print(f"Failed to reload cache volume: {e}")
+        html = _read_artifact_file(key)
+
+    source = "volume"
+    metrics = None
+    if html is None:
+        if modal.is_local():
+            html, metrics = build_artifact(content, artifact_type, dependencies)
+        else:
+            result = ArtifactBuilder().build.remote(content, artifact_type, dependencies)
+            if "error" in result:
+                raise ArtifactBuildError(result["error"])
+            html, metrics = result["html"], result["metrics"]
+        _write_artifact_file(key, html)
+        source = "build"
+    _artifact_cache.set(key, html, len(html))
+    return key, html, source, metrics
+
+
+def record_artifact_build(supabase, artifact_id: str, key: str, metrics: dict | None = None, error: str | None = None) -> None:
+    """Store build metrics (or the build error) on the artifacts row."""
+    try:
+        supabase.table("artifacts").update({
+            "build_key": key,
+            "build_status": "failed" if error else "built",
+            "build_error": error[:2000] if error else None,
+            "built_at": datetime.now(timezone.utc).isoformat(),
+            **(metrics or {}),
+        }).eq("id", artifact_id).execute()
+    except Exception as e:
+        print(f"Failed to record artifact build: {e}")
+
+
+def build_and_record(supabase, artifact_id: str, content: str, artifact_type: str, dependencies: list) -> tuple[str, str]:
+    """get_built_artifact, recording metrics on the row when a build actually ran."""
+    key = artifact_build_key(content, artifact_type, dependencies)
+    try:
+        key, html, source, metrics = get_built_artifact(content, artifact_type, dependencies)
+    except ArtifactBuildError as e:
+        record_artifact_build(supabase, artifact_id, key, error=str(e))
+        raise
+    if metrics:
+        record_artifact_build(supabase, artifact_id, key, metrics)
+    return html, source
+
+
+@app.function(
+    image=image,
+    secrets=[supabase_secret],
+    volumes={CACHE_MOUNT: cache_volume},
+    timeout=180,
+)
+def prebuild_artifact(artifact_id: str) -> None:
+    """Build a new react/script artifact as soon as it is created, ahead of its first view."""
+    from supabase import create_client
+
+    supabase = create_client(os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_KEY"])
+    row = supabase.table("artifacts").select("content, type, dependencies").eq("id", artifact_id).single().execute().data
+    if not row or row.get("type") not in ARTIFACT_BUILT_TYPES:
+        return
+    try:
+        _, source = build_and_record(supabase, artifact_id, row["content"], row["type"], row.get("dependencies") or [])
+        print(f"[ARTIFACT] Prebuilt {artifact_id} ({source})")
+    except ArtifactBuildError as e:
+        # serve_artifact reports the error when the artifact is viewed
+        print(f"[ARTIFACT] Prebuild failed for {artifact_id}: {e}")
+
+
+@app.function(
+    image=image,
+    secrets=[supabase_secret],
+    volumes={CACHE_MOUNT: cache_volume},
+    timeout=180,
+)
+@modal.web_endpoint(method="GET")
+def serve_artifact(id: str, request: Request):
+    """Serve an artifact's content, building react/script artifacts once and caching the output.
+
+    Responses carry an ETag derived from the content hash and dependency set,
+    so browsers and CDNs can cache them and revalidate with If-None-Match.
+    """
+    from fastapi.responses import HTMLResponse, PlainTextResponse, Response
+    from supabase import create_client
+
+    supabase_url = os.environ["SUPABASE_URL"]
+    supabase_key = os.environ["SUPABASE_SERVICE_KEY"]
+    supabase = create_client(supabase_url, supabase_key)
+
+    csp_headers = {
+        "Content-Security-Policy": "default-src * 'unsafe-inline' 'unsafe-eval' data: blob:;",
+        "X-Frame-Options": "ALLOWALL",
+    }
+
+    try:
+        result = supabase.table("artifacts").select("content, title, type, dependencies").eq("id", id).single().execute()
+        if not result.data:
+            return PlainTextResponse("Artifact not found", status_code=404)
+
+        content = result.data["content"]
+        artifact_type = result.data.get("type", "html")
+        dependencies = result.data.get("dependencies") or []
+
+        if artifact_type != "html" and artifact_type not in ARTIFACT_BUILT_TYPES:
+            return PlainTextResponse(f"Unknown artifact type: {artifact_type}", status_code=400)
+
+        etag = f'"{artifact_build_key(content, artifact_type, dependencies)[:32]}"'
+        cache_headers = {**csp_headers, "ETag": etag, "Cache-Control": ARTIFACT_CACHE_CONTROL}
+        if etag in request.headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=cache_headers)
+
+        # Static HTML - serve directly
+        if artifact_type == "html":
+            return HTMLResponse(content=content, headers=cache_headers)
+
+        # React or script - built once per content and dependency set
+        try:
+            html, source = build_and_record(supabase, id, content, artifact_type, dependencies)
+        except ArtifactBuildError as e:
+            return PlainTextResponse(str(e), status_code=500, headers={"Cache-Control": "no-store"})
+        print(f"[ARTIFACT] Served {id} from {source}")
+        return HTMLResponse(content=html, headers=cache_headers)
     except Exception as e:
-        return PlainTextResponse(f"Error: {str(e)}", status_code=500)
+        return PlainTextResponse(f"Error: {str(e)}", status_code=500, headers={"Cache-Control": "no-store"})
 
 
 if __name__ == "__main__":
@@ -967,5 +3883,5 @@ if __name__ == "__main__":
     )
     print(f"Question: {question}\n")
     # For local testing, set env vars
-    result = run_agent.local(question, thread_id="test")
+    result = run_agent(question, thread_id="test")
     print(f"\nResult: {result}")
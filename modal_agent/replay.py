@@ -0,0 +1,675 @@
+"""Offline replay of the agent loop against recorded fixtures.
+
+Runs run_agent end to end (spec conversion, tool dispatch, summaries, logging
+and persistence) with recorded Claude responses, a fake Supabase client and a
+local HTTP stand-in for the PolicyEngine API, so runs are deterministic and
+need no credentials. Reports per-phase timings, database round trips and
+token accounting for each scenario.
+
+    python replay.py                          # every scenario in fixtures/replay
+    python replay.py reform_impact --repeat 3 --warm --json results.json
+
+A scenario fixture (fixtures/replay/<name>.json) holds the question, optional
+history, the API routes to serve and the recorded Claude turns:
+
+    {
+      "name": "...", "question": "...", "history": [...],
+      "routes": [{"method": "GET", "path": "/parameters/",
+                  "responses": [{"status": 200, "body": ..., "headers": {...}, "delay_ms": 100}]}],
+      "claude": [{"content": [...], "stop_reason": "tool_use", "usage": {...},
+                  "latency_ms": 2500, "ttft_ms": 900}],
+      "summary": "text returned for Haiku summaries",
+      "title": "text returned for title generation",
+      "expect": {"turns": 6, "compactions": 1}
+    }
+
+Route paths may contain {placeholders}; a route's responses are served in
+order and the last one repeats (for job polling). The OpenAPI spec served at
+/openapi.json is fixtures/replay/openapi.json unless a scenario sets "spec".
+Each "expect" entry is compared with the measured value of the same name and
+reported as a warning when they differ; --check exits non-zero on any warning.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# Replays never configure logfire, so its spans are no-ops
+os.environ.setdefault("LOGFIRE_IGNORE_NO_CONFIG", "1")
+
+import agent
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "replay")
+REPLAY_THREAD_ID = "replay-thread"
+REPLAY_MODEL = "claude-opus-4-5"
+
+# Agent functions timed as phases (their time is summed across threads)
+TIMED_PHASES = {
+    "load_tools": "tools_load",
+    "fetch_openapi_spec": "spec_fetch",
+    "openapi_to_claude_tools": "spec_convert",
+    "_make_tool_entry": "tools_index",
+    "execute_api_tool": "api_tools",
+    "summarize_api_result": "summaries",
+    "finalize_inline": "finalize",
+}
+
+
+class PhaseTimer:
+    """Accumulates wall time and call counts per phase, from any thread."""
+
+    def __init__(self):
+        self.ms: Counter = Counter()
+        self.calls: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, phase: str, ms: float) -> None:
+        with self._lock:
+            self.ms[phase] += ms
+            self.calls[phase] += 1
+
+    def wrap(self, phase: str, fn):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(phase, (time.perf_counter() - start) * 1000)
+        return timed
+
+
+# ---------------------------------------------------------------------------
+# Fake Supabase
+# ---------------------------------------------------------------------------
+
+
+class FakeQuery:
+    """The subset of the supabase-py query builder the agent uses."""
+
+    def __init__(self, db: "FakeSupabase", table: str):
+        self.db = db
+        self.table = table
+        self.op = "select"
+        self.payload = None
+        self.filters = []
+        self.order_by = None
+        self.limit_rows = None
+        self.single_row = False
+
+    def select(self, *args, **kwargs):
+        self.op = "select"
+        return self
+
+    def insert(self, payload):
+        self.op, self.payload = "insert", payload
+        return self
+
+    def upsert(self, payload, **kwargs):
+        self.op, self.payload = "insert", payload
+        return self
+
+    def update(self, payload):
+        self.op, self.payload = "update", payload
+        return self
+
+    def delete(self):
+        self.op = "delete"
+        return self
+
+    def eq(self, column, value):
+        self.filters.append((column, lambda v: v == value))
+        return self
+
+    def gt(self, column, value):
+        self.filters.append((column, lambda v: v is not None and v > value))
+        return self
+
+    def in_(self, column, values):
+        self.filters.append((column, lambda v: v in values))
+        return self
+
+    def order(self, column, desc: bool = False):
+        self.order_by = (column, desc)
+        return self
+
+    def limit(self, count: int):
+        self.limit_rows = count
+        return self
+
+    def single(self):
+        self.single_row = True
+        return self
+
+    maybe_single = single
+
+    def execute(self):
+        return self.db.execute(self)
+
+
+class FakeSupabase:
+    """In-memory tables that count and time every round trip."""
+
+    def __init__(self, round_trip_ms: float = 0.0):
+        self.round_trip_ms = round_trip_ms
+        self.tables: dict[str, list[dict]] = {}
+        self.round_trips: Counter = Counter()
+        self.rpcs: list[tuple[str, dict]] = []
+        self.elapsed_ms = 0.0
+        self._ids = Counter()
+        self._lock = threading.Lock()
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name)
+
+    def rpc(self, name: str, params: dict):
+        def execute():
+            self._round_trip(f"rpc.{name}")
+            with self._lock:
+                self.rpcs.append((name, params))
+            return SimpleNamespace(data=None)
+        return SimpleNamespace(execute=execute)
+
+    def _round_trip(self, key: str) -> None:
+        with self._lock:
+            self.round_trips[key] += 1
+            self.elapsed_ms += self.round_trip_ms
+        if self.round_trip_ms:
+            time.sleep(self.round_trip_ms / 1000)
+
+    def execute(self, query: FakeQuery):
+        self._round_trip(f"{query.table}.{query.op}")
+        with self._lock:
+            rows = self.tables.setdefault(query.table, [])
+            if query.op == "insert":
+                inserted = []
+                for row in query.payload if isinstance(query.payload, list) else [query.payload]:
+                    self._ids[query.table] += 1
+                    row = {"id": f"{query.table}-{self._ids[query.table]}", **row}
+                    rows.append(row)
+                    inserted.append(dict(row))
+                return SimpleNamespace(data=inserted)
+            matched = [r for r in rows if all(test(r.get(column)) for column, test in query.filters)]
+            if query.op == "update":
+                for row in matched:
+                    row.update(query.payload)
+            elif query.op == "delete":
+                for row in matched:
+                    rows.remove(row)
+            if query.order_by:
+                column, desc = query.order_by
+                matched.sort(key=lambda r: (r.get(column) is None, r.get(column)), reverse=desc)
+            if query.limit_rows is not None:
+                matched = matched[:query.limit_rows]
+            matched = [dict(r) for r in matched]
+        if query.single_row:
+            return SimpleNamespace(data=matched[0] if matched else None)
+        return SimpleNamespace(data=matched)
+
+
+# ---------------------------------------------------------------------------
+# Recorded Claude
+# ---------------------------------------------------------------------------
+
+
+def estimate_tokens(value) -> int:
+    return len(json.dumps(value, default=str)) // agent.CHARS_PER_TOKEN
+
+
+class RecordedStream:
+    """Replays a recorded message as streaming events."""
+
+    def __init__(self, message, ttft_s: float, rest_s: float, timer: PhaseTimer):
+        self.message = message
+        self.ttft_s = ttft_s
+        self.rest_s = rest_s
+        self.timer = timer
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __iter__(self):
+        start = time.perf_counter()
+        try:
+            yield from self._events()
+        finally:
+            self.timer.add("claude", (time.perf_counter() - start) * 1000)
+
+    def _events(self):
+        yield SimpleNamespace(type="message_start")
+        time.sleep(self.ttft_s)
+        blocks = self.message.content
+        for i, block in enumerate(blocks):
+            yield SimpleNamespace(type="content_block_start", index=i, content_block=block)
+            if block.type == "text":
+                chunks = [block.text[j:j + 40] for j in range(0, len(block.text), 40)] or [""]
+                for chunk in chunks:
+                    yield SimpleNamespace(type="content_block_delta", index=i, delta=SimpleNamespace(type="text_delta", text=chunk))
+            else:
+                yield SimpleNamespace(type="content_block_delta", index=i, delta=SimpleNamespace(type="input_json_delta", partial_json=""))
+            time.sleep(self.rest_s / len(blocks))
+            yield SimpleNamespace(type="content_block_stop", index=i, content_block=block)
+        yield SimpleNamespace(type="message_stop")
+
+    def get_final_message(self):
+        return self.message
+
+
+class RecordedMessages:
+    """messages.create/stream/count_tokens answered from a scenario's recordings.
+
+    Requests with tools are agent turns and get the recorded turns in order.
+    Tool-less requests are Haiku summaries (SUMMARY_MODEL) or title generation.
+    """
+
+    def __init__(self, scenario: dict, timer: PhaseTimer, replay_latency: bool):
+        self.turns = scenario["claude"]
+        self.summary = scenario.get("summary", "Summary of the API response.")
+        self.title = scenario.get("title", "Replayed conversation")
+        self.timer = timer
+        self.replay_latency = replay_latency
+        self.next_turn = 0
+        self.requests: list[dict] = []
+        self.warnings: list[str] = []
+        self._lock = threading.Lock()
+
+    def _respond(self, request: dict):
+        from anthropic.types import Message
+
+        model = request["model"]
+        record = {"model": model, "prompt_tokens_est": estimate_tokens(
+            [request.get("system"), request.get("tools"), request.get("messages")]
+        )}
+        if "tools" in request:
+            offered = {t["name"] for t in request["tools"]}
+            with self._lock:
+                index = self.next_turn
+                self.next_turn += 1
+            if index < len(self.turns):
+                turn = self.turns[index]
+            else:
+                self.warnings.append(f"Ran out of recorded turns at request {index + 1}")
+                turn = {"content": [{"type": "text", "text": "[replay] No more recorded turns."}], "stop_reason": "end_turn"}
+            for block in turn["content"]:
+                if block["type"] == "tool_use" and block["name"] not in offered:
+                    self.warnings.append(f"Turn {index + 1} calls {block['name']}, which was not offered")
+            record.update(kind="turn", tools=len(request["tools"]), tool_tokens_est=estimate_tokens(request["tools"]))
+        else:
+            kind = "summary" if model == agent.SUMMARY_MODEL else "title"
+            text = self.summary if kind == "summary" else self.title
+            turn = {"content": [{"type": "text", "text": text}], "stop_reason": "end_turn", "latency_ms": 600, "ttft_ms": 300}
+            record["kind"] = kind
+        usage = turn.get("usage") or {
+            "input_tokens": record["prompt_tokens_est"],
+            "output_tokens": estimate_tokens(turn["content"]),
+        }
+        record["usage"] = usage
+        with self._lock:
+            self.requests.append(record)
+        message = Message.model_validate({
+            "id": f"msg_replay_{len(self.requests)}",
+            "type": "message",
+            "role": "assistant",
+            "model": model,
+            "content": turn["content"],
+            "stop_reason": turn["stop_reason"],
+            "usage": usage,
+        })
+        latency_s = turn.get("latency_ms", 0) / 1000 if self.replay_latency else 0.0
+        ttft_s = min(turn.get("ttft_ms", 0) / 1000, latency_s) if self.replay_latency else 0.0
+        return message, ttft_s, latency_s - ttft_s
+
+    def create(self, **request):
+        start = time.perf_counter()
+        message, ttft_s, rest_s = self._respond(request)
+        time.sleep(ttft_s + rest_s)
+        self.timer.add("claude", (time.perf_counter() - start) * 1000)
+        return message
+
+    def stream(self, **request):
+        message, ttft_s, rest_s = self._respond(request)
+        return RecordedStream(message, ttft_s, rest_s, self.timer)
+
+    def count_tokens(self, **request):
+        return SimpleNamespace(input_tokens=estimate_tokens(
+            [request.get("system"), request.get("tools"), request.get("messages")]
+        ))
+
+
+class RecordedAnthropic:
+    def __init__(self, messages: RecordedMessages):
+        self.messages = messages
+
+
+# ---------------------------------------------------------------------------
+# PolicyEngine API stand-in
+# ---------------------------------------------------------------------------
+
+
+class ApiStandIn:
+    """Local HTTP server serving the spec and a scenario's recorded routes."""
+
+    def __init__(self):
+        self.spec_bytes = b"{}"
+        self.routes: list[dict] = []
+        self.requests: list[str] = []
+        self.unmatched: list[str] = []
+        self._lock = threading.Lock()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _handle(self, method: str):
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    self.rfile.read(length)
+                status, body, headers, delay_ms = stand_in.respond(method, self.path)
+                time.sleep(delay_ms / 1000)
+                payload = body if isinstance(body, bytes) else json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def do_PUT(self):
+                self._handle("PUT")
+
+            def do_PATCH(self):
+                self._handle("PATCH")
+
+            def do_DELETE(self):
+                self._handle("DELETE")
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def load(self, spec: dict, routes: list[dict]) -> None:
+        with self._lock:
+            self.spec_bytes = json.dumps(spec).encode()
+            self.routes = [
+                {
+                    **route,
+                    "pattern": re.compile(re.sub(r"\\\{\w+\\\}", r"[^/]+", re.escape(route["path"])) + "$"),
+                    "served": 0,
+                }
+                for route in routes
+            ]
+            self.requests = []
+            self.unmatched = []
+
+    def respond(self, method: str, raw_path: str) -> tuple[int, object, dict, float]:
+        path = urlsplit(raw_path).path
+        with self._lock:
+            self.requests.append(f"{method} {raw_path}")
+            if method == "GET" and path == "/openapi.json":
+                return 200, self.spec_bytes, {"ETag": f'"{hash(self.spec_bytes)}"'}, 0
+            for route in self.routes:
+                if route["method"] == method and route["pattern"].match(path):
+                    response = route["responses"][min(route["served"], len(route["responses"]) - 1)]
+                    route["served"] += 1
+                    return (
+                        response.get("status", 200),
+                        response.get("body"),
+                        response.get("headers", {}),
+                        response.get("delay_ms", 0),
+                    )
+            self.unmatched.append(f"{method} {raw_path}")
+        return 404, {"detail": "Not found (no recorded route)"}, {}, 0
+
+    def close(self) -> None:
+        self.server.shutdown()
+
+
+# ---------------------------------------------------------------------------
+# Harness
+# ---------------------------------------------------------------------------
+
+
+class _NoSpawn:
+    """Modal functions can't be spawned offline; run_agent then finalizes in-process."""
+
+    def spawn(self, *args, **kwargs):
+        raise RuntimeError("Modal spawn is unavailable in replay")
+
+
+def load_scenarios(names: list[str]) -> list[dict]:
+    """Scenario fixtures by name or path (all of FIXTURE_DIR if names is empty)."""
+    if not names:
+        names = sorted(
+            f[:-5] for f in os.listdir(FIXTURE_DIR)
+            if f.endswith(".json") and f != "openapi.json"
+        )
+    scenarios = []
+    for name in names:
+        path = name if name.endswith(".json") else os.path.join(FIXTURE_DIR, f"{name}.json")
+        with open(path) as f:
+            scenario = json.load(f)
+        spec_path = os.path.join(os.path.dirname(path), scenario.get("spec", "openapi.json"))
+        with open(spec_path) as f:
+            scenario["spec_data"] = json.load(f)
+        scenarios.append(scenario)
+    return scenarios
+
+
+def reset_caches(cache_dir: str) -> None:
+    """Give the agent module empty in-memory caches and a fresh cache directory."""
+    with agent._tool_cache_lock:
+        agent._tool_cache.clear()
+        agent._tool_cache_revalidating.clear()
+        for key in agent._tool_cache_stats:
+            agent._tool_cache_stats[key] = 0
+    agent._response_cache = agent.ResponseCache(agent.API_CACHE_MAX_BYTES, agent.API_CACHE_TTL)
+    agent._summary_cache = agent.LRUCache(agent.SUMMARY_CACHE_MAX_BYTES)
+    agent.TOOL_CACHE_DIR = os.path.join(cache_dir, "openapi")
+    agent.SUMMARY_CACHE_DIR = os.path.join(cache_dir, "summaries")
+
+
+def run_scenario(scenario: dict, api: ApiStandIn, options: argparse.Namespace) -> dict:
+    """Run one scenario through run_agent and collect its measurements."""
+    timer = PhaseTimer()
+    supabase = FakeSupabase(round_trip_ms=options.db_latency_ms)
+    supabase.tables["threads"] = [{"id": REPLAY_THREAD_ID, "title": agent.DEFAULT_THREAD_TITLE}]
+    messages = RecordedMessages(scenario, timer, options.replay_latency)
+    api.load(scenario["spec_data"], scenario.get("routes", []))
+
+    patched = {name: getattr(agent, name) for name in (*TIMED_PHASES, "finalize_run", "prebuild_artifact")}
+    for name, phase in TIMED_PHASES.items():
+        setattr(agent, name, timer.wrap(phase, patched[name]))
+    agent.finalize_run = agent.prebuild_artifact = _NoSpawn()
+    if options.poll_interval is not None:
+        poll_defaults = agent.JOB_POLL_INITIAL_INTERVAL, agent.JOB_POLL_MAX_INTERVAL
+        agent.JOB_POLL_INITIAL_INTERVAL = agent.JOB_POLL_MAX_INTERVAL = options.poll_interval
+
+    error = None
+    start = time.perf_counter()
+    # The agent prints every log line; keep the report readable unless --verbose
+    output = contextlib.nullcontext() if options.verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with output:
+            result = agent.run_agent(
+                scenario["question"],
+                REPLAY_THREAD_ID,
+                api_base_url=api.base_url,
+                history=scenario.get("history"),
+                model=scenario.get("model", REPLAY_MODEL),
+                stream=not options.no_stream,
+                supabase=supabase,
+                client=RecordedAnthropic(messages),
+                tool_subset=not options.full_tools,
+            )
+    except Exception as e:
+        result = {"status": "error"}
+        error = f"{type(e).__name__}: {e}"
+    total_ms = (time.perf_counter() - start) * 1000
+    for name, fn in patched.items():
+        setattr(agent, name, fn)
+    if options.poll_interval is not None:
+        agent.JOB_POLL_INITIAL_INTERVAL, agent.JOB_POLL_MAX_INTERVAL = poll_defaults
+
+    run = next(iter(supabase.tables.get("agent_runs", [])), {})
+    message = next((m for m in supabase.tables.get("messages", []) if m.get("role") == "assistant"), {})
+    turns = [r for r in messages.requests if r["kind"] == "turn"]
+    warnings = list(messages.warnings)
+    if error:
+        warnings.append(error)
+    warnings += [f"No recorded route for {request}" for request in api.unmatched]
+    if len(turns) < len(messages.turns):
+        warnings.append(f"Used {len(turns)} of {len(messages.turns)} recorded turns")
+    logs = supabase.tables.get("agent_logs", [])
+    measured = {
+        "turns": result.get("turns"),
+        "compactions": sum(row["message"].startswith("[CONTEXT] Compacted") for row in logs),
+    }
+    warnings += [
+        f"Expected {key} {expected}, got {measured.get(key)}"
+        for key, expected in scenario.get("expect", {}).items()
+        if measured.get(key) != expected
+    ]
+    phases = {phase: round(ms, 1) for phase, ms in sorted(timer.ms.items())}
+    phases["db"] = round(supabase.elapsed_ms, 1)
+    return {
+        "scenario": scenario["name"],
+        "status": result.get("status"),
+        "turns": result.get("turns"),
+        "compactions": measured["compactions"],
+        "total_ms": round(total_ms, 1),
+        "phases_ms": phases,
+        "phase_calls": dict(timer.calls),
+        "db_round_trips": sum(supabase.round_trips.values()),
+        "db_by_table": dict(sorted(supabase.round_trips.items())),
+        "api_requests": len(api.requests),
+        "tokens": {
+            "input": run.get("input_tokens", 0),
+            "output": run.get("output_tokens", 0),
+            "cache_read": run.get("cache_read_tokens", 0),
+            "cache_creation": run.get("cache_creation_tokens", 0),
+            "cost_usd": run.get("cost_usd", 0),
+            "prompt_est": sum(r["prompt_tokens_est"] for r in turns),
+            "tool_defs_est": max((r["tool_tokens_est"] for r in turns), default=0),
+            "tools_offered": max((r["tools"] for r in turns), default=0),
+        },
+        "model_usage": run.get("model_usage", {}),
+        "claude_requests": dict(Counter(r["kind"] for r in messages.requests)),
+        "logs": len(logs),
+        "timings": message.get("timings"),
+        "warnings": warnings,
+    }
+
+
+def summarize_runs(runs: list[dict]) -> dict:
+    """Median timings over repeats of one scenario, with the last run's counts."""
+    summary = dict(runs[-1])
+    summary["repeats"] = len(runs)
+    summary["total_ms"] = round(statistics.median(r["total_ms"] for r in runs), 1)
+    summary["phases_ms"] = {
+        phase: round(statistics.median(r["phases_ms"].get(phase, 0) for r in runs), 1)
+        for phase in runs[-1]["phases_ms"]
+    }
+    summary["warnings"] = sorted({w for r in runs for w in r["warnings"]})
+    return summary
+
+
+def print_report(results: list[dict]) -> None:
+    header = f"{'scenario':<24}{'status':<11}{'turns':>6}{'total ms':>10}{'claude':>9}{'api':>9}{'db trips':>9}{'input':>8}{'output':>8}{'cache r':>9}{'cache w':>9}{'cost $':>9}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        tokens = r["tokens"]
+        print(
+            f"{r['scenario']:<24}{str(r['status']):<11}{str(r['turns']):>6}{r['total_ms']:>10.0f}"
+            f"{r['phases_ms'].get('claude', 0):>9.0f}{r['phases_ms'].get('api_tools', 0):>9.0f}{r['db_round_trips']:>9}"
+            f"{tokens['input']:>8}{tokens['output']:>8}{tokens['cache_read']:>9}{tokens['cache_creation']:>9}{tokens['cost_usd']:>9.4f}"
+        )
+    for r in results:
+        print(f"\n{r['scenario']} ({r['repeats']} run{'s' if r['repeats'] > 1 else ''}, median timings)")
+        print("  phases ms: " + ", ".join(f"{phase} {ms:.0f}" for phase, ms in r["phases_ms"].items()))
+        print("  db: " + ", ".join(f"{key} {count}" for key, count in r["db_by_table"].items()))
+        tokens = r["tokens"]
+        print(
+            f"  claude: {r['claude_requests']}, {tokens['tools_offered']} tools offered"
+            f" (~{tokens['tool_defs_est']} tokens), ~{tokens['prompt_est']} prompt tokens sent"
+        )
+        print(f"  api requests: {r['api_requests']}, agent_logs rows: {r['logs']}, context compactions: {r['compactions']}")
+        for warning in r["warnings"]:
+            print(f"  WARNING: {warning}")
+
+
+def main(argv: list[str] | None = None) -> list[dict]:
+    parser = argparse.ArgumentParser(description="Replay recorded agent scenarios offline and report timings.")
+    parser.add_argument("scenarios", nargs="*", help="Scenario names in fixtures/replay or fixture paths (default: all)")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per scenario; timings are medians")
+    parser.add_argument("--warm", action="store_true", help="Keep tool, response and summary caches between runs")
+    parser.add_argument("--replay-latency", action="store_true", help="Sleep for recorded Claude latencies")
+    parser.add_argument("--db-latency-ms", type=float, default=0.0, help="Simulated latency per Supabase round trip")
+    parser.add_argument("--poll-interval", type=float, default=None, help="Override job poll intervals (seconds)")
+    parser.add_argument("--no-stream", action="store_true", help="Use messages.create instead of streaming")
+    parser.add_argument("--full-tools", action="store_true", help="Offer every API tool instead of a subset")
+    parser.add_argument("--json", help="Also write results to this file")
+    parser.add_argument("--trace-file", help="Append each run's spans to this file as OTLP/JSON lines")
+    parser.add_argument("--verbose", action="store_true", help="Print the agent's logs while it runs")
+    parser.add_argument("--check", action="store_true", help="Exit with status 1 if any scenario has warnings")
+    options = parser.parse_args(argv)
+    # Spans still feed messages.timings; only export them when asked
+    agent.TRACE_EXPORTERS = "file" if options.trace_file else ""
+    agent.TRACE_FILE = options.trace_file or agent.TRACE_FILE
+
+    scenarios = load_scenarios(options.scenarios)
+    # run_agent imports these lazily; import them up front so the first
+    # scenario's timings don't include it
+    import anthropic  # noqa: F401
+    import logfire  # noqa: F401
+
+    api = ApiStandIn()
+    results = []
+    with tempfile.TemporaryDirectory(prefix="agent-replay-") as cache_dir:
+        reset_caches(cache_dir)
+        try:
+            for scenario in scenarios:
+                runs = []
+                for i in range(options.repeat):
+                    if not options.warm:
+                        reset_caches(os.path.join(cache_dir, f"{scenario['name']}-{i}"))
+                    runs.append(run_scenario(scenario, api, options))
+                results.append(summarize_runs(runs))
+        finally:
+            api.close()
+
+    print_report(results)
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if options.check and any(r["warnings"] for r in results):
+        sys.exit(1)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,8 @@
-import { NextRequest } from "next/server";
-import { createClient } from "@supabase/supabase-js";
+import { NextRequest, NextResponse } from "next/server";
+import { createClient } from "@/lib/supabase/server";
 
 const API_BASE_URL =
   process.env.NEXT_PUBLIC_API_BASE_URL || "https://v2.api.policyengine.org";
-const SUPABASE_URL = process.env.NEXT_PUBLIC_SUPABASE_URL!;
-const SUPABASE_SERVICE_KEY = process.env.SUPABASE_SERVICE_KEY!;
 
 interface AgentRequest {
   question: string;
@@ -13,123 +11,66 @@ interface AgentRequest {
   model?: string;
 }
 
-export async function POST(request: NextRequest) {
-  const body: AgentRequest = await request.json();
-  const supabase = createClient(SUPABASE_URL, SUPABASE_SERVICE_KEY);
-
-  const encoder = new TextEncoder();
-  const stream = new ReadableStream({
-    async start(controller) {
-      try {
-        // Clear any old logs for this thread
-        await supabase
-          .from("agent_logs")
-          .delete()
-          .eq("thread_id", body.threadId);
-
-        // Spawn the Modal function
-        const modalResponse = await fetch(
-          "https://nikhilwoodruff--policyengine-chat-agent-run-agent-web.modal.run",
-          {
-            method: "POST",
-            headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({
-              question: body.question,
-              thread_id: body.threadId,
-              api_base_url: API_BASE_URL,
-              history: body.history,
-              model: "claude-opus-4-5",
-            }),
-          }
-        );
-
-        if (!modalResponse.ok) {
-          // Modal function might be async, check if it returned a call ID
-          const text = await modalResponse.text();
-          controller.enqueue(
-            encoder.encode(
-              `data: ${JSON.stringify({ type: "log", message: `Starting agent... ${text}` })}\n\n`
-            )
-          );
-        }
-
-        // Poll Supabase for logs and check for completion
-        let lastLogCount = 0;
-        let attempts = 0;
-        const maxAttempts = 120; // 2 minutes max
+// The stream stays open for the whole run, which Modal caps at 10 minutes
+export const maxDuration = 600;
 
-        while (attempts < maxAttempts) {
-          await new Promise((resolve) => setTimeout(resolve, 1000));
-          attempts++;
+const SSE_HEADERS = {
+  "Content-Type": "text/event-stream",
+  "Cache-Control": "no-cache",
+  Connection: "keep-alive",
+};
 
-          // Get new logs
-          const { data: logs } = await supabase
-            .from("agent_logs")
-            .select("*")
-            .eq("thread_id", body.threadId)
-            .order("created_at", { ascending: true });
+function errorEvent(message: string) {
+  return new Response(
+    `data: ${JSON.stringify({ type: "error", message })}\n\ndata: ${JSON.stringify({ type: "done" })}\n\n`,
+    { headers: SSE_HEADERS }
+  );
+}
 
-          if (logs && logs.length > lastLogCount) {
-            for (let i = lastLogCount; i < logs.length; i++) {
-              controller.enqueue(
-                encoder.encode(
-                  `data: ${JSON.stringify({ type: "log", message: logs[i].message })}\n\n`
-                )
-              );
-            }
-            lastLogCount = logs.length;
-          }
+export async function POST(request: NextRequest) {
+  const body: AgentRequest = await request.json();
 
-          // Check if agent completed (look for completion log)
-          const hasCompleted = logs?.some((log) =>
-            log.message.includes("[AGENT] Completed")
-          );
+  // Get user ID from session
+  const supabase = await createClient();
+  const { data: { user } } = await supabase.auth.getUser();
 
-          if (hasCompleted) {
-            // Get the assistant message
-            const { data: messages } = await supabase
-              .from("messages")
-              .select("*")
-              .eq("thread_id", body.threadId)
-              .eq("role", "assistant")
-              .order("created_at", { ascending: false })
-              .limit(1);
+  try {
+    // The streaming endpoint pushes typed events (run, log, delta, tool_result,
+    // result, error, done) as server-sent events, so we proxy it directly
+    // instead of polling agent_logs
+    const modalResponse = await fetch(
+      "https://nikhilwoodruff--policyengine-chat-agent-run-agent-stream.modal.run",
+      {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({
+          question: body.question,
+          thread_id: body.threadId,
+          api_base_url: API_BASE_URL,
+          history: body.history,
+          user_id: user?.id,
+          model: "claude-opus-4-5",
+        }),
+        signal: request.signal,
+      }
+    );
 
-            if (messages && messages.length > 0) {
-              controller.enqueue(
-                encoder.encode(
-                  `data: ${JSON.stringify({ type: "result", content: messages[0].content })}\n\n`
-                )
-              );
-            }
-            break;
-          }
-        }
+    if (modalResponse.status === 429) {
+      // Admission control: the user already has runs in flight or the queue is full
+      const result = await modalResponse.json();
+      return NextResponse.json(result, {
+        status: 429,
+        headers: { "Retry-After": modalResponse.headers.get("Retry-After") || "10" },
+      });
+    }
 
-        if (attempts >= maxAttempts) {
-          controller.enqueue(
-            encoder.encode(
-              `data: ${JSON.stringify({ type: "error", message: "Request timed out" })}\n\n`
-            )
-          );
-        }
-      } catch (error) {
-        controller.enqueue(
-          encoder.encode(
-            `data: ${JSON.stringify({ type: "error", message: String(error) })}\n\n`
-          )
-        );
-      } finally {
-        controller.close();
-      }
-    },
-  });
+    if (!modalResponse.ok || !modalResponse.body) {
+      const text = await modalResponse.text();
+      return errorEvent(`Agent failed to start: ${text}`);
+    }
 
-  return new Response(stream, {
-    headers: {
-      "Content-Type": "text/event-stream",
-      "Cache-Control": "no-cache",
-      Connection: "keep-alive",
-    },
-  });
+    return new Response(modalResponse.body, { headers: SSE_HEADERS });
+  } catch (error) {
+    return errorEvent(String(error));
+  }
 }
@@ -38,8 +38,40 @@ function CopyButton({ text, className = "" }: { text: string; className?: string
 interface AgentLog {
   id: string;
   thread_id: string;
+  run_id?: string | null;
   message: string;
   created_at: string;
+  seq?: number | null;
+}
+
+// Server-sent event from /api/agent (see run_agent_stream)
+interface AgentEvent {
+  type: "run" | "log" | "delta" | "tool_result" | "result" | "error" | "done";
+  run_id?: string;
+  message?: string;
+  text?: string;
+}
+
+async function readAgentEvents(body: ReadableStream<Uint8Array>, onEvent: (event: AgentEvent) => void) {
+  const reader = body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) return;
+    buffer += decoder.decode(value, { stream: true });
+    const frames = buffer.split("\n\n");
+    buffer = frames.pop() ?? "";
+    for (const frame of frames) {
+      // Lines starting with ":" are keep-alive comments
+      const data = frame
+        .split("\n")
+        .filter((line) => line.startsWith("data: "))
+        .map((line) => line.slice("data: ".length))
+        .join("\n");
+      if (data) onEvent(JSON.parse(data));
+    }
+  }
 }
 
 interface Artifact {
@@ -420,6 +452,13 @@ export function ChatInterface({ threadId }: ChatInterfaceProps) {
   const [showShareMenu, setShowShareMenu] = useState(false);
   const [copied, setCopied] = useState(false);
   const [tokenCost, setTokenCost] = useState<number | null>(null);
+  // Shown above the input, never added to messages (so never sent as history)
+  const [notice, setNotice] = useState<string | null>(null);
+  // Text Claude is writing in the current turn, from the stream's delta events
+  const [streamingText, setStreamingText] = useState("");
+  // True while this tab reads its run's events from the stream, so the same
+  // rows arriving over realtime are skipped
+  const streamingRef = useRef(false);
   const messagesEndRef = useRef<HTMLDivElement>(null);
   const logsEndRef = useRef<HTMLDivElement>(null);
   const supabase = createClient();
@@ -488,14 +527,41 @@ export function ChatInterface({ threadId }: ChatInterfaceProps) {
         },
         (payload) => {
           const newLog = payload.new as AgentLog;
+          if (streamingRef.current) return;
           setLogs((prev) => {
             if (prev.some((l) => l.id === newLog.id)) return prev;
-            return [...prev, newLog];
+            // Batched inserts can arrive out of order; keep logs in seq order
+            const last = prev[prev.length - 1];
+            if (newLog.seq == null || last?.seq == null || newLog.seq > last.seq) {
+              return [...prev, newLog];
+            }
+            return [...prev, newLog].sort((a, b) => (a.seq ?? 0) - (b.seq ?? 0));
           });
         }
       )
       .subscribe();
 
+    // Runs that end without an answer (failed or cancelled) stop the spinner here;
+    // completed runs are handled when their message arrives
+    const runsChannel = supabase
+      .channel(`runs-${threadId}`)
+      .on(
+        "postgres_changes",
+        {
+          event: "UPDATE",
+          schema: "public",
+          table: "agent_runs",
+          filter: `thread_id=eq.${threadId}`,
+        },
+        (payload) => {
+          const run = payload.new as { status: string };
+          if (run.status === "failed" || run.status === "cancelled") {
+            setIsLoading(false);
+          }
+        }
+      )
+      .subscribe();
+
     // Subscribe to thread updates for token cost
     const threadChannel = supabase
       .channel(`thread-${threadId}`)
@@ -543,6 +609,7 @@ export function ChatInterface({ threadId }: ChatInterfaceProps) {
     return () => {
       supabase.removeChannel(messagesChannel);
       supabase.removeChannel(logsChannel);
+      supabase.removeChannel(runsChannel);
       supabase.removeChannel(threadChannel);
       supabase.removeChannel(artifactsChannel);
     };
@@ -647,33 +714,28 @@ export function ChatInterface({ threadId }: ChatInterfaceProps) {
   }
 
   async function loadLogs() {
-    // Load existing logs (in case of page refresh while agent is running)
+    // Reattach to the latest run if it is still in progress (page refresh mid-run)
+    const { data: run } = await supabase
+      .from("agent_runs")
+      .select("id, status")
+      .eq("thread_id", threadId)
+      .order("created_at", { ascending: false })
+      .limit(1)
+      .maybeSingle();
+
+    if (!run || (run.status !== "queued" && run.status !== "running")) {
+      // Finished runs have their logs attached to the message via tool_logs
+      return;
+    }
+
     const { data: existingLogs } = await supabase
       .from("agent_logs")
       .select("*")
-      .eq("thread_id", threadId)
-      .order("created_at", { ascending: true });
+      .eq("run_id", run.id)
+      .order("seq", { ascending: true });
 
-    if (existingLogs && existingLogs.length > 0) {
-      // Check if agent is finished (completed, cancelled, or stale)
-      const hasFinished = existingLogs.some((log) =>
-        log.message.includes("[AGENT] Completed") ||
-        log.message.includes("[AGENT] Cancelled") ||
-        log.message === "[CANCELLED]"
-      );
-
-      // Also check if logs are stale (last log > 5 minutes old = agent probably crashed)
-      const lastLog = existingLogs[existingLogs.length - 1];
-      const lastLogAge = Date.now() - new Date(lastLog.created_at).getTime();
-      const isStale = lastLogAge > 5 * 60 * 1000; // 5 minutes
-
-      if (!hasFinished && !isStale) {
-        // Agent is still running - show logs and set loading state
-        setLogs(existingLogs);
-        setIsLoading(true);
-      }
-      // If finished or stale, logs will be attached to the message via tool_logs
-    }
+    setLogs(existingLogs || []);
+    setIsLoading(true);
   }
 
   async function togglePublic() {
@@ -698,10 +760,10 @@ export function ChatInterface({ threadId }: ChatInterfaceProps) {
 
     const userMessage = input.trim();
     setInput("");
+    setNotice(null);
     setIsLoading(true);
     setLogs([]);
-
-    await supabase.from("agent_logs").delete().eq("thread_id", threadId);
+    setStreamingText("");
 
     // Optimistic update - show message immediately
     const tempId = `temp-${Date.now()}`;
@@ -713,24 +775,13 @@ export function ChatInterface({ threadId }: ChatInterfaceProps) {
       created_at: new Date().toISOString(),
     }]);
 
-    await supabase.from("messages").insert({
-      thread_id: threadId,
-      role: "user",
-      content: userMessage,
-    });
-
-    if (messages.length === 0) {
-      const title = userMessage.slice(0, 50) + (userMessage.length > 50 ? "..." : "");
-      await supabase.from("threads").update({ title }).eq("id", threadId);
-    }
-
     const history = messages.map((m) => ({
       role: m.role,
       content: m.content,
     }));
 
     try {
-      const response = await fetch("/api/agent/spawn", {
+      const response = await fetch("/api/agent", {
         method: "POST",
         headers: { "Content-Type": "application/json" },
         body: JSON.stringify({
@@ -740,14 +791,53 @@ export function ChatInterface({ threadId }: ChatInterfaceProps) {
         }),
       });
 
-      if (!response.ok) {
-        const error = await response.json();
-        console.error("Agent error:", error);
+      if (response.status === 429) {
+        // The run was never queued: drop the question and give it back to the user
+        const reason = (await response.json()).reason;
+        setMessages((prev) => prev.filter((m) => m.id !== tempId));
+        setInput(userMessage);
+        setNotice(
+          reason === "user_limit"
+            ? "You already have a question in progress. Please wait for it to finish and try again."
+            : "The analyst is busy right now. Please try again in a few seconds."
+        );
         setIsLoading(false);
+        return;
       }
+
+      // Admission saves the question and the placeholder title with the run
+      if (!response.ok || !response.body) {
+        console.error("Agent error:", await response.text());
+        setIsLoading(false);
+        return;
+      }
+
+      // Progress comes from the stream; the answer still arrives as a message insert
+      streamingRef.current = true;
+      await readAgentEvents(response.body, (event) => {
+        if (event.type === "delta") {
+          setStreamingText((prev) => prev + (event.text ?? ""));
+        } else if (event.type === "log") {
+          const message = event.message ?? "";
+          // A new turn starts a new piece of text
+          if (message.startsWith("[AGENT] Turn ")) setStreamingText("");
+          setLogs((prev) => [...prev, {
+            id: `stream-${prev.length}`,
+            thread_id: threadId,
+            message,
+            created_at: new Date().toISOString(),
+          }]);
+        } else if (event.type === "error") {
+          console.error("Agent error:", event.message);
+          setNotice("Something went wrong while answering. Please try again.");
+          setIsLoading(false);
+        }
+      });
     } catch (error) {
-      console.error("Failed to spawn agent:", error);
+      console.error("Failed to run agent:", error);
       setIsLoading(false);
+    } finally {
+      streamingRef.current = false;
     }
   }
 
@@ -940,6 +1030,13 @@ export function ChatInterface({ threadId }: ChatInterfaceProps) {
                   {parsedSteps.map((step, j) => (
                     <ToolCard key={j} step={step} />
                   ))}
+                  {streamingText && (
+                    <div className="response-content mt-2">
+                      <ReactMarkdown remarkPlugins={[remarkGfm, remarkBreaks]}>
+                        {streamingText}
+                      </ReactMarkdown>
+                    </div>
+                  )}
                   <div ref={logsEndRef} />
                 </div>
               </div>
@@ -962,6 +1059,11 @@ export function ChatInterface({ threadId }: ChatInterfaceProps) {
 
       {/* Input */}
       <div className="border-t border-[var(--color-border)] p-2 sm:p-4 bg-[var(--color-surface)]">
+        {notice && (
+          <div className="max-w-3xl mx-auto mb-2 px-3 py-2 text-[13px] text-amber-800 bg-amber-50 border border-amber-200 rounded-lg">
+            {notice}
+          </div>
+        )}
         <form onSubmit={sendMessage} className="flex gap-2 sm:gap-3 max-w-3xl mx-auto">
           <input
             type="text"
@@ -975,11 +1077,11 @@ export function ChatInterface({ threadId }: ChatInterfaceProps) {
             <button
               type="button"
               onClick={async () => {
-                // Insert cancellation signal for the agent to pick up
-                await supabase.from("agent_logs").insert({
-                  thread_id: threadId,
-                  message: "[CANCELLED]",
-                });
+                // Flag the thread; the running agent watches this column
+                await supabase
+                  .from("threads")
+                  .update({ cancel_requested_at: new Date().toISOString() })
+                  .eq("id", threadId);
                 setIsLoading(false);
                 setLogs((prev) => [...prev, {
                   id: `cancel-${Date.now()}`,
@@ -5,24 +5,64 @@ export interface Thread {
   is_public: boolean;
   input_tokens: number | null;
   output_tokens: number | null;
+  cache_read_tokens: number | null;
+  cache_creation_tokens: number | null;
+  model_usage: Record<string, Record<string, number>> | null;
+  cancel_requested_at: string | null;
   created_at: string;
   updated_at: string;
 }
 
+export interface MessageTimings {
+  total_ms: number;
+  phases: Record<string, { count: number; total_ms: number; max_ms: number }>;
+  turns: ({ turn: number; ms: number } & Record<string, number>)[];
+  counters: Record<string, number>;
+}
+
 export interface Message {
   id: string;
   thread_id: string;
   role: "user" | "assistant";
   content: string;
   tool_logs?: string[] | null;
+  timings?: MessageTimings | null;
+  run_id?: string | null;
   created_at: string;
 }
 
 export interface AgentLog {
   id: string;
   thread_id: string;
+  run_id: string | null;
   message: string;
   created_at: string;
+  seq: number | null;
+}
+
+export type AgentRunStatus = "queued" | "running" | "completed" | "failed" | "cancelled";
+
+export interface AgentRun {
+  id: string;
+  thread_id: string;
+  user_id: string | null;
+  model: string;
+  question: string | null;
+  status: AgentRunStatus;
+  error: string | null;
+  turns: number | null;
+  input_tokens: number | null;
+  output_tokens: number | null;
+  cache_read_tokens: number | null;
+  cache_creation_tokens: number | null;
+  cost_usd: number | null;
+  model_usage: Record<string, Record<string, number>> | null;
+  duration_ms: number | null;
+  usage_applied_at: string | null;
+  title_usage: Record<string, Record<string, number>> | null;
+  created_at: string;
+  started_at: string | null;
+  completed_at: string | null;
 }
 
 export interface Database {
@@ -35,6 +75,7 @@ export interface Database {
           title?: string;
           user_id?: string;
           is_public?: boolean;
+          cancel_requested_at?: string | null;
           created_at?: string;
           updated_at?: string;
         };
@@ -43,6 +84,7 @@ export interface Database {
           title?: string;
           user_id?: string;
           is_public?: boolean;
+          cancel_requested_at?: string | null;
           created_at?: string;
           updated_at?: string;
         };
@@ -55,6 +97,7 @@ export interface Database {
           thread_id: string;
           role: "user" | "assistant";
           content: string;
+          run_id?: string | null;
           created_at?: string;
         };
         Update: {
@@ -78,14 +121,18 @@ export interface Database {
         Insert: {
           id?: string;
           thread_id: string;
+          run_id?: string | null;
           message: string;
           created_at?: string;
+          seq?: number | null;
         };
         Update: {
           id?: string;
           thread_id?: string;
+          run_id?: string | null;
           message?: string;
           created_at?: string;
+          seq?: number | null;
         };
         Relationships: [
           {
@@ -96,9 +143,43 @@ export interface Database {
           }
         ];
       };
+      agent_runs: {
+        Row: AgentRun;
+        Insert: {
+          id?: string;
+          thread_id: string;
+          user_id?: string | null;
+          model: string;
+          question?: string | null;
+          status?: AgentRunStatus;
+          created_at?: string;
+        };
+        Update: Partial<AgentRun>;
+        Relationships: [
+          {
+            foreignKeyName: "agent_runs_thread_id_fkey";
+            columns: ["thread_id"];
+            referencedRelation: "threads";
+            referencedColumns: ["id"];
+          }
+        ];
+      };
     };
     Views: Record<string, never>;
-    Functions: Record<string, never>;
+    Functions: {
+      increment_thread_usage: {
+        Args: {
+          p_thread_id: string;
+          p_input_tokens?: number;
+          p_output_tokens?: number;
+          p_cache_read_tokens?: number;
+          p_cache_creation_tokens?: number;
+          p_model_usage?: Record<string, Record<string, number>>;
+          p_run_id?: string | null;
+        };
+        Returns: boolean;
+      };
+    };
     Enums: Record<string, never>;
     CompositeTypes: Record<string, never>;
   };
@@ -0,0 +1,53 @@
+-- Per-thread sequence number for agent logs, assigned in the database on
+-- insert. Readers fetch seq > last_seen instead of ordering by created_at,
+-- which collides when many rows are inserted in the same millisecond.
+alter table agent_logs add column if not exists seq bigint;
+
+-- Number existing rows in timestamp order
+update agent_logs
+set seq = numbered.seq
+from (
+  select id, row_number() over (partition by thread_id order by created_at, id) as seq
+  from agent_logs
+) as numbered
+where agent_logs.id = numbered.id and agent_logs.seq is null;
+
+-- Last seq handed out per thread
+create table if not exists agent_log_seqs (
+  thread_id uuid primary key references threads(id) on delete cascade,
+  last_seq bigint not null default 0
+);
+
+-- Only the trigger below touches the counters
+alter table agent_log_seqs enable row level security;
+
+insert into agent_log_seqs (thread_id, last_seq)
+select thread_id, max(seq) from agent_logs group by thread_id
+on conflict (thread_id) do update set last_seq = greatest(agent_log_seqs.last_seq, excluded.last_seq);
+
+-- Cursor reads (seq > last_seen). Keyed columns only: btree tuples are capped
+-- at about 2.7 KB, so including message would reject long log lines.
+create unique index if not exists agent_logs_thread_seq_key on agent_logs(thread_id, seq);
+
+-- Rows of a multi-row insert are numbered in order. The counter row stays
+-- locked until the inserting transaction commits, so a lower seq is always
+-- visible before a higher one and readers paging on seq never skip a row.
+create or replace function assign_agent_log_seq() returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+  insert into agent_log_seqs (thread_id, last_seq)
+  values (new.thread_id, 1)
+  on conflict (thread_id) do update set last_seq = agent_log_seqs.last_seq + 1
+  returning last_seq into new.seq;
+  return new;
+end;
+$$;
+
+drop trigger if exists agent_logs_assign_seq on agent_logs;
+create trigger agent_logs_assign_seq
+  before insert on agent_logs
+  for each row
+  execute function assign_agent_log_seq();
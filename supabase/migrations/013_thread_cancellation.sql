@@ -0,0 +1,4 @@
+-- Cancellation flag on threads, set by the frontend and watched by the agent.
+-- Replaces inserting a "[CANCELLED]" row into agent_logs and scanning for it
+-- before every turn.
+alter table threads add column if not exists cancel_requested_at timestamptz;
@@ -0,0 +1,50 @@
+-- One row per agent run, tracking its lifecycle and totals. Replaces
+-- detecting completion by searching agent_logs for "[AGENT] Completed".
+create table if not exists agent_runs (
+  id uuid primary key default gen_random_uuid(),
+  thread_id uuid not null references threads(id) on delete cascade,
+  user_id uuid references auth.users(id) on delete set null,
+  model text not null,
+  question text,
+  status text not null default 'queued'
+    check (status in ('queued', 'running', 'completed', 'failed', 'cancelled')),
+  error text,
+  turns integer default 0,
+  input_tokens bigint default 0,
+  output_tokens bigint default 0,
+  cache_read_tokens bigint default 0,
+  cache_creation_tokens bigint default 0,
+  cost_usd numeric(12, 6),
+  duration_ms integer,
+  created_at timestamp with time zone default now(),
+  started_at timestamp with time zone,
+  completed_at timestamp with time zone
+);
+
+-- Latest run for a thread
+create index if not exists agent_runs_thread_id_created_at_idx
+  on agent_runs(thread_id, created_at desc);
+
+-- Key logs and messages to the run that produced them
+alter table agent_logs add column if not exists run_id uuid references agent_runs(id) on delete cascade;
+create index if not exists agent_logs_run_seq_idx on agent_logs(run_id, seq);
+
+alter table messages add column if not exists run_id uuid references agent_runs(id) on delete set null;
+
+-- RLS policies
+alter table agent_runs enable row level security;
+
+create policy "Users can view runs in their threads"
+  on agent_runs for select
+  using (thread_id in (select id from threads where user_id = auth.uid()));
+
+create policy "Anyone can view runs in anonymous threads"
+  on agent_runs for select
+  using (thread_id in (select id from threads where user_id is null));
+
+create policy "Service role can manage agent runs"
+  on agent_runs for all
+  using (auth.role() = 'service_role');
+
+-- Enable realtime
+alter publication supabase_realtime add table agent_runs;
@@ -0,0 +1,62 @@
+-- Cache and per-model token usage, alongside the existing input/output totals
+alter table threads add column if not exists cache_read_tokens bigint default 0;
+alter table threads add column if not exists cache_creation_tokens bigint default 0;
+alter table threads add column if not exists model_usage jsonb default '{}'::jsonb;
+
+alter table agent_runs add column if not exists model_usage jsonb default '{}'::jsonb;
+-- Usage of the title request, kept so a retried finalize still counts it
+alter table agent_runs add column if not exists title_usage jsonb;
+-- Set when the run's usage has been added to its thread
+alter table agent_runs add column if not exists usage_applied_at timestamp with time zone;
+
+-- Add a run's token usage to its thread in a single atomic update.
+-- p_model_usage is {model: {counter: n}}; counters are summed per model.
+-- With p_run_id, the run is marked as applied in the same transaction and a
+-- second call for it changes nothing. Returns whether the usage was added.
+create or replace function increment_thread_usage(
+  p_thread_id uuid,
+  p_input_tokens bigint default 0,
+  p_output_tokens bigint default 0,
+  p_cache_read_tokens bigint default 0,
+  p_cache_creation_tokens bigint default 0,
+  p_model_usage jsonb default '{}'::jsonb,
+  p_run_id uuid default null
+) returns boolean
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+  if p_run_id is not null then
+    update agent_runs set usage_applied_at = now()
+    where id = p_run_id and usage_applied_at is null;
+    if not found then
+      return false;
+    end if;
+  end if;
+
+  update threads set
+    input_tokens = coalesce(input_tokens, 0) + p_input_tokens,
+    output_tokens = coalesce(output_tokens, 0) + p_output_tokens,
+    cache_read_tokens = coalesce(cache_read_tokens, 0) + p_cache_read_tokens,
+    cache_creation_tokens = coalesce(cache_creation_tokens, 0) + p_cache_creation_tokens,
+    model_usage = coalesce(threads.model_usage, '{}'::jsonb) || coalesce((
+      select jsonb_object_agg(
+        m.key,
+        coalesce(threads.model_usage -> m.key, '{}'::jsonb) || (
+          select jsonb_object_agg(
+            u.key,
+            coalesce((threads.model_usage -> m.key ->> u.key)::bigint, 0) + (u.value #>> '{}')::bigint
+          )
+          from jsonb_each(m.value) as u
+        )
+      )
+      from jsonb_each(p_model_usage) as m
+    ), '{}'::jsonb)
+  where id = p_thread_id;
+  return true;
+end;
+$$;
+
+revoke execute on function increment_thread_usage(uuid, bigint, bigint, bigint, bigint, jsonb, uuid) from public, anon, authenticated;
+grant execute on function increment_thread_usage(uuid, bigint, bigint, bigint, bigint, jsonb, uuid) to service_role;
@@ -0,0 +1,116 @@
+-- Admission control for queued agent runs. The agent_runs table is the queue:
+-- queued and running rows count against per-user and global limits. Rows
+-- older than p_stale_after_seconds are ignored, so a crashed run doesn't hold
+-- its slot forever.
+create index if not exists agent_runs_active_idx
+  on agent_runs(status, created_at)
+  where status in ('queued', 'running');
+
+create index if not exists agent_runs_started_at_idx on agent_runs(started_at);
+
+-- Atomically check limits and insert a queued run along with the question
+-- it answers, so a rejected question is never saved and an admitted one is.
+-- Returns {admitted, run_id, queue_position, active} or {admitted: false, reason, ...}.
+create or replace function enqueue_agent_run(
+  p_thread_id uuid,
+  p_user_id uuid,
+  p_model text,
+  p_question text,
+  p_max_active integer,
+  p_max_queued integer,
+  p_max_per_user integer,
+  p_stale_after_seconds integer default 1800
+) returns jsonb
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  v_active integer;
+  v_user_active integer;
+  v_run_id uuid;
+begin
+  -- Serialise admission so concurrent requests can't both take the last slot
+  perform pg_advisory_xact_lock(hashtext('enqueue_agent_run'));
+
+  select
+    count(*),
+    count(*) filter (
+      where (p_user_id is not null and user_id = p_user_id)
+         or (p_user_id is null and thread_id = p_thread_id)
+    )
+  into v_active, v_user_active
+  from agent_runs
+  where status in ('queued', 'running')
+    and created_at > now() - make_interval(secs => p_stale_after_seconds);
+
+  if v_user_active >= p_max_per_user then
+    return jsonb_build_object('admitted', false, 'reason', 'user_limit', 'active', v_active, 'user_active', v_user_active);
+  end if;
+
+  if v_active >= p_max_active + p_max_queued then
+    return jsonb_build_object('admitted', false, 'reason', 'queue_full', 'active', v_active);
+  end if;
+
+  insert into agent_runs (thread_id, user_id, model, question, status)
+  values (p_thread_id, p_user_id, p_model, left(p_question, 1000), 'queued')
+  returning id into v_run_id;
+
+  insert into messages (thread_id, run_id, role, content)
+  values (p_thread_id, v_run_id, 'user', p_question);
+
+  -- A cancel pressed from here on applies to this run, even while it is queued.
+  -- An untitled thread gets the truncated question until the agent titles it.
+  update threads set
+    cancel_requested_at = null,
+    title = case
+      when title is null or title = 'New chat'
+        then left(p_question, 50) || case when length(p_question) > 50 then '...' else '' end
+      else title
+    end
+  where id = p_thread_id;
+
+  return jsonb_build_object(
+    'admitted', true,
+    'run_id', v_run_id,
+    'queue_position', greatest(v_active + 1 - p_max_active, 0),
+    'active', v_active + 1
+  );
+end;
+$$;
+
+-- Queue depth and recent queue wait times, for sizing concurrency
+create or replace function agent_queue_stats(
+  p_window_seconds integer default 900,
+  p_stale_after_seconds integer default 1800
+) returns jsonb
+language sql
+stable
+security definer
+set search_path = public
+as $$
+  with active as (
+    select status, created_at
+    from agent_runs
+    where status in ('queued', 'running')
+      and created_at > now() - make_interval(secs => p_stale_after_seconds)
+  ),
+  waits as (
+    select extract(epoch from started_at - created_at) as wait_seconds
+    from agent_runs
+    where started_at > now() - make_interval(secs => p_window_seconds)
+  )
+  select jsonb_build_object(
+    'queued', (select count(*) from active where status = 'queued'),
+    'running', (select count(*) from active where status = 'running'),
+    'oldest_queued_seconds', (select coalesce(extract(epoch from now() - min(created_at)), 0) from active where status = 'queued'),
+    'started_in_window', (select count(*) from waits),
+    'avg_wait_seconds', (select coalesce(avg(wait_seconds), 0) from waits),
+    'p95_wait_seconds', (select coalesce(percentile_cont(0.95) within group (order by wait_seconds), 0) from waits)
+  );
+$$;
+
+revoke execute on function enqueue_agent_run(uuid, uuid, text, text, integer, integer, integer, integer) from public, anon, authenticated;
+grant execute on function enqueue_agent_run(uuid, uuid, text, text, integer, integer, integer, integer) to service_role;
+revoke execute on function agent_queue_stats(integer, integer) from public, anon, authenticated;
+grant execute on function agent_queue_stats(integer, integer) to service_role;
@@ -0,0 +1,10 @@
+-- Build metrics for react/script artifacts, recorded by the artifact builder
+alter table artifacts add column if not exists build_key text;
+alter table artifacts add column if not exists build_status text;
+alter table artifacts add column if not exists build_error text;
+alter table artifacts add column if not exists built_at timestamp with time zone;
+-- warm, lockfile, resolved or none: how the dependency set was installed
+alter table artifacts add column if not exists dependency_cache text;
+alter table artifacts add column if not exists install_ms integer;
+alter table artifacts add column if not exists build_ms integer;
+alter table artifacts add column if not exists bundle_bytes integer;
@@ -0,0 +1,2 @@
+-- Per-run timing summary (phase totals, per-turn breakdown, counters) saved with the assistant message
+alter table messages add column if not exists timings jsonb;